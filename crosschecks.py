@@ -975,11 +975,16 @@ def check_reweighting_for_inc_xs(args):
 
 
 class PDFDrawer(object):
-    """docstring for PDFDrawer"""
+    """
+    Draws pdfs of a workspace; the workspace is shared, so use as
+    `with PDFDrawer(ws) as pdfdrawer:` to restore the variables afterwards
+    """
     def __init__(self, ws):
         super(PDFDrawer, self).__init__()
         self.ws = ws
         self.w = differentials.core.get_ws(self.ws)
+        self.preserved_values = differentials.wsregistry.preserved_values(self.w)
+        self.preserved_values.__enter__()
 
         self.MH = self.w.var('MH')
         self.MH.setVal(125.)
@@ -1000,6 +1005,11 @@ class PDFDrawer(object):
         self.hgg_cat = self.w.cat('CMS_channel')
         ROOT.SetOwnership(self.hgg_cat, False )
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.preserved_values.__exit__(*args)
 
     def set_testable_yield_parameter(self, name):
         self.mu = self.w.var(name)
@@ -1090,33 +1100,33 @@ def hgg_pdf_xcheck(args):
 
     for ws in [ ws_smH, ws_ggH ]:
 
-        pdfdrawer = PDFDrawer(ws)
-        pdfdrawer.set_testable_yield_parameter(yp[ws])
+        with PDFDrawer(ws) as pdfdrawer:
+            pdfdrawer.set_testable_yield_parameter(yp[ws])
 
-        c.Clear()
-        c.set_margins()
+            c.Clear()
+            c.set_margins()
 
-        base = differentials.plotting.pywrappers.Base(
-                x_min = 100.,
-                x_max = 180.,
-                y_min = 0.,
-                # y_max = 0.20,
-                y_max = 1.20,
-                x_title = 'mH',
-                y_title = '',
-                )
-        base.Draw()
+            base = differentials.plotting.pywrappers.Base(
+                    x_min = 100.,
+                    x_max = 180.,
+                    y_min = 0.,
+                    # y_max = 0.20,
+                    y_max = 1.20,
+                    x_title = 'mH',
+                    y_title = '',
+                    )
+            base.Draw()
 
-        pdf_name = 'pdf_binrecoPt_600p0_10000p0_SigmaMpTTag_0_13TeV'
+            pdf_name = 'pdf_binrecoPt_600p0_10000p0_SigmaMpTTag_0_13TeV'
 
-        for mu_val in [ 0.5, 1.0, 2.0, -1.0, -2.0, -3.0, -5.0, -10.0 ]:
-            pdfdrawer.mu.setVal(mu_val)
-            # H = pdfdrawer.get_histogram('pdf_binrecoPt_600p0_10000p0_SigmaMpTTag_0_13TeV_obsOnly')
-            H = pdfdrawer.get_histogram(pdf_name)
-            H.Draw('HISTSAME')
+            for mu_val in [ 0.5, 1.0, 2.0, -1.0, -2.0, -3.0, -5.0, -10.0 ]:
+                pdfdrawer.mu.setVal(mu_val)
+                # H = pdfdrawer.get_histogram('pdf_binrecoPt_600p0_10000p0_SigmaMpTTag_0_13TeV_obsOnly')
+                H = pdfdrawer.get_histogram(pdf_name)
+                H.Draw('HISTSAME')
 
-        H_data = pdfdrawer.get_data_histogram(pdf_name)
-        H_data.Draw('HISTSAME')
+            H_data = pdfdrawer.get_data_histogram(pdf_name)
+            H_data.Draw('HISTSAME')
 
         outname = 'hgg_pdf_xcheck_' + os.path.basename(ws).replace('.root','')
         c.save(outname)
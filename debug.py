@@ -226,8 +226,9 @@ def debug_print_hbb_pdfs(args):
         w.pdf('shapeBkg_qcd_cat2_pass_cat2').Print()
 
     print_w(w)
-    set_w(w)
-    print_w(w)
+    with differentials.wsregistry.preserved_values(w):
+        set_w(w)
+        print_w(w)
 
 
 
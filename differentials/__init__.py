@@ -16,6 +16,10 @@ import onedimscanner
 import onedimscanfilter
 import observable
 import scan_accounting
+import scancache
+import scancompleteness
+import wsregistry
+import rbfspline
 
 # Sub-packages
 import plotting
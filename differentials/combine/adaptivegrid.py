@@ -0,0 +1,186 @@
+"""
+Bookkeeping for adaptive 2D pointwise scans (see CombineAdaptivePointwiseScan).
+
+The fastscan defines a regular grid of points. The scan starts on a coarse
+subgrid (every step-th node in both directions); after every pass, the cells of
+the current subgrid are inspected, and only those that a contour crosses, or
+where the scan deviates strongly from a linear interpolation of the corners
+(according to an RBF spline through all points measured so far), are
+subdivided by adding the nodes at half the step.
+
+The last node along each axis is always part of the subgrid, so when the grid
+size is not a multiple of the step plus one, the last cell is a smaller one.
+Nodes that the fastscan rejected are replaced by the nearest available node,
+both when queueing the coarse subgrid and when evaluating cell corners. Nodes of
+which the fit failed (deltaNLL 9990.) stay NaN and are marked failed; as cell
+corners they are treated like rejected nodes.
+"""
+
+import logging
+import numpy
+
+import differentials.rbfspline
+
+
+class AdaptiveGrid(object):
+    """docstring for AdaptiveGrid"""
+
+    def __init__(self, iPoints, xs, ys):
+        super(AdaptiveGrid, self).__init__()
+        xs = numpy.round(numpy.asarray(xs, dtype=numpy.float64), 8)
+        ys = numpy.round(numpy.asarray(ys, dtype=numpy.float64), 8)
+        self.x_axis = numpy.unique(xs)
+        self.y_axis = numpy.unique(ys)
+        self.nx = len(self.x_axis)
+        self.ny = len(self.y_axis)
+
+        # iPoint of every node; -1 for nodes that are not available (e.g. rejected by the fastscan)
+        self.index = numpy.full((self.nx, self.ny), -1, dtype=int)
+        self.index[numpy.searchsorted(self.x_axis, xs), numpy.searchsorted(self.y_axis, ys)] = iPoints
+        # Measured 2*deltaNLL per node
+        self.values = numpy.full((self.nx, self.ny), numpy.nan)
+        self.queued = numpy.zeros((self.nx, self.ny), dtype=bool)
+        self.failed = numpy.zeros((self.nx, self.ny), dtype=bool)
+
+    def queue(self, mask):
+        """Marks the available, not yet queued nodes in mask as queued and returns their iPoints"""
+        mask = mask & (self.index >= 0) & ~self.queued
+        self.queued |= mask
+        return sorted(self.index[mask].tolist())
+
+    def axis_nodes(self, n, step):
+        """Node indices along an axis of n nodes at the given step, always including the last node"""
+        nodes = numpy.arange(0, n, step)
+        if nodes[-1] != n-1: nodes = numpy.append(nodes, n-1)
+        return nodes
+
+    def nearest(self, ix, iy, radius, available):
+        """Nearest node to (ix, iy) within radius for which available is True; None if there is none"""
+        x_lo, x_hi = max(0, ix-radius), min(self.nx, ix+radius+1)
+        y_lo, y_hi = max(0, iy-radius), min(self.ny, iy+radius+1)
+        jx, jy = numpy.nonzero(available[x_lo:x_hi, y_lo:y_hi])
+        if len(jx) == 0: return None
+        i = numpy.argmin((jx + x_lo - ix)**2 + (jy + y_lo - iy)**2)
+        return jx[i] + x_lo, jy[i] + y_lo
+
+    def coarse_points(self, step):
+        mask = numpy.zeros((self.nx, self.ny), dtype=bool)
+        mask[numpy.ix_(self.axis_nodes(self.nx, step), self.axis_nodes(self.ny, step))] = True
+        available = self.index >= 0
+        for ix, iy in zip(*numpy.nonzero(mask & ~available)):
+            node = self.nearest(ix, iy, max(1, step // 2), available)
+            if not(node is None): mask[node] = True
+        return self.queue(mask)
+
+    def find_node(self, x, y, tolerance=1e-3):
+        """Returns (ix, iy) of the queued node at (x, y), or None (e.g. for a best fit entry)"""
+        ix = numpy.argmin(numpy.abs(self.x_axis - x))
+        iy = numpy.argmin(numpy.abs(self.y_axis - y))
+        dx = (self.x_axis[-1] - self.x_axis[0]) / max(1, self.nx-1)
+        dy = (self.y_axis[-1] - self.y_axis[0]) / max(1, self.ny-1)
+        if abs(self.x_axis[ix] - x) > tolerance*dx or abs(self.y_axis[iy] - y) > tolerance*dy:
+            return None
+        if not self.queued[ix, iy]:
+            return None
+        return ix, iy
+
+    def set_value(self, x, y, two_dnll, tolerance=1e-3):
+        """Stores a result at the node (x, y); returns False if (x, y) is not a queued node"""
+        node = self.find_node(x, y, tolerance)
+        if node is None: return False
+        self.values[node] = two_dnll
+        return True
+
+    def set_failed(self, x, y, tolerance=1e-3):
+        """Marks the fit at the node (x, y) as failed; returns False if (x, y) is not a queued node"""
+        node = self.find_node(x, y, tolerance)
+        if node is None: return False
+        self.failed[node] = True
+        return True
+
+    def n_measured(self):
+        return int(numpy.isfinite(self.values).sum())
+
+    def get_spline(self):
+        ix, iy = numpy.nonzero(numpy.isfinite(self.values))
+        return differentials.rbfspline.RBFSpline(
+            numpy.column_stack((self.x_axis[ix], self.y_axis[iy])), self.values[ix, iy]
+            )
+
+    def corner_values(self, IX, IY, radius):
+        """
+        Measured values at the nodes (IX, IY); a node that was rejected by the
+        fastscan, or of which the fit failed, gets the value of the nearest measured
+        node within radius
+        """
+        values = self.values[IX, IY]
+        measured = numpy.isfinite(self.values)
+        for i in numpy.nonzero((self.index[IX, IY] < 0) | self.failed[IX, IY])[0]:
+            node = self.nearest(IX[i], IY[i], radius, measured)
+            if not(node is None): values[i] = self.values[node]
+        return values
+
+    def cell_scores(self, step, levels, residual_threshold):
+        """
+        Returns (ix_lo, ix_hi, iy_lo, iy_hi, score) for all cells of the subgrid
+        with the given step of which all corners are measured and that need
+        refinement; contour crossings score inf, other cells score their residual
+        """
+        x_nodes = self.axis_nodes(self.nx, step)
+        y_nodes = self.axis_nodes(self.ny, step)
+        X0, Y0 = numpy.meshgrid(x_nodes[:-1], y_nodes[:-1], indexing='ij')
+        X1, Y1 = numpy.meshgrid(x_nodes[1:], y_nodes[1:], indexing='ij')
+        X0, X1, Y0, Y1 = X0.ravel(), X1.ravel(), Y0.ravel(), Y1.ravel()
+        corners = numpy.stack([
+            self.corner_values(X0, Y0, step), self.corner_values(X1, Y0, step),
+            self.corner_values(X0, Y1, step), self.corner_values(X1, Y1, step)
+            ])
+        complete = numpy.all(numpy.isfinite(corners), axis=0)
+        X0, X1, Y0, Y1, corners = X0[complete], X1[complete], Y0[complete], Y1[complete], corners[:,complete]
+        if len(X0) == 0:
+            return X0, X1, Y0, Y1, numpy.zeros(0)
+
+        lo = corners.min(axis=0)
+        hi = corners.max(axis=0)
+        crossed = numpy.zeros(len(X0), dtype=bool)
+        for level in levels:
+            crossed |= (lo < level) & (level < hi)
+
+        centers = numpy.column_stack((
+            0.5*(self.x_axis[X0] + self.x_axis[X1]), 0.5*(self.y_axis[Y0] + self.y_axis[Y1])
+            ))
+        residuals = numpy.abs(self.get_spline().evaluate(centers) - corners.mean(axis=0))
+
+        scores = numpy.where(crossed, numpy.inf, residuals)
+        select = crossed | (residuals > residual_threshold)
+        return X0[select], X1[select], Y0[select], Y1[select], scores[select]
+
+    def refine(self, step, levels, residual_threshold, budget=None):
+        """
+        Queues the nodes of the subgrid at step/2 inside the cells of the subgrid at
+        step that need refinement, highest score first, until budget new points are
+        reached; returns their iPoints
+        """
+        half = step // 2
+        if half == 0: return []
+        X0, X1, Y0, Y1, scores = self.cell_scores(step, levels, residual_threshold)
+        logging.info(
+            '{0} cells of size {1} need refinement ({2} crossed by a contour)'
+            .format(len(X0), step, numpy.isinf(scores).sum())
+            )
+
+        x_nodes = self.axis_nodes(self.nx, half)
+        y_nodes = self.axis_nodes(self.ny, half)
+        new_points = []
+        for i in numpy.argsort(-scores, kind='mergesort'):
+            mask = numpy.zeros((self.nx, self.ny), dtype=bool)
+            mask[numpy.ix_(
+                x_nodes[(x_nodes >= X0[i]) & (x_nodes <= X1[i])],
+                y_nodes[(y_nodes >= Y0[i]) & (y_nodes <= Y1[i])]
+                )] = True
+            n_new = (mask & (self.index >= 0) & ~self.queued).sum()
+            if not(budget is None) and len(new_points) + n_new > budget:
+                logging.info('Point budget of {0} reached'.format(budget))
+                break
+            new_points.extend(self.queue(mask))
+        return sorted(new_points)
@@ -16,6 +16,9 @@ from time import strftime
 import logging
 import differentials
 import differentials.core as core
+import scheduler
+import adaptivegrid
+import jobpacker
 
 
 ########################################
@@ -45,6 +48,16 @@ class CombineConfig(object):
         self.jobPriority                 = 0
         self.suppress_output             = False
 
+        # Run batch jobs on this machine instead of submitting them (see localpool.py)
+        self.localBackend                = False
+        self.nLocalWorkers               = None # Defaults to the number of cpus
+        self.nLocalRetries               = 1
+        # A scheduler.Scheduler instance; picked automatically if None (see get_scheduler)
+        self.scheduler                   = None
+
+        # Use CombineAdaptivePointwiseScan instead of scanning all accepted fastscan points
+        self.adaptiveScan                = False
+
         self.datacard                    = 'somedatacard.root'
         self.subDirectory                = ''
 
@@ -61,6 +74,9 @@ class CombineConfig(object):
 
         self.nPoints                     = 100
         self.nPointsPerJob               = 8
+        # A jobpacker.JobPacker; if set, points are packed into jobs by estimated
+        # cpu time for self.queue instead of nPointsPerJob per job
+        self.jobPacker                   = None
 
         self.minimizer_settings = [
             '--cminDefaultMinimizerType Minuit2',
@@ -188,6 +204,7 @@ class BaseCombineScan(object):
         self.dont_define_POIs = False
 
         self.freezeNuisances = self.input.freezeNuisances[:]
+        self.jobids = []
 
     def get_task_name(self):
         return '_UNSPECIFIED_' + ( 'ASIMOV_' if self.input.asimov else '' ) + self.input.get_name()
@@ -218,11 +235,33 @@ class BaseCombineScan(object):
             cmd.append( '--setPhysicsModelParameterRanges ' + ':'.join(self.input.PhysicsModelParameterRanges) )
         if len(self.input.floatNuisances) > 0:
             cmd.append( '--floatNuisances ' + ','.join(self.input.floatNuisances) )
-        if len(self.freezeNuisances) > 0:
-            cmd.append( '--freezeNuisances ' + ','.join(self.freezeNuisances) )
+        freezeNuisances = self.get_freeze_nuisances()
+        if len(freezeNuisances) > 0:
+            cmd.append( '--freezeNuisances ' + ','.join(freezeNuisances) )
         cmd.extend(self.set_physics_model_parameters())
         return cmd
 
+    def get_freeze_nuisances(self):
+        return self.freezeNuisances
+
+    def get_POI_ranges(self):
+        """(left, right) per POI from PhysicsModelParameterRanges; None if a POI has no range"""
+        ranges = {}
+        for parstr in self.input.PhysicsModelParameterRanges:
+            name, values = parstr.split('=', 1)
+            ranges[name] = tuple(float(v) for v in values.split(','))
+        if not all(POI in ranges for POI in self.input.POIs): return None
+        return [ ranges[POI] for POI in self.input.POIs ]
+
+    def get_expected_bestfit(self):
+        """POI values as set by (hard)PhysicsModelParameters; None if a POI is not set"""
+        values = {}
+        for parstr in self.input.PhysicsModelParameters + self.input.hardPhysicsModelParameters:
+            name, value = parstr.split('=', 1)
+            values[name] = float(value)
+        if not all(POI in values for POI in self.input.POIs): return None
+        return [ values[POI] for POI in self.input.POIs ]
+
     def set_physics_model_parameters(self):
         cmd = []
         if not(self.input.asimov) and self.set_only_hard_physics_model_parameters:
@@ -241,7 +280,7 @@ class BaseCombineScan(object):
         cmd = []
 
         if self.onBatch:
-            cmd.append( 'combineTool.py' )
+            cmd.append( self.get_scheduler().executable )
         else:
             cmd.append( 'combine' )
 
@@ -283,21 +322,7 @@ class BaseCombineScan(object):
             cmd.append('--saveSpecifiedFunc ' + ','.join(self.input.saveFunctions))
 
         if self.onBatch:
-            if 't3' in os.environ['HOSTNAME']:
-                if not self.input.queue in [ 'all.q', 'long.q', 'short.q' ]:
-                    raise RuntimeError('Queue \'{0}\' is not available on PSI'.format(self.input.queue))
-                if self.input.jobPriority != 0:
-                    cmd.append(
-                        '--job-mode psi --task-name {0} --sub-opts=\'-q {1} -p {2}\' '
-                        .format( taskName, self.input.queue, self.input.jobPriority ),
-                        )
-                else:
-                    cmd.append(
-                        '--job-mode psi --task-name {0} --sub-opts=\'-q {1}\' '
-                        .format( taskName, self.input.queue ),
-                        )
-            else:
-                raise NotImplementedError( 'Only jobs submitted from T3 are implemented now' )
+            cmd.extend(self.get_scheduler().job_options(taskName, self.input))
 
         # Do POIs, ranges, etc.
         cmd.extend(self.get_parameter_settings())
@@ -305,9 +330,20 @@ class BaseCombineScan(object):
         return cmd
 
 
+    def get_scheduler(self):
+        if self.input.scheduler is None:
+            if self.input.localBackend:
+                self.input.scheduler = scheduler.LocalScheduler(self.input.nLocalWorkers, self.input.nLocalRetries)
+            elif 't3' in os.environ.get('HOSTNAME', ''):
+                self.input.scheduler = scheduler.SGEScheduler()
+            else:
+                raise NotImplementedError( 'Only jobs submitted from T3 are implemented now' )
+        return self.input.scheduler
+
     def execute_command(self, cmd):
         if self.onBatch:
-            output = core.execute(cmd, py_capture_output=True)
+            output, jobids = self.get_scheduler().submit(cmd)
+            self.jobids.extend(jobids)
             logging.info('Output of cmd {0}'.format(cmd))
             logging.info(output)
         else:
@@ -317,6 +353,18 @@ class BaseCombineScan(object):
             output = '\nOUTPUT: some output but this is testmode'
         return output
 
+    def poll(self):
+        return self.get_scheduler().poll(self.jobids)
+
+    def wait(self, poll_interval=30.):
+        return self.get_scheduler().wait(self.jobids, poll_interval)
+
+    def collect_accounting(self):
+        return self.get_scheduler().accounting(self.jobids)
+
+    def cancel(self):
+        self.get_scheduler().cancel(self.jobids)
+
     def run(self):
         cmd = self.parse_command()
         with core.enterdirectory(self.subDirectory):
@@ -330,6 +378,9 @@ class BaseCombineScan(object):
         if not self.onBatch:
             print '{0} was not on batch; not registering jobs.'.format(self)
             return
+        if not self.get_scheduler().uses_jobmanager:
+            print '{0} does not use the jobmanager; not registering jobs.'.format(self.get_scheduler())
+            return
 
         # Your job 8086766 ("job__SCAN_ASIMOV_hgg_Top_reweighted_nominal_148_0.sh") has been submitted
         jobids = re.findall(r'Your job (\d+)', submission_output)
@@ -468,30 +519,38 @@ class CombineCorrMat(BaseCombineScan):
                 'or the best fit may make no sense'
                 )
 
-        if core.is_testmode():
-            pdf_vars_to_freeze = [ 'some', 'pdfs' ]
-        else:
-            # pdf_vars_to_freeze = ListOfPDFIndicesToFreeze( postfitFilename, verbose=False )
-            pdf_vars_to_freeze = differentials.pdffreezer.PDFFreezer(self.datacard).get_vars_to_freeze()
-
+        # The pdfindex categories are set by the snapshot
         cmd.extend([
             '--algo none',
             '--snapshotName MultiDimFit',
             '--saveWorkspace',
             # '--skipInitialFit',
             '--computeCovarianceMatrix=1',
-            '--freezeNuisances {0}'.format( ','.join(pdf_vars_to_freeze) ),
             ])
 
         return cmd
 
+    def get_freeze_nuisances(self):
+        # Merged into the one --freezeNuisances option; combine does not accept it twice
+        if core.is_testmode():
+            pdf_vars_to_freeze = [ 'some', 'pdfs' ]
+        else:
+            # pdf_vars_to_freeze = ListOfPDFIndicesToFreeze( postfitFilename, verbose=False )
+            pdf_vars_to_freeze = differentials.pdffreezer.PDFFreezer(self.datacard).get_vars_to_freeze()
+        return self.freezeNuisances + pdf_vars_to_freeze
+
 #____________________________________________________________________
 class CombineScan(BaseCombineScan):
     def __init__(self, *args, **kwargs):
         super(CombineScan, self).__init__(*args, **kwargs)
+        self._point_range = None
 
     def get_task_name(self):
-        return '_SCAN_' + ( 'ASIMOV_' if self.input.asimov else '' ) + self.input.get_name()
+        name = '_SCAN_' + ( 'ASIMOV_' if self.input.asimov else '' ) + self.input.get_name()
+        if not(self._point_range is None):
+            # Same naming as combineTool.py --split-points
+            name += '.POINTS.{0}.{1}'.format(*self._point_range)
+        return name
 
     def parse_command(self):
         cmd = super(CombineScan, self).parse_command()
@@ -500,9 +559,31 @@ class CombineScan(BaseCombineScan):
             '--points={0}'.format(self.nPoints),
             ])
         if self.onBatch:
-            cmd.append('--split-points {0}'.format(self.nPointsPerJob))
+            if self._point_range is None:
+                cmd.append('--split-points {0}'.format(self.nPointsPerJob))
+            else:
+                cmd.append('--firstPoint {0} --lastPoint {1}'.format(*self._point_range))
         return cmd
 
+    def run(self):
+        if not(self.onBatch) or self.input.jobPacker is None:
+            super(CombineScan, self).run()
+            return
+        # One submission per packed range of points
+        POI_ranges = self.get_POI_ranges()
+        point_ranges = self.input.jobPacker.pack_contiguous(
+            self.nPoints, self.input.queue,
+            coordinates = None if POI_ranges is None else jobpacker.combine_grid(self.nPoints, POI_ranges),
+            bestfit = self.get_expected_bestfit()
+            )
+        submission_outputs = ''
+        with core.enterdirectory(self.subDirectory):
+            for point_range in point_ranges:
+                self._point_range = point_range
+                submission_outputs += '\n' + self.execute_command(self.parse_command())
+        self._point_range = None
+        self.register_jobids_in_jobmanager(submission_outputs)
+
 #____________________________________________________________________
 class CombineScanFromPostFit(BaseCombineScan):
     def __init__(self, *args, **kwargs):
@@ -587,22 +668,36 @@ class CombinePointwiseScan(BaseCombineScan):
     def run(self, postfitWS, fastscanFile):
         self.datacard = postfitWS
         self.fastscanFile = fastscanFile
+        accepted_points = self.list_accepted_points(self.fastscanFile)
+        submission_outputs = self.submit_points(accepted_points)
+        self.register_jobids_in_jobmanager(submission_outputs)
 
+    def submit_points(self, points, tag=''):
         # Base extraOptions
         _extraOptions = self.extraOptions
 
-        accepted_points = self.list_accepted_points(self.fastscanFile)
-
         submission_outputs = ''
         with core.enterdirectory(self.subDirectory):
-            for iChunk, chunk in enumerate(chunks(accepted_points, self.nPointsPerJob)):
+            for iChunk, chunk in enumerate(self.get_chunks(points)):
                 print '\nJob', iChunk
                 self.extraOptions = _extraOptions + [ '--doPoints ' + ','.join([ str(i) for i in chunk ]) ]
-                self.get_task_name = lambda: self.get_task_name_without_number() + '_' + str(iChunk)
+                self.get_task_name = lambda: self.get_task_name_without_number() + tag + '_' + str(iChunk)
                 cmd = self.parse_command()
                 output = self.execute_command(cmd)
                 submission_outputs += '\n' + output
-        self.register_jobids_in_jobmanager(submission_outputs)
+        self.extraOptions = _extraOptions
+        return submission_outputs
+
+    def get_chunks(self, points):
+        if self.input.jobPacker is None:
+            return chunks(points, self.nPointsPerJob)
+        coordinates = None
+        bestfit = None
+        if hasattr(self, 'accepted_points') and hasattr(self, 'bestfit'):
+            POIvals = { c.iPoint : c.POIvals for c in self.accepted_points }
+            coordinates = [ POIvals[i] for i in points ]
+            bestfit = self.bestfit.POIvals
+        return self.input.jobPacker.pack(points, self.input.queue, coordinates, bestfit)
 
 
     def list_accepted_points(self, fastscanFile):
@@ -657,9 +752,89 @@ class CombinePointwiseScan(BaseCombineScan):
                     line.append( '{0:10} = {1:+7.2f}'.format( POI, POIval ) )
                 self.print_info(' | '.join(line))
 
+        self.accepted_points = acceptedPoints
         return [ c.iPoint for c in acceptedPoints ]
 
 
+#____________________________________________________________________
+class CombineAdaptivePointwiseScan(CombinePointwiseScan):
+    """
+    Pointwise scan that first scans a coarse subgrid of the accepted fastscan points,
+    and then iteratively only adds points in cells that are crossed by a contour or
+    where the scan is not well described by a linear interpolation (see
+    adaptivegrid.py). Every pass waits for the jobs of the previous pass.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CombineAdaptivePointwiseScan, self).__init__(*args, **kwargs)
+        self.coarseStep = 8 # Should be a power of 2
+        self.contourLevels = [ 2.30, 6.18 ] # In 2*deltaNLL
+        self.residualThreshold = 0.5 # In 2*deltaNLL
+        self.pointBudget = 1000 # Max number of new points per pass
+        self.pollInterval = 60.
+
+    def run(self, postfitWS, fastscanFile):
+        if len(self.input.POIs) != 2:
+            raise NotImplementedError('Adaptive scans are only implemented for 2 POIs')
+        self.datacard = postfitWS
+        self.fastscanFile = fastscanFile
+        self.list_accepted_points(self.fastscanFile)
+
+        self.grid = adaptivegrid.AdaptiveGrid(
+            [ c.iPoint for c in self.accepted_points ],
+            [ c.POIvals[0] for c in self.accepted_points ],
+            [ c.POIvals[1] for c in self.accepted_points ],
+            )
+
+        step = self.coarseStep
+        points = self.grid.coarse_points(step)
+        i_pass = 0
+        while len(points) > 0:
+            tag = '_pass{0}'.format(i_pass)
+            self.print_info('Pass {0}: submitting {1} points at step {2}'.format(i_pass, len(points), step))
+            submission_outputs = self.submit_points(points, tag)
+            self.register_jobids_in_jobmanager(submission_outputs)
+            if core.is_testmode() or step == 1: break
+            states = self.wait(self.pollInterval)
+            n_error = states.values().count('error')
+            if n_error == len(states):
+                # E.g. the scheduler could not be polled; the outputs cannot be trusted yet
+                raise RuntimeError(
+                    'Pass {0}: all {1} jobs are in error; not continuing the adaptive scan'
+                    .format(i_pass, len(states))
+                    )
+            elif n_error > 0:
+                logging.warning('Pass {0}: {1} of {2} jobs are in error'.format(i_pass, n_error, len(states)))
+            self.read_pass(tag)
+            points = self.grid.refine(step, self.contourLevels, self.residualThreshold, self.pointBudget)
+            step //= 2
+            i_pass += 1
+        self.print_info('Submitted {0} of {1} accepted points'.format(self.grid.queued.sum(), len(self.accepted_points)))
+
+    def read_pass(self, tag):
+        output_files = glob(join(
+            self.subDirectory, 'higgsCombine{0}{1}_*.root'.format(self.get_task_name_without_number(), tag)
+            ))
+        n_read = 0
+        n_failed = 0
+        for output_file in output_files:
+            with core.openroot(output_file) as output_fp:
+                if not output_fp.GetListOfKeys().Contains('limit'):
+                    logging.warning('No tree \'limit\' in {0}; skipping'.format(output_file))
+                    continue
+                for event in output_fp.Get('limit'):
+                    x, y = [ getattr(event, POI) for POI in self.input.POIs ]
+                    if event.deltaNLL == 9990. or event.deltaNLL > 1e9:
+                        # Failed fit; do not put it in the grid as a (huge) value
+                        if self.grid.set_failed(x, y): n_failed += 1
+                    elif self.grid.set_value(x, y, 2.*event.deltaNLL):
+                        n_read += 1
+        self.print_info(
+            'Read {0} points ({1} failed fits) from {2} files of pass {3}'
+            .format(n_read, n_failed, len(output_files), tag)
+            )
+
+
 #____________________________________________________________________
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
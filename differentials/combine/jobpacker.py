@@ -0,0 +1,166 @@
+"""
+Packs scan points into batch jobs by estimated cpu time, rather than a fixed
+number of points per job. Every job is filled up to a fraction of the wall time
+limit of the queue it goes to.
+
+The cpu time per point comes from a cost model:
+- AccountantCostModel: per point cpu times of a previous scan of the same grid,
+  as measured by scan_accounting.ScanAccountant
+- DistanceCostModel: a base cost that grows linearly with the (range-normalized)
+  distance to the best fit, since fits far from the minimum take longer
+"""
+
+import math
+import logging
+import numpy
+
+import differentials.scan_accounting
+
+
+class DistanceCostModel(object):
+    """
+    cpu hours per point = base_hours * (1 + slope * d), with d the distance to the
+    best fit in units of the scanned range of every POI
+    """
+
+    def __init__(self, base_hours=0.05, slope=1.0):
+        super(DistanceCostModel, self).__init__()
+        self.base_hours = base_hours
+        self.slope = slope
+
+    def costs(self, points, coordinates=None, bestfit=None):
+        costs = numpy.full(len(points), self.base_hours)
+        if coordinates is None or bestfit is None or len(points) == 0:
+            return costs
+        coordinates = numpy.asarray(coordinates, dtype=numpy.float64).reshape((len(points), -1))
+        widths = numpy.ptp(coordinates, axis=0)
+        widths[widths == 0.] = 1.
+        distances = numpy.sqrt(numpy.sum(((coordinates - numpy.asarray(bestfit)) / widths)**2, axis=1))
+        return costs * (1. + self.slope * distances)
+
+
+class AccountantCostModel(object):
+    """
+    Uses the measured cpu time per point of a previous scan; every point of a job
+    gets the job's cpu time divided by its number of points. Points that were not
+    in the previous scan get the mean cpu time per point.
+    """
+
+    def __init__(self, scandir):
+        super(AccountantCostModel, self).__init__()
+        self.accountant = differentials.scan_accounting.ScanAccountant(scandir)
+        if self.accountant.process() is False:
+            raise RuntimeError('Could not get accounting for {0}'.format(scandir))
+        jobs = [ j for j in self.accountant.jobs if not j.is_failed() ]
+        self.point_hours = {}
+        for job in jobs:
+            cpu_per_point = job.cpu_per_point()
+            for point in job.points:
+                self.point_hours[point] = cpu_per_point
+        self.mean_hours = self.accountant.mean_cpu_per_point
+
+    def costs(self, points, coordinates=None, bestfit=None):
+        return numpy.array([ self.point_hours.get(point, self.mean_hours) for point in points ])
+
+
+class JobPacker(object):
+    """docstring for JobPacker"""
+
+    queue_hours = {
+        'short.q' : 1.5,
+        'all.q'   : 10.,
+        'long.q'  : 96.,
+        }
+    # Fill jobs only up to this fraction of the queue limit, as costs are estimates
+    fill_fraction = 0.8
+
+    def __init__(self, cost_model, max_points_per_job=None):
+        super(JobPacker, self).__init__()
+        self.cost_model = cost_model
+        self.max_points_per_job = max_points_per_job
+
+    def budget(self, queue):
+        if not queue in self.queue_hours:
+            raise ValueError('No wall time known for queue \'{0}\''.format(queue))
+        return self.fill_fraction * self.queue_hours[queue]
+
+    def log_packing(self, jobs, costs, queue):
+        loads = [ sum(costs[i] for i in job) for job in jobs ]
+        logging.info(
+            'Packed {0} points into {1} jobs for {2} (budget {3:.2f}h); est. cpu/job {4:.2f}h to {5:.2f}h'
+            .format(len(costs), len(jobs), queue, self.budget(queue), min(loads), max(loads))
+            )
+
+    def pack(self, points, queue, coordinates=None, bestfit=None):
+        """
+        First-fit-decreasing bin packing of points into jobs of at most budget(queue)
+        estimated cpu hours; returns a list of sorted lists of points
+        """
+        if len(points) == 0: return []
+        budget = self.budget(queue)
+        costs = self.cost_model.costs(points, coordinates, bestfit)
+        loads = numpy.zeros(0)
+        n_points = numpy.zeros(0, dtype=int)
+        jobs = []
+        for i in numpy.argsort(-costs, kind='mergesort'):
+            fits = loads + costs[i] <= budget
+            if not(self.max_points_per_job is None): fits &= n_points < self.max_points_per_job
+            if numpy.any(fits):
+                i_job = numpy.argmax(fits)
+            else:
+                if costs[i] > budget:
+                    logging.warning(
+                        'Point {0} is estimated at {1:.2f}h, more than the {2:.2f}h budget for {3}'
+                        .format(points[i], costs[i], budget, queue)
+                        )
+                i_job = len(jobs)
+                jobs.append([])
+                loads = numpy.append(loads, 0.)
+                n_points = numpy.append(n_points, 0)
+            jobs[i_job].append(i)
+            loads[i_job] += costs[i]
+            n_points[i_job] += 1
+        self.log_packing(jobs, costs, queue)
+        jobs = [ sorted(points[i] for i in job) for job in jobs ]
+        jobs.sort(key=lambda job: job[0])
+        return jobs
+
+    def pack_contiguous(self, n_points, queue, coordinates=None, bestfit=None):
+        """
+        Splits the points 0..n_points-1 into consecutive ranges of at most budget(queue)
+        estimated cpu hours, for --firstPoint/--lastPoint jobs; returns (first, last) pairs
+        """
+        budget = self.budget(queue)
+        costs = self.cost_model.costs(range(n_points), coordinates, bestfit)
+        ranges = []
+        first = 0
+        load = 0.
+        for i in xrange(n_points):
+            too_many = not(self.max_points_per_job is None) and i - first >= self.max_points_per_job
+            if i > first and (load + costs[i] > budget or too_many):
+                ranges.append((first, i-1))
+                first = i
+                load = 0.
+            load += costs[i]
+        if n_points > 0: ranges.append((first, n_points-1))
+        self.log_packing([ range(first, last+1) for first, last in ranges ], costs, queue)
+        return ranges
+
+
+def combine_grid(n_points, POI_ranges):
+    """
+    Approximate coordinates of the points of combine's --algo=grid, for 1 or 2 POIs
+    (bin centers, in the order combine scans them); returns None for other cases
+    """
+    if len(POI_ranges) == 1:
+        (x_min, x_max), = POI_ranges
+        return x_min + (numpy.arange(n_points) + 0.5) * (x_max - x_min) / n_points
+    elif len(POI_ranges) == 2:
+        (x_min, x_max), (y_min, y_max) = POI_ranges
+        n_per_dim = int(math.floor(math.sqrt(n_points)))
+        i_points = numpy.arange(n_points)
+        return numpy.column_stack((
+            x_min + (i_points // n_per_dim + 0.5) * (x_max - x_min) / n_per_dim,
+            y_min + (i_points % n_per_dim + 0.5) * (y_max - y_min) / n_per_dim,
+            ))
+    return None
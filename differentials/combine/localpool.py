@@ -0,0 +1,242 @@
+"""
+Local execution backend for BaseCombineScan: runs the jobs of a scan on this
+machine in a bounded pool instead of submitting them to a batch system.
+
+The layout mimics what combineTool.py + SGE leave behind, so that the usual
+tools (ScanAccountant, the scan readers) work on local scans as well: every job
+gets a job_<name>.sh file with an 'eval combine ...' line, and its output goes to
+job_<name>.sh.o<jobid>, ending in a qacct-like cpu/wall/exit status line.
+"""
+
+import os, re, time, socket, signal, subprocess, itertools, threading
+import logging
+from time import strftime
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import differentials.core as core
+
+
+def seconds_to_hms(n_seconds):
+    n_seconds = int(round(n_seconds))
+    return '{0:02d}:{1:02d}:{2:02d}'.format(n_seconds // 3600, (n_seconds % 3600) // 60, n_seconds % 60)
+
+
+def expand_split_points(cmd):
+    """
+    Turns a (combineTool.py-style) command into a list of (name, combine command)
+    pairs, one per job. A '--split-points N' option is expanded into jobs with
+    '--firstPoint/--lastPoint' and a '.POINTS.<first>.<last>' suffix on the name,
+    the same way combineTool.py does it; without it, a single job is returned.
+    """
+    if not isinstance(cmd, basestring):
+        cmd = ' '.join([ l for l in cmd if not len(l.strip()) == 0 ])
+    cmd = re.sub(r'^\s*combineTool\.py\b', 'combine', cmd)
+    cmd = re.sub(r'--points=(\d+)', r'--points \1', cmd)
+
+    name = re.search(r'(?:^|\s)-n (\S+)', cmd).group(1)
+
+    match_split = re.search(r'\s*--split-points[= ](\d+)', cmd)
+    if not match_split:
+        return [ (name, cmd) ]
+    n_per_job = int(match_split.group(1))
+    cmd = cmd.replace(match_split.group(0), '')
+
+    n_points = int(re.search(r'--points (\d+)', cmd).group(1))
+    jobs = []
+    for first in xrange(0, n_points, n_per_job):
+        last = min(first + n_per_job, n_points) - 1
+        job_name = '{0}.POINTS.{1}.{2}'.format(name, first, last)
+        job_cmd = (
+            re.sub(r'(^|\s)-n \S+', r'\1-n ' + job_name, cmd, count=1)
+            + ' --firstPoint {0} --lastPoint {1}'.format(first, last)
+            )
+        jobs.append((job_name, job_cmd))
+    return jobs
+
+
+class LocalJob(object):
+    """docstring for LocalJob"""
+
+    def __init__(self, name, cmd):
+        super(LocalJob, self).__init__()
+        self.name = name
+        self.cmd = cmd
+        self.sh_file = os.path.abspath('job_{0}.sh'.format(name))
+        self.o_files = []
+        self.jobid = None
+        self.exit_code = None
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.attempts = 0
+        self.state = 'queued' # queued, running, finished, cancelled or skipped (testmode)
+        self.proc = None
+        self.accounting = [] # One qacct-like record per attempt
+        # Guards state and proc: cancel() is called from other threads than run_once()
+        self._lock = threading.Lock()
+
+    def write_sh_file(self):
+        with open(self.sh_file, 'w') as sh_fp:
+            sh_fp.write('#!/bin/sh\nulimit -s unlimited\ncd {0}\n\neval {1}\n'.format(os.getcwd(), self.cmd))
+        os.chmod(self.sh_file, 0o755)
+
+    def run_once(self, jobid):
+        """Runs the job once, writing its output to <sh_file>.o<jobid>"""
+        if self.state == 'cancelled': return self.exit_code
+        self.attempts += 1
+        self.jobid = jobid
+        o_file = '{0}.o{1}'.format(self.sh_file, jobid)
+        self.o_files.append(o_file)
+
+        with open(o_file, 'w') as o_fp:
+            o_fp.write('# Local job {0}, attempt {1}, started {2}\n'.format(jobid, self.attempts, strftime('%y-%m-%d %H:%M:%S')))
+            o_fp.flush()
+            t_start = time.time()
+            with self._lock:
+                self.proc = subprocess.Popen(['/bin/sh', self.sh_file], stdout=o_fp, stderr=subprocess.STDOUT)
+                if self.state == 'cancelled':
+                    # Cancelled after the check above; cancel() did not see a process to kill
+                    os.kill(self.proc.pid, signal.SIGTERM)
+                else:
+                    self.state = 'running'
+            # wait4 instead of proc.wait() to get the resource usage of this job only
+            _, status, rusage = os.wait4(self.proc.pid, 0)
+            t_end = time.time()
+            self.wall_time = t_end - t_start
+            self.cpu_time = rusage.ru_utime + rusage.ru_stime
+            self.exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            self.proc.returncode = self.exit_code
+
+            hostname = socket.gethostname()
+            o_fp.write(
+                '\n# queue@host = local.q@{0}\n# exit_status={1}, cpu={2}, wall={3},\n'
+                .format(hostname, self.exit_code, seconds_to_hms(self.cpu_time), seconds_to_hms(self.wall_time))
+                )
+
+        self.accounting.append({
+            'qname'        : 'local.q',
+            'hostname'     : hostname,
+            'jobname'      : os.path.basename(self.sh_file),
+            'jobnumber'    : jobid,
+            'start_time'   : time.ctime(t_start),
+            'end_time'     : time.ctime(t_end),
+            # Like SGE: 'failed' is set when the job was killed, exit_status is the job's own
+            'failed'       : 100 if self.exit_code < 0 else 0,
+            'exit_status'  : self.exit_code if self.exit_code >= 0 else 128 - self.exit_code,
+            'ru_wallclock' : self.wall_time,
+            'cpu'          : self.cpu_time,
+            })
+        return self.exit_code
+
+    def finish(self):
+        """Marks the job finished once no more attempts follow, unless it was cancelled"""
+        with self._lock:
+            if self.state != 'cancelled': self.state = 'finished'
+
+    def cancel(self):
+        with self._lock:
+            if self.state in [ 'finished', 'cancelled' ]: return
+            was_running = self.state == 'running'
+            self.state = 'cancelled'
+            if was_running:
+                try:
+                    os.kill(self.proc.pid, signal.SIGTERM)
+                except OSError:
+                    pass # Finished in the meantime
+
+    def is_failed(self):
+        if self.state == 'skipped': return False
+        return self.exit_code != 0
+
+    def __repr__(self):
+        if self.state == 'skipped':
+            return 'Job {0} ({1}): skipped (testmode)'.format(self.jobid, os.path.basename(self.sh_file))
+        return (
+            'Job {0} ({1}): exit code {2} after {3} attempt(s); wall {4:.1f}s, cpu {5:.1f}s'
+            .format(self.jobid, os.path.basename(self.sh_file), self.exit_code, self.attempts, self.wall_time, self.cpu_time)
+            )
+
+
+class LocalPool(object):
+    """
+    Runs LocalJobs in the current directory with at most n_workers at the same
+    time; failed jobs are rerun up to n_retries times.
+    """
+
+    def __init__(self, n_workers=None, n_retries=1):
+        super(LocalPool, self).__init__()
+        self.n_workers = cpu_count() if n_workers is None else n_workers
+        self.n_retries = n_retries
+        self._jobids = itertools.count(int(time.time()))
+        self.pool = None
+
+    def new_jobid(self):
+        return next(self._jobids)
+
+    def run_job(self, job):
+        while True:
+            # The first attempt keeps the jobid assigned at submission, if any
+            jobid = job.jobid if job.attempts == 0 and not(job.jobid is None) else self.new_jobid()
+            exit_code = job.run_once(jobid)
+            if exit_code == 0 or job.attempts > self.n_retries or job.state == 'cancelled': break
+            logging.warning(
+                'Job {0} failed with exit code {1}; retrying ({2}/{3})'
+                .format(job.name, exit_code, job.attempts, self.n_retries)
+                )
+        # Only now, so that a job being retried does not look finished in between
+        job.finish()
+        if job.state == 'cancelled':
+            logging.info('{0}; cancelled'.format(job))
+        elif job.is_failed():
+            logging.error('{0}; giving up'.format(job))
+        else:
+            logging.info('{0}'.format(job))
+        return job
+
+    def run(self, jobs):
+        for job in jobs:
+            job.write_sh_file()
+            if job.jobid is None: job.jobid = self.new_jobid()
+        if core.is_testmode():
+            for job in jobs:
+                logging.info('[TESTMODE] Not running {0}:\n{1}'.format(job.sh_file, job.cmd))
+                job.state = 'skipped'
+            return jobs
+
+        logging.info('Running {0} jobs locally with {1} workers'.format(len(jobs), self.n_workers))
+        pool = ThreadPool(max(1, min(self.n_workers, len(jobs))))
+        try:
+            pool.map(self.run_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        return jobs
+
+    def start(self, jobs):
+        """Queues jobs in a persistent pool and returns without waiting for them"""
+        for job in jobs:
+            job.write_sh_file()
+            if job.jobid is None: job.jobid = self.new_jobid()
+        if self.pool is None:
+            self.pool = ThreadPool(max(1, self.n_workers))
+        return [ self.pool.apply_async(self.run_job, (job,)) for job in jobs ]
+
+    def close(self):
+        if self.pool is None: return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+
+def summarize(jobs):
+    n_failed = len([ job for job in jobs if job.is_failed() ])
+    n_skipped = len([ job for job in jobs if job.state == 'skipped' ])
+    lines = [ repr(job) for job in jobs ]
+    lines.append(
+        '{0} jobs, {1} failed, {2} skipped; total wall {3}, total cpu {4}'
+        .format(
+            len(jobs), n_failed, n_skipped,
+            seconds_to_hms(sum(job.wall_time for job in jobs)), seconds_to_hms(sum(job.cpu_time for job in jobs))
+            )
+        )
+    return '\n'.join(lines)
@@ -0,0 +1,189 @@
+"""
+Batch schedulers for BaseCombineScan. A scheduler decides which executable and
+job options go into the combine command, and knows how to submit, poll, collect
+accounting for and cancel the resulting jobs:
+
+- SGEScheduler: combineTool.py --job-mode psi submission to the PSI T3 queues
+- LocalScheduler: runs the jobs as subprocesses on this machine (see localpool.py),
+  and produces qacct-like accounting for them, so that submission, monitoring and
+  rescan logic can be run and benchmarked without a cluster
+"""
+
+import os, re, time, getpass
+import logging
+from subprocess import CalledProcessError
+
+import differentials.core as core
+from differentials.scan_accounting import parse_qacct, qacct_cache
+import localpool
+
+
+def format_qacct(records):
+    """Formats a list of accounting dicts the way qacct prints them"""
+    lines = []
+    for record in records:
+        lines.append('='*62)
+        for key in sorted(record.keys()):
+            lines.append('{0:<13}{1}'.format(key, record[key]))
+    return '\n'.join(lines)
+
+
+class Scheduler(object):
+    """
+    Base class for schedulers; jobs are identified by integer jobids.
+    Poll states are 'queued', 'running', 'finished', 'error', 'cancelled' or
+    'skipped' (not run in testmode).
+    """
+
+    executable = 'combine'
+    uses_jobmanager = False
+
+    def __deepcopy__(self, memo):
+        # Schedulers keep track of running jobs, so configs share rather than copy them
+        return self
+
+    def job_options(self, task_name, config):
+        return []
+
+    def submit(self, cmd):
+        """Submits cmd; returns (printable submission output, list of jobids)"""
+        raise NotImplementedError
+
+    def poll(self, jobids):
+        """Returns a { jobid : state } dict"""
+        raise NotImplementedError
+
+    def accounting(self, jobids):
+        """Returns a { jobid : qacct-like dict } dict for all finished jobids"""
+        raise NotImplementedError
+
+    def cancel(self, jobids):
+        raise NotImplementedError
+
+    def wait(self, jobids, poll_interval=30.):
+        """Blocks until none of the jobids is queued or running anymore"""
+        while True:
+            states = self.poll(jobids)
+            n_active = len([ s for s in states.itervalues() if s in [ 'queued', 'running' ] ])
+            if n_active == 0: return states
+            logging.info('{0} of {1} jobs still queued or running'.format(n_active, len(jobids)))
+            time.sleep(poll_interval)
+
+
+class SGEScheduler(Scheduler):
+    """Submission via combineTool.py --job-mode psi, monitoring via qstat/qacct"""
+
+    executable = 'combineTool.py'
+    uses_jobmanager = True
+    queues = [ 'all.q', 'long.q', 'short.q' ]
+
+    def job_options(self, task_name, config):
+        if not config.queue in self.queues:
+            raise RuntimeError('Queue \'{0}\' is not available on PSI'.format(config.queue))
+        if config.jobPriority != 0:
+            return [
+                '--job-mode psi --task-name {0} --sub-opts=\'-q {1} -p {2}\' '
+                .format( task_name, config.queue, config.jobPriority ),
+                ]
+        else:
+            return [
+                '--job-mode psi --task-name {0} --sub-opts=\'-q {1}\' '
+                .format( task_name, config.queue ),
+                ]
+
+    def submit(self, cmd):
+        output = core.execute(cmd, py_capture_output=True)
+        if output is None: output = '' # testmode
+        # Your job 8086766 ("job__SCAN_ASIMOV_hgg_Top_reweighted_nominal_148_0.sh") has been submitted
+        jobids = [ int(i) for i in re.findall(r'Your job (\d+)', output) ]
+        return output, jobids
+
+    def poll(self, jobids):
+        cmd = 'qstat -u {0}'.format(getpass.getuser())
+        try:
+            output = core.execute(cmd, py_capture_output=True)
+        except CalledProcessError:
+            logging.error('Could not call {0}; reporting all jobs as error'.format(cmd))
+            return { jobid : 'error' for jobid in jobids }
+        if output is None: # testmode
+            return { jobid : 'skipped' for jobid in jobids }
+        qstat_states = {}
+        for line in output.split('\n'):
+            components = line.split()
+            if len(components) < 5 or not components[0].isdigit(): continue
+            qstat_states[int(components[0])] = components[4]
+        states = {}
+        for jobid in jobids:
+            if not jobid in qstat_states:
+                states[jobid] = 'finished'
+            elif 'E' in qstat_states[jobid]:
+                states[jobid] = 'error'
+            elif 'r' in qstat_states[jobid] or 't' in qstat_states[jobid]:
+                states[jobid] = 'running'
+            else:
+                states[jobid] = 'queued'
+        return states
+
+    def accounting(self, jobids, days=7):
+        qacct_cache.prefetch(jobids, days)
+        records = {}
+        for jobid in jobids:
+            record = qacct_cache.get(jobid)
+            if not(record is None): records[jobid] = record
+        return records
+
+    def cancel(self, jobids):
+        if len(jobids) == 0: return
+        core.execute('qdel ' + ' '.join([ str(i) for i in jobids ]))
+
+
+class LocalScheduler(Scheduler):
+    """
+    Runs jobs as subprocesses on this machine, at most n_workers at a time.
+    With blocking=True, submit only returns when all jobs are done.
+    """
+
+    def __init__(self, n_workers=None, n_retries=1, blocking=True):
+        super(LocalScheduler, self).__init__()
+        self.pool = localpool.LocalPool(n_workers, n_retries)
+        self.blocking = blocking
+        self.jobs = []
+
+    def submit(self, cmd):
+        jobs = [ localpool.LocalJob(name, job_cmd) for name, job_cmd in localpool.expand_split_points(cmd) ]
+        self.jobs.extend(jobs)
+        if self.blocking or core.is_testmode():
+            self.pool.run(jobs)
+        else:
+            self.pool.start(jobs)
+        return localpool.summarize(jobs), [ job.jobid for job in jobs ]
+
+    def get_job(self, jobid):
+        for job in self.jobs:
+            if job.jobid == jobid or jobid in [ record['jobnumber'] for record in job.accounting ]:
+                return job
+        raise KeyError('No local job with jobid {0}'.format(jobid))
+
+    def poll(self, jobids):
+        states = {}
+        for jobid in jobids:
+            job = self.get_job(jobid)
+            # Like qstat's E state: the job ran, but with a non-zero exit code
+            states[jobid] = 'error' if job.state == 'finished' and job.is_failed() else job.state
+        return states
+
+    def accounting(self, jobids):
+        records = {}
+        for jobid in jobids:
+            for record in self.get_job(jobid).accounting:
+                records[record['jobnumber']] = record
+        return records
+
+    def qacct(self, jobids):
+        """Same information as accounting, formatted like qacct output"""
+        records = self.accounting(jobids)
+        return format_qacct([ records[jobid] for jobid in sorted(records) ])
+
+    def cancel(self, jobids):
+        for jobid in jobids:
+            self.get_job(jobid).cancel()
@@ -3,6 +3,8 @@ from os.path import *
 from datetime import datetime
 import traceback
 import subprocess
+import hashlib
+from array import array
 
 import logging
 import logger
@@ -10,6 +12,7 @@ logger.set_basic_format()
 
 import differentials
 import ROOT
+import wsregistry
 
 from time import strftime
 GLOBAL_DATESTR = strftime( '%b%d' )
@@ -246,6 +249,19 @@ def __uniqueid__():
         # return a new id
         yield newid
 
+_file_md5s = {}
+def file_md5(path, block_size=2**20):
+    """md5 of the file contents; remembered per process for as long as size and mtime do not change"""
+    stat = os.stat(path)
+    key = (abspath(path), stat.st_size, stat.st_mtime)
+    if not key in _file_md5s:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(block_size), ''):
+                md5.update(block)
+        _file_md5s[key] = md5.hexdigest()
+    return _file_md5s[key]
+
 class openroot():
     """Context manager to safely open and close root files"""
     def __init__(self, root_file):
@@ -261,13 +277,82 @@ class openroot():
         self._root_fp.Close()
 
 
+_declared_tree_from_arrays = None
+def declare_tree_from_arrays():
+    """Declares a C++ function that fills a memory-resident TTree from arrays; returns False on failure"""
+    global _declared_tree_from_arrays
+    if _declared_tree_from_arrays is None:
+        try:
+            _declared_tree_from_arrays = bool(ROOT.gInterpreter.Declare(
+                'TTree* differentials_tree_from_arrays(const char* name, int n, int nvars,'
+                '    const char** names, const double* values){'
+                '    TDirectory::TContext context(nullptr);'
+                '    TTree* tree = new TTree(name, name);'
+                '    tree->SetDirectory(0);'
+                '    std::vector<float> buffer(nvars);'
+                '    for (int j = 0; j < nvars; j++) tree->Branch(names[j], &buffer[j], (std::string(names[j]) + "/F").c_str());'
+                '    for (int i = 0; i < n; i++){'
+                '        for (int j = 0; j < nvars; j++) buffer[j] = values[j*n + i];'
+                '        tree->Fill();'
+                '        }'
+                '    tree->ResetBranchAddresses();'
+                '    return tree;'
+                '    }'
+                ))
+        except Exception as e:
+            logging.warning('Could not declare tree filling function ({0}); falling back to python loop'.format(e))
+            _declared_tree_from_arrays = False
+    return _declared_tree_from_arrays
+
+class memory_tree():
+    """
+    Context manager that provides a memory-resident TTree (no file on disk) with
+    float branches filled from the passed columns (name -> sequence of values).
+    The tree is owned by python and deleted on exit once no other python reference
+    to it is left; anything built from it (e.g. a RooSplineND, which copies the
+    points) must not rely on it afterwards.
+    """
+    def __init__(self, columns, name='limit'):
+        self._names = columns.keys()
+        self._columns = [ [ float(v) for v in columns[name] ] for name in self._names ]
+        self._name = name
+
+    def __enter__(self):
+        n = len(self._columns[0]) if len(self._columns) > 0 else 0
+        if declare_tree_from_arrays():
+            names = ROOT.std.vector('const char*')()
+            for name in self._names: names.push_back(name)
+            values = array('d', [ v for column in self._columns for v in column ])
+            self._tree = ROOT.differentials_tree_from_arrays(self._name, n, len(self._names), names.data(), values)
+        else:
+            previous_dir = ROOT.gDirectory
+            ROOT.gROOT.cd()
+            self._tree = ROOT.TTree(self._name, self._name)
+            self._tree.SetDirectory(0)
+            previous_dir.cd()
+            buffers = [ array('f', [0.]) for name in self._names ]
+            for name, buf in zip(self._names, buffers):
+                self._tree.Branch(name, buf, name + '/F')
+            for i in xrange(n):
+                for buf, column in zip(buffers, self._columns):
+                    buf[0] = column[i]
+                self._tree.Fill()
+            self._tree.ResetBranchAddresses()
+        ROOT.SetOwnership(self._tree, True)
+        return self._tree
+
+    def __exit__(self, *args):
+        # Python owns the tree, so dropping the last reference deletes it
+        del self._tree
+
+
 def list_POIs(root_file, only_r_=True):
-    with openroot(root_file) as root_fp:
-        POI_list = ROOT.RooArgList(root_fp.Get('w').set('POI'))
+    POI_names = wsregistry.get_registry().read_set_names(root_file, 'POI')
+    if POI_names is None:
+        raise ValueError('Workspace in {0} has no set POI'.format(root_file))
 
     par_names = []
-    for i in xrange(POI_list.getSize()):
-        par_name = POI_list[i].GetName()
+    for par_name in POI_names:
         if only_r_:
             if par_name.startswith('r_'):
                 par_names.append(par_name)
@@ -279,13 +364,22 @@ def list_POIs(root_file, only_r_=True):
 
 
 def get_ws(root_file, wsname = 'w'):
-    with openroot(root_file) as root_fp:
-        w = root_fp.Get(wsname)
-    if w == None:
-        raise ValueError('Workspace \'{0}\' does not exist in {1}'.format(wsname, root_file))
-    return w
+    """
+    Returns the workspace; every file is only opened once per process (see wsregistry).
+    WARNING: all callers get the same RooWorkspace object, so setVal, setConstant or
+    loadSnapshot affect every other holder of the same file. Restore the values
+    afterwards, e.g. with wsregistry.preserved_values(w).
+    """
+    return wsregistry.get_registry().get(root_file, wsname)
 
 def read_set(root_file, setname, return_names=True):
+    if return_names and not isinstance(root_file, ROOT.RooWorkspace):
+        names = wsregistry.get_registry().read_set_names(root_file, setname)
+        if names is None:
+            logging.info('Set {0} does not exist in {1}'.format(setname, root_file))
+            return []
+        logging.debug('Found the following object names in set {0}: {1}'.format(setname, names))
+        return names
     if isinstance(root_file, ROOT.RooWorkspace):
         w = root_file
     else:
@@ -310,6 +404,11 @@ def read_set(root_file, setname, return_names=True):
         return objs
 
 def set_exists(root_file, setname):
+    if not isinstance(root_file, ROOT.RooWorkspace):
+        if wsregistry.get_registry().read_set_names(root_file, setname) is None:
+            logging.info('Set {0} does not exist in {1}'.format(setname, root_file))
+            return False
+        return True
     if isinstance(root_file, ROOT.RooWorkspace):
         w = root_file
     else:
@@ -16,18 +16,28 @@ class Rebinner(object):
         self.bin_boundaries_old = bin_boundaries_old
         self.values_old = values_old
         self.bin_boundaries_new = bin_boundaries_new
+        self._rebin_matrix = None
+
+    def get_rebin_matrix(self):
+        """Returns the RebinMatrix for the current binnings, rebuilding it only if they changed"""
+        if (
+            self._rebin_matrix is None
+            or list(self._rebin_matrix.bin_boundaries_old) != list(self.bin_boundaries_old)
+            or list(self._rebin_matrix.bin_boundaries_new) != list(self.bin_boundaries_new)
+            ):
+            self._rebin_matrix = RebinMatrix(self.bin_boundaries_old, self.bin_boundaries_new)
+        return self._rebin_matrix
 
     def rebin(self):
         self.n_bins_old = len(self.bin_boundaries_old)-1
         self.n_bins_new = len(self.bin_boundaries_new)-1
-        self.integral = Integrator(self.bin_boundaries_old, self.values_old)
-        self.values_new = []
-        lefts = self.bin_boundaries_new[:-1]
-        rights = self.bin_boundaries_new[1:]
-        for a, b in zip(lefts, rights):
-            self.values_new.append(
-                self.integral.integral(a, b) / (b-a)
+        if len(self.values_old) != self.n_bins_old:
+            raise ValueError(
+                'Length of given input lists do not match'
+                '\nTried to rebin {0} bin boundaries and {1} values'
+                .format(len(self.bin_boundaries_old), len(self.values_old))
                 )
+        self.values_new = self.get_rebin_matrix().rebin(self.values_old).tolist()
         return self.values_new
 
     def rebin_values(self, values_old):
@@ -35,6 +45,57 @@ class Rebinner(object):
         return self.rebin()
 
 
+class RebinMatrix(object):
+    """
+    Rebinning as a (n_bins_new, n_bins_old) matrix, with the same semantics as
+    Rebinner/Integrator: the new value is the integral of the old (per unit x)
+    values over the new bin divided by the new bin width, where the old values
+    are zero outside the old range. Element (i, j) is the overlap of new bin i
+    with old bin j divided by the width of new bin i.
+    """
+
+    def __init__(self, bin_boundaries_old, bin_boundaries_new):
+        super(RebinMatrix, self).__init__()
+        self.bin_boundaries_old = numpy.asarray(bin_boundaries_old, dtype=numpy.float64)
+        self.bin_boundaries_new = numpy.asarray(bin_boundaries_new, dtype=numpy.float64)
+        self.n_bins_old = len(self.bin_boundaries_old)-1
+        self.n_bins_new = len(self.bin_boundaries_new)-1
+
+        # Like Integrator.integral, a bin with right < left integrates from right to left
+        lefts = numpy.minimum(self.bin_boundaries_new[:-1], self.bin_boundaries_new[1:])
+        rights = numpy.maximum(self.bin_boundaries_new[:-1], self.bin_boundaries_new[1:])
+        widths = rights - lefts
+        if numpy.any(widths == 0.):
+            raise ValueError(
+                'New binning {0} contains a bin of zero width'.format(list(bin_boundaries_new))
+                )
+
+        overlaps = (
+            numpy.minimum(rights[:,None], self.bin_boundaries_old[None,1:])
+            - numpy.maximum(lefts[:,None], self.bin_boundaries_old[None,:-1])
+            )
+        numpy.maximum(overlaps, 0., out=overlaps)
+        with numpy.errstate(invalid='ignore'):
+            # An open (infinite) new bin gets zero, as in Rebinner
+            self.matrix = overlaps / widths[:,None]
+
+    def rebin(self, values_old):
+        """
+        Rebins (n_bins_old,) values to (n_bins_new,), or (n, n_bins_old) values
+        (e.g. one spectrum per row) to (n, n_bins_new)
+        """
+        values_old = numpy.asarray(values_old, dtype=numpy.float64)
+        if values_old.shape[-1] != self.n_bins_old:
+            raise ValueError(
+                'Expected {0} values per spectrum, got shape {1}'.format(self.n_bins_old, values_old.shape)
+                )
+        return values_old.dot(self.matrix.T)
+
+    def rebin_values(self, values_old):
+        """Same as Rebinner.rebin_values: a list in, a list out"""
+        return self.rebin(values_old).tolist()
+
+
 class Integrator(object):
 
     def __init__(self, bin_boundaries, values):
@@ -1,5 +1,6 @@
 import differentials
 import copy
+import numpy
 
 class OneDimScanFilter(object):
     """docstring for OneDimScanFilter"""
@@ -55,53 +56,25 @@ class OneDimScanFilter(object):
 
 
     def filter_branch(self, xs, ys, is_left=False):
+        """
+        Keeps only the points that lie on the monotonic envelope going outward from
+        the minimum: a point is non-sensical if any point further out is lower.
+        Equivalent to repeatedly deleting points whose next point is lower, in one pass.
+        """
+        xs = numpy.array(xs, dtype=numpy.float64)
+        ys = numpy.array(ys, dtype=numpy.float64)
         if is_left:
             xs = xs[::-1]
             ys = ys[::-1]
-        else:
-            xs = xs[:]
-            ys = ys[:]
-        n = len(xs)
-        xs_deleted = []
-        ys_deleted = []
-        # Filter n times (cannot be more often), but break when nothing to delete
-        for i in xrange(n):
-            to_delete = self.filter_branch_once(xs, ys)
-            if len(to_delete) == 0: break
-            xs, ys, xs_del, ys_del = self.delete_points(to_delete, xs, ys)
-            xs_deleted += xs_del
-            ys_deleted += ys_del
+        # Minimum of all points from i outward; a point is kept if it is this minimum
+        envelope = numpy.minimum.accumulate(ys[::-1])[::-1]
+        keep = ys <= envelope
+        xs_kept, ys_kept = xs[keep], ys[keep]
+        xs_deleted, ys_deleted = xs[~keep], ys[~keep]
         if is_left:
-            xs = xs[::-1]
-            ys = ys[::-1]
-            xs_deleted = xs_deleted[::-1]
-            ys_deleted = ys_deleted[::-1]
-        return xs, ys, xs_deleted, ys_deleted
-
-    def filter_branch_once(self, xs, ys):
-        """Built for the right branch; invert ys to use for left branch"""
-        n = len(xs)
-        to_delete = []
-        for i in xrange(n-1):
-            if ys[i+1] < ys[i]:
-                # y[i] is non-sensical if the next point is lower
-                # For the last point, nothing can be said
-                to_delete.append(i)
-        return to_delete
-
-    def delete_points(self, indices, xs, ys):
-        xs_kept = []
-        ys_kept = []
-        xs_deleted = []
-        ys_deleted = []
-        for i in xrange(len(xs)):
-            if i in indices:
-                xs_deleted.append(xs[i])
-                ys_deleted.append(ys[i])
-            else:
-                xs_kept.append(xs[i])
-                ys_kept.append(ys[i])
-        return xs_kept, ys_kept, xs_deleted, ys_deleted
+            xs_kept, ys_kept = xs_kept[::-1], ys_kept[::-1]
+            xs_deleted, ys_deleted = xs_deleted[::-1], ys_deleted[::-1]
+        return xs_kept.tolist(), ys_kept.tolist(), xs_deleted.tolist(), ys_deleted.tolist()
 
 
     def to_graph(self, style=None):
@@ -106,13 +106,100 @@ def prod(list):
     return r
 
 
+# (workspace md5, function names, coupling names) -> TabulatedFunctions
+_tabulations = {}
+
+def quadratic_monomials(points):
+    """(n_points, n_terms) array with a constant, all columns of points, and all products of two columns"""
+    points = numpy.atleast_2d(numpy.asarray(points, dtype=numpy.float64))
+    n = points.shape[1]
+    columns = [ numpy.ones(points.shape[0]) ] + [ points[:,i] for i in xrange(n) ]
+    columns.extend([ points[:,i] * points[:,j] for i, j in itertools.combinations_with_replacement(xrange(n), 2) ])
+    return numpy.column_stack(columns)
+
+def parabola_monomials(points):
+    """(n_points, 6) array of the terms of Parabola for an (n_points, 2) array, in the order of its A..F"""
+    points = numpy.atleast_2d(numpy.asarray(points, dtype=numpy.float64))
+    c1s = points[:,0]
+    c2s = points[:,1]
+    c3 = Parabola.c3
+    return numpy.column_stack((
+        c1s**2, c2s**2, c1s*c2s, c1s*c3, c2s*c3, numpy.full_like(c1s, c3*c3)
+        ))
+
+
+class TabulatedFunctions(object):
+    """
+    Quadratic coefficients of a list of workspace functions of some couplings,
+    obtained by probing the functions at random coupling points and solving
+    for the coefficients. They are then checked against the workspace at other
+    points; functions that are not reproduced (not quadratic in the couplings)
+    keep being evaluated in the workspace.
+    All other workspace variables are assumed to stay at their current values.
+    """
+
+    n_probe_per_term = 3
+    probe_range = 2.
+    n_check = 10
+    check_range = 10.
+    rtol = 1e-6
+
+    def __init__(self, w, functions, couplings, seed=1):
+        super(TabulatedFunctions, self).__init__()
+        self.couplings = couplings
+        n_terms = quadratic_monomials(numpy.zeros((1, len(couplings)))).shape[1]
+        rng = numpy.random.RandomState(seed)
+        probe_points = rng.uniform(-self.probe_range, self.probe_range, (self.n_probe_per_term*n_terms, len(couplings)))
+        check_points = rng.uniform(-self.check_range, self.check_range, (self.n_check, len(couplings)))
+        probe_values = self.probe(w, functions, probe_points)
+        check_values = self.probe(w, functions, check_points)
+
+        finite = numpy.all(numpy.isfinite(probe_values), axis=0) & numpy.all(numpy.isfinite(check_values), axis=0)
+        probe_values[:,~finite] = 0.
+        check_values[:,~finite] = 0.
+        # (n_functions, n_terms)
+        self.coefficients = numpy.linalg.lstsq(quadratic_monomials(probe_points), probe_values, rcond=None)[0].T
+
+        deviations = numpy.abs(quadratic_monomials(check_points).dot(self.coefficients.T) - check_values)
+        scales = numpy.maximum(numpy.abs(check_values).max(axis=0), 1e-12)
+        self.is_quadratic = finite & numpy.all(deviations <= self.rtol * scales, axis=0)
+        self.i_fallback = numpy.nonzero(~self.is_quadratic)[0].tolist()
+        logging.info(
+            'Tabulated {0} of {1} functions as quadratic in {2}; evaluating {3} in the workspace'
+            .format(
+                numpy.count_nonzero(self.is_quadratic), len(functions), ', '.join(couplings),
+                ', '.join([ functions[i].GetName() for i in self.i_fallback ]) if len(self.i_fallback) > 0 else 'none'
+                )
+            )
+
+    def probe(self, w, functions, points):
+        # The workspace may be shared (see core.get_ws); put the couplings back afterwards
+        old_values = [ w.var(name).getVal() for name in self.couplings ]
+        values = numpy.zeros((len(points), len(functions)))
+        try:
+            for i_point, point in enumerate(points):
+                for name, value in zip(self.couplings, point):
+                    w.var(name).setVal(value)
+                values[i_point] = [ function.getVal() for function in functions ]
+        finally:
+            for name, value in zip(self.couplings, old_values):
+                w.var(name).setVal(value)
+        return values
+
+    def evaluate(self, coupling_vals, functions):
+        """Evaluates at coupling_vals; the workspace variables should already be set for the fallback functions"""
+        values = self.coefficients.dot(quadratic_monomials([[ coupling_vals[c] for c in self.couplings ]])[0])
+        for i in self.i_fallback:
+            values[i] = functions[i].getVal()
+        return values.tolist()
+
+
 class WSParametrization(object):
     """docstring for WSParametrization"""
     def __init__(self, ws_file):
         logging.debug('Initializing parametrization with file {0}'.format(ws_file))
         self.ws_file = ws_file
-        with core.openroot(ws_file) as ws_fp:
-            self.w = ws_fp.Get('w')
+        self.w = core.get_ws(ws_file)
 
         self.old_style = False
 
@@ -128,6 +215,12 @@ class WSParametrization(object):
         self.decay_channel = None
         self.is_dc_specific = False
 
+        # If True, yield parameters are evaluated from their quadratic coefficients
+        # (see TabulatedFunctions) rather than in the workspace
+        self.tabulate = False
+        self.coupling_vals = {}
+        self._ws_md5 = None
+
 
 
     def arglist_to_pylist(self, arglist):
@@ -173,6 +266,7 @@ class WSParametrization(object):
                 .format(name, self.ws_file)
                 )
         roovar.setVal(value)
+        self.coupling_vals[name] = value
 
     def set_kwargs(self, kwargs):
         for name, value in kwargs.iteritems():
@@ -181,6 +275,26 @@ class WSParametrization(object):
     def set_smxs(self, smxs):
         self.smxs = smxs
 
+    def get_ws_md5(self):
+        if self._ws_md5 is None:
+            self._ws_md5 = core.file_md5(self.ws_file)
+        return self._ws_md5
+
+    def get_tabulation(self, functions):
+        couplings = sorted(self.coupling_vals.keys())
+        key = (self.get_ws_md5(), tuple([ f.GetName() for f in functions ]), tuple(couplings))
+        if not key in _tabulations:
+            _tabulations[key] = TabulatedFunctions(self.w, functions, couplings)
+        return _tabulations[key]
+
+    def evaluate_functions(self, functions, kwargs):
+        # The workspace may be shared with other parametrizations of the same file
+        # (see core.get_ws), so (re)set all couplings set on this one, not only kwargs
+        self.set_kwargs(dict(self.coupling_vals, **kwargs))
+        if not self.tabulate or len(self.coupling_vals) == 0:
+            return [ function.getVal() for function in functions ]
+        return self.get_tabulation(functions).evaluate(self.coupling_vals, functions)
+
     def get_smxs_from_ws(self, set_name='SMXS'):
         xs_pars = self.get_argset_as_pylist(set_name)
         self.smxs = [ p.getVal() for p in xs_pars ]
@@ -236,8 +350,7 @@ class WSParametrization(object):
     def get_mus_exp(self, **kwargs):
         if len(self.parametrizations) == 0:
             self.get_parametrizations()
-        self.set_kwargs(kwargs)
-        return [ param.getVal() for param in self.parametrizations ]
+        return self.evaluate_functions(self.parametrizations, kwargs)
 
     def get_xs_exp(self, **kwargs):
         if len(self.smxs)==0:
@@ -267,8 +380,7 @@ class WSParametrization(object):
             self.ggH_yield_parameters = self.get_argset_as_pylist('all_ggH_yieldParameters')
             if self.is_dc_specific:
                 self.ggH_yield_parameters = self.filter_for_decay_channel(self.ggH_yield_parameters)
-        self.set_kwargs(kwargs)
-        return [ yp.getVal() for yp in self.ggH_yield_parameters ]
+        return self.evaluate_functions(self.ggH_yield_parameters, kwargs)
 
     def get_xs_exp_ggH(self, **kwargs):
         if len(self.smxs)==0:
@@ -287,8 +399,7 @@ class WSParametrization(object):
             self.xH_yield_parameters = self.get_argset_as_pylist('all_xH_yieldParameters')
             if self.is_dc_specific:
                 self.xH_yield_parameters = self.filter_for_decay_channel(self.xH_yield_parameters)
-        self.set_kwargs(kwargs)
-        return [ yp.getVal() for yp in self.xH_yield_parameters ]
+        return self.evaluate_functions(self.xH_yield_parameters, kwargs)
 
     def get_xs_exp_xH(self, **kwargs):
         if len(self.smxs_xH)==0:
@@ -308,13 +419,56 @@ class ParametrizationMultiDim(object):
         self.variations = []
         self.parametrizations = []
         self.parametrize_by_matrix_inversion = False
+        # (n_bins, n_coefficients); row i holds the coefficients of self.parametrizations[i]
+        self.coefficient_matrix = None
+        # The parametrizations the matrix was built from
+        self._coefficient_matrix_source = []
         
         self.rebinner = None
         self.SM_set = False
         self.binning_set = False
 
     def evaluate(self, **coupling_vals):
-        return [ p(**coupling_vals) if abs(p(**coupling_vals))>1e-12 else 0.0 for p in self.parametrizations ]
+        point = [ coupling_vals[name] for name in self.coupling_names ]
+        return self.evaluate_many([ point ])[0].tolist()
+
+    def evaluate_many(self, points):
+        """
+        Evaluates all bins for an (n_points, n_couplings) array of coupling values
+        (in the order of self.coupling_names); returns an (n_points, n_bins) array
+        """
+        xs = self.monomials_many(points).dot(self.get_coefficient_matrix().T)
+        xs[numpy.abs(xs) <= 1e-12] = 0.
+        return xs
+
+    def get_coefficients(self, parametrization):
+        return parametrization.coefficients
+
+    def build_coefficient_matrix(self):
+        self.coefficient_matrix = numpy.array(
+            [ self.get_coefficients(p) for p in self.parametrizations ], dtype=numpy.float64
+            )
+        self._coefficient_matrix_source = list(self.parametrizations)
+
+    def get_coefficient_matrix(self):
+        # Refits create new parametrization objects, so the matrix is outdated as soon as
+        # any of them is not the object it was built from (list replaced, bin replaced or added)
+        source = self._coefficient_matrix_source
+        if (
+                self.coefficient_matrix is None
+                or len(source) != len(self.parametrizations)
+                or any(p is not q for p, q in zip(source, self.parametrizations))
+                ):
+            self.build_coefficient_matrix()
+        return self.coefficient_matrix
+
+    def monomials_many(self, points):
+        """(n_points, n_coefficients) array of the coupling products in self.coupling_combinations"""
+        points = numpy.atleast_2d(numpy.asarray(points, dtype=numpy.float64))
+        index = { name : i for i, name in enumerate(self.coupling_names) }
+        return numpy.column_stack([
+            numpy.prod(points[:,[ index[c] for c in comb ]], axis=1) for comb in self.coupling_combinations
+            ])
 
     def set_binning(self, binning):
         self.binning = binning
@@ -427,6 +581,7 @@ class ParametrizationMultiDim(object):
             self.do_parametrize_by_matrix_inversion()
         else:
             self.do_parametrize_by_fitting()
+        self.build_coefficient_matrix()
 
     def do_parametrize_by_matrix_inversion(self):
         self.get_coupling_combinations()
@@ -492,7 +647,22 @@ class Parametrization2Dim(ParametrizationMultiDim):
 
 
     def evaluate(self, c1, c2):
-        return [ p(c1, c2) if abs(p(c1, c2))>1e-12 else 0.0 for p in self.parametrizations ]
+        return self.evaluate_many([[ c1, c2 ]])[0].tolist()
+
+    def get_coefficients(self, parabola):
+        return [ parabola.A, parabola.B, parabola.C, parabola.D, parabola.E, parabola.F ]
+
+    def monomials_many(self, points):
+        return parabola_monomials(points)
+
+    def get_xs_exp_many(self, points):
+        """Experimentally binned cross sections for an (n_points, 2) array; returns (n_points, n_bins_exp)"""
+        if self.rebinner is None:
+            raise RuntimeError(
+                'First define a rebinner so that the theory spectrum may be mapped to the experimental one'
+                )
+        if not self.SM_set: self.set_SM()
+        return self.rebinner.get_rebin_matrix().rebin(self.evaluate_many(points))
 
     def get_xs_exp(self, c1, c2):
         if self.rebinner is None:
@@ -569,6 +739,7 @@ class Parametrization2Dim(ParametrizationMultiDim):
             else:
                 parametrization = self.get_fitted_parametrization(c1s, c2s, xs)
             self.parametrizations.append(parametrization)
+        self.build_coefficient_matrix()
 
     def do_parametrize_by_fitting(self):
         for i_bin in xrange(self.n_bins):
@@ -1,18 +1,32 @@
 import logging
+import os, json
+import os.path as osp
 import differentials
 import core
+import wsregistry
 
 import ROOT
 
 class PDFFreezer(object):
+    """
+    Finds the pdfindex categories and the parameters of the non-selected envelope
+    pdfs to freeze. The result is stored in an index file keyed by the md5 of the
+    workspace and the snapshot name, so later runs on the same workspace do not
+    need to open it.
+    """
+
+    index_dir = 'pdffreezerindex'
 
     def __init__(self, ws=None):
         super(PDFFreezer, self).__init__()
         self.ws = ws
         self.snapshotname = 'MultiDimFit'
+        self.use_index = True
         self._is_read = False
         self.vars_to_freeze = []
         self.vars_to_float = []
+        # pdfindex category name -> index in the snapshot
+        self.categories = {}
 
     def get_loaded_workspace(self):
         self.w = core.get_ws(self.ws)
@@ -27,6 +41,7 @@ class PDFFreezer(object):
         while cat:
             if cat.GetName().startswith('pdfindex'):
                 self.vars_to_freeze.append(cat.GetName())
+                self.categories[cat.GetName()] = cat.getIndex()
             cat = catitr.Next()
 
     def add_pdf_parameters_to_freeze(self):
@@ -57,11 +72,53 @@ class PDFFreezer(object):
         # For some reason, the first variable is never frozen; simply append it again at end of list
         self.vars_to_freeze.append( self.vars_to_freeze[0] )
 
+    def get_index_file(self):
+        return osp.join(self.index_dir, '{0}_{1}.json'.format(core.file_md5(self.ws), self.snapshotname))
+
+    def read_index(self):
+        index_file = self.get_index_file()
+        if not osp.isfile(index_file): return False
+        try:
+            with open(index_file, 'r') as fp:
+                index = json.load(fp)
+        except ValueError:
+            logging.warning('Could not read {0}; rebuilding it'.format(index_file))
+            return False
+        # json gives unicode; keep plain str for the command line and PyROOT
+        self.categories = { str(name) : int(i) for name, i in index['categories'].iteritems() }
+        self.vars_to_freeze = [ str(name) for name in index['vars_to_freeze'] ]
+        self.vars_to_float = [ str(name) for name in index['vars_to_float'] ]
+        logging.info('Read the pdf parameters to freeze for {0} from {1}'.format(self.ws, index_file))
+        return True
+
+    def write_index(self):
+        index_file = self.get_index_file()
+        if not osp.isdir(self.index_dir): os.makedirs(self.index_dir)
+        index = {
+            'ws'             : osp.abspath(self.ws),
+            'snapshotname'   : self.snapshotname,
+            'categories'     : self.categories,
+            'vars_to_freeze' : self.vars_to_freeze,
+            'vars_to_float'  : self.vars_to_float,
+            }
+        tmp_file = index_file + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            json.dump(index, fp, indent=2, sort_keys=True)
+        os.rename(tmp_file, index_file)
+        logging.info('Wrote the pdf parameters to freeze for {0} to {1}'.format(self.ws, index_file))
+
     def read(self):
-        self.get_loaded_workspace()
-        self.add_categories_to_freeze()
-        self.add_pdf_parameters_to_freeze()
+        if self.use_index and self.read_index():
+            self._is_read = True
+            return
+        # The workspace is shared with other users of the same file (see core.get_ws),
+        # so undo loading the snapshot afterwards
+        with wsregistry.preserved_values(core.get_ws(self.ws)):
+            self.get_loaded_workspace()
+            self.add_categories_to_freeze()
+            self.add_pdf_parameters_to_freeze()
         self._is_read = True
+        if self.use_index: self.write_index()
 
     def get_vars_to_freeze(self):
         if not self._is_read:
@@ -6,6 +6,7 @@ import ROOT
 import logging
 from array import array
 from math import sqrt
+import numpy
 
 ROOTCOUNTER = 1000
 def get_unique_rootname():
@@ -101,62 +102,183 @@ def new_color_cycle():
 
 contourset_counter = 1
 def get_contours_from_H2(H2_original, threshold):
-    # Open a temporary canvas so the contour business does not screw up other plots
-    ctemp = ROOT.TCanvas('ctemp', 'ctemp', 1000, 800)
-    ctemp.cd()
-    global contourset_counter
-
-    H2 = H2_original.Clone()
-    H2.SetName(get_unique_rootname())
-    H2.SetContour(1, array('d', [threshold]))
-
+    """
+    Returns the contours of a TH2 at threshold as a list of TGraphs; computed
+    with marching squares on the bin contents, so no canvas is needed
+    """
+    x_centers, y_centers, z = get_H2_contents(H2_original)
     logging.debug(
         'Trying to get contours from \'{0}\''
-        .format(H2.GetName())
+        .format(H2_original.GetName())
         + (' ({0})'.format(H2_original.name) if hasattr(H2_original, 'name') else '')
         )
+    contours = get_contours_from_array(x_centers, y_centers, z, [threshold])[threshold]
+    return contours_to_TGraphs(contours, threshold)
+
+
+def get_H2_contents(H2):
+    """Returns the x bin centers, y bin centers and (nx, ny) array of contents of a TH2"""
+    nx = H2.GetNbinsX()
+    ny = H2.GetNbinsY()
+    x_centers = numpy.array([ H2.GetXaxis().GetBinCenter(i+1) for i in xrange(nx) ])
+    y_centers = numpy.array([ H2.GetYaxis().GetBinCenter(i+1) for i in xrange(ny) ])
+    if H2.InheritsFrom('TH2D'):
+        buf = H2.GetArray()
+        n = (nx+2) * (ny+2)
+        if hasattr(buf, 'SetSize'):
+            buf.SetSize(n)
+        else:
+            buf.reshape((n,))
+        # Root bin number is ix + (nx+2)*iy, including under- and overflow
+        z = numpy.frombuffer(buf, dtype=numpy.float64, count=n).reshape((ny+2, nx+2)).T[1:-1,1:-1].copy()
+    else:
+        z = numpy.array([ [ H2.GetBinContent(ix+1, iy+1) for iy in xrange(ny) ] for ix in xrange(nx) ])
+    return x_centers, y_centers, z
+
+
+# Marching squares lookup: cell corners are bl=1, br=2, tr=4, tl=8 (bit set if z >= level),
+# cell edges are bottom=0, right=1, top=2, left=3
+_MARCHING_SQUARES_SEGMENTS = {
+    1  : [(3, 0)],
+    2  : [(0, 1)],
+    3  : [(3, 1)],
+    4  : [(1, 2)],
+    6  : [(0, 2)],
+    7  : [(3, 2)],
+    8  : [(2, 3)],
+    9  : [(0, 2)],
+    11 : [(1, 2)],
+    12 : [(3, 1)],
+    13 : [(0, 1)],
+    14 : [(3, 0)],
+    }
+# Saddles, resolved with the average of the 4 corners: (center >= level, center < level)
+_MARCHING_SQUARES_SADDLES = {
+    5  : ( [(0, 1), (2, 3)], [(3, 0), (1, 2)] ),
+    10 : ( [(3, 0), (1, 2)], [(0, 1), (2, 3)] ),
+    }
+
+def get_contours_from_array(x_centers, y_centers, z, levels):
+    """
+    Marching squares on a grid of values z[ix][iy] at (x_centers[ix], y_centers[iy]).
+    Returns a dict level -> list of contours, every contour a tuple (xs, ys) of
+    numpy arrays; closed contours repeat their first point at the end.
+    """
+    x_centers = numpy.asarray(x_centers, dtype=numpy.float64)
+    y_centers = numpy.asarray(y_centers, dtype=numpy.float64)
+    z = numpy.asarray(z, dtype=numpy.float64)
+    nx, ny = z.shape
+    contours = {}
+    if nx < 2 or ny < 2:
+        return { level : [] for level in levels }
+
+    # Edge ids: horizontal edge (ix,iy)-(ix+1,iy) is ix*ny + iy,
+    # vertical edge (ix,iy)-(ix,iy+1) is n_h + ix*(ny-1) + iy
+    n_h = (nx-1) * ny
+    IX, IY = numpy.meshgrid(numpy.arange(nx-1), numpy.arange(ny-1), indexing='ij')
+    cell_edge_ids = numpy.array([
+        IX*ny + IY,                  # bottom
+        n_h + (IX+1)*(ny-1) + IY,    # right
+        IX*ny + IY + 1,              # top
+        n_h + IX*(ny-1) + IY,        # left
+        ])
+    z_bl, z_br, z_tr, z_tl = z[:-1,:-1], z[1:,:-1], z[1:,1:], z[:-1,1:]
+    z_center = 0.25 * (z_bl + z_br + z_tr + z_tl)
+
+    def edge_points(edge_ids, level):
+        """Linearly interpolated crossing points for an array of edge ids"""
+        is_h = edge_ids < n_h
+        ix = numpy.where(is_h, edge_ids // ny, (edge_ids - n_h) // (ny-1))
+        iy = numpy.where(is_h, edge_ids % ny, (edge_ids - n_h) % (ny-1))
+        ix2 = numpy.where(is_h, ix+1, ix)
+        iy2 = numpy.where(is_h, iy, iy+1)
+        z1 = z[ix, iy]
+        z2 = z[ix2, iy2]
+        dz = z2 - z1
+        t = numpy.where(dz == 0., 0.5, (level - z1) / numpy.where(dz == 0., 1., dz))
+        xs = x_centers[ix] + t * (x_centers[ix2] - x_centers[ix])
+        ys = y_centers[iy] + t * (y_centers[iy2] - y_centers[iy])
+        return xs, ys
 
-    H2.Draw('CONT Z LIST')
-    ROOT.gPad.Update()
-
-    contours_genObj = ROOT.gROOT.GetListOfSpecials().FindObject('contours')
-
+    for level in levels:
+        case = (
+            (z_bl >= level).astype(int) + 2*(z_br >= level) + 4*(z_tr >= level) + 8*(z_tl >= level)
+            )
+        segments = []
+        for i_case, edge_pairs in _MARCHING_SQUARES_SEGMENTS.iteritems():
+            cells = (case == i_case)
+            if not numpy.any(cells): continue
+            for e1, e2 in edge_pairs:
+                segments.append(numpy.column_stack((cell_edge_ids[e1][cells], cell_edge_ids[e2][cells])))
+        for i_case, (pairs_high, pairs_low) in _MARCHING_SQUARES_SADDLES.iteritems():
+            for pairs, center_mask in [ (pairs_high, z_center >= level), (pairs_low, z_center < level) ]:
+                cells = (case == i_case) & center_mask
+                if not numpy.any(cells): continue
+                for e1, e2 in pairs:
+                    segments.append(numpy.column_stack((cell_edge_ids[e1][cells], cell_edge_ids[e2][cells])))
+
+        if len(segments) == 0:
+            contours[level] = []
+            continue
+        segments = numpy.concatenate(segments)
+        paths = join_segments(segments.tolist())
+        edge_ids = numpy.unique(segments)
+        xs, ys = edge_points(edge_ids, level)
+        point_for_edge = dict(zip(edge_ids.tolist(), zip(xs.tolist(), ys.tolist())))
+        contours[level] = []
+        for path in paths:
+            points = numpy.array([ point_for_edge[edge_id] for edge_id in path ])
+            contours[level].append(( points[:,0], points[:,1] ))
+    return contours
+
+
+def join_segments(segments):
+    """
+    Joins segments (pairs of edge ids) into paths of edge ids. Open paths (ending
+    on the grid boundary) are walked from their ends first; what is left are closed loops.
+    """
+    neighbours = {}
+    for a, b in segments:
+        neighbours.setdefault(a, []).append(b)
+        neighbours.setdefault(b, []).append(a)
+
+    def walk(start):
+        path = [start]
+        current = start
+        while len(neighbours[current]) > 0:
+            next_id = neighbours[current].pop(0)
+            neighbours[next_id].remove(current)
+            path.append(next_id)
+            current = next_id
+            if current == start: break
+        return path
+
+    paths = []
+    for start in [ edge_id for edge_id, n in neighbours.iteritems() if len(n) == 1 ]:
+        if len(neighbours[start]) == 1:
+            paths.append(walk(start))
+    for start in neighbours.keys():
+        while len(neighbours[start]) > 0:
+            paths.append(walk(start))
+    return paths
+
+
+def contours_to_TGraphs(contours, threshold=None):
+    """Converts a list of (xs, ys) contours into TGraphs, only needed for drawing"""
+    global contourset_counter
     Tgs = []
-    for iContour in xrange(contours_genObj.GetSize()):
-        contour_TList = contours_genObj.At(iContour)
-        for iVal in xrange(contour_TList.GetSize()):
-            Tg = contour_TList.At(iVal)
-
-            TgClone = Tg.Clone()
-            ROOT.SetOwnership(TgClone, False)
-            TgClone.SetName('contourset{0}_'.format(contourset_counter) + get_unique_rootname())
-            Tgs.append(TgClone)
-
+    for xs, ys in contours:
+        Tg = ROOT.TGraph(len(xs), array('d', xs), array('d', ys))
+        ROOT.SetOwnership(Tg, False)
+        Tg.SetName('contourset{0}_'.format(contourset_counter) + get_unique_rootname())
+        Tgs.append(Tg)
     logging.debug('{0} contours found for threshold {1}'.format(len(Tgs), threshold))
-    for i_Tg, Tg in enumerate(Tgs):
-        N = Tg.GetN()
-        xList = [ Tg.GetX()[iPoint] for iPoint in xrange(N) ]
-        yList = [ Tg.GetY()[iPoint] for iPoint in xrange(N) ]
-        xMin = min(xList)
-        xMax = max(xList)
-        yMin = min(yList)
-        yMax = max(yList)
+    for i_contour, (xs, ys) in enumerate(contours):
         logging.debug(
             'Contour {0} ({1} points): '
             'xMin = {2:+9.4f}, xMax = {3:+9.4f}, yMin = {4:+9.4f}, yMax = {5:+9.4f}'
-            .format(i_Tg, N, xMin, xMax, yMin, yMax)
+            .format(i_contour, len(xs), min(xs), max(xs), min(ys), max(ys))
             )
-
-    del H2
-    del contours_genObj
-
-    ctemp.Close()
-    del ctemp
-
-    from canvas import c
-    c.cd()
-    ROOT.gPad.Update()
-
     contourset_counter += 1
     return Tgs
 
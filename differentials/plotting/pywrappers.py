@@ -1,4 +1,4 @@
-import itertools, copy, sys
+import itertools, copy, sys, hashlib
 
 import ROOT
 import plotting_utils as utils
@@ -1228,10 +1228,13 @@ class Histogram2D(BasicDrawable):
         self.legend = None
         self.H2 = None
         self.H2_array = None
-        self.entries = []
+        self.H2_content = None
+        self.entries = differentials.scans.ScanTable()
 
         self.contour_filter_method = None
         self._filled_bestfit = False
+        self._contour_cache_key = None
+        self._contour_cache = {}
 
 
     def infer_bin_boundaries(self, bin_centers):
@@ -1252,15 +1255,15 @@ class Histogram2D(BasicDrawable):
         return self.entries[self.deltaNLL().index(0.0)]
 
     def x(self):
-        return [e.x for e in self.entries]
+        return self.entries.column('x').tolist()
     def y(self):
-        return [e.y for e in self.entries]
+        return self.entries.column('y').tolist()
     def z(self):
-        return [e.z for e in self.entries]
+        return self.entries.column('z').tolist()
     def deltaNLL(self):
-        return [e.deltaNLL for e in self.entries]
+        return self.entries.column('deltaNLL').tolist()
     def two_times_deltaNLL(self):
-        return [2.*e.deltaNLL for e in self.entries]
+        return (2.*self.entries.column('deltaNLL')).tolist()
 
     def x_min(self):
         if len(self.entries) == 0: return self.x_bin_boundaries[0]
@@ -1277,10 +1280,10 @@ class Histogram2D(BasicDrawable):
 
     def set_binning_from_entries(self):
         bestfit = self.bestfit()
-        self.x_bin_centers = [ x for x in list(set(self.x())) if not x == bestfit.x ]
-        self.y_bin_centers = [ y for y in list(set(self.y())) if not y == bestfit.y ]
-        self.x_bin_centers.sort()
-        self.y_bin_centers.sort()
+        xs = numpy.unique(self.entries.column('x'))
+        ys = numpy.unique(self.entries.column('y'))
+        self.x_bin_centers = xs[xs != bestfit.x].tolist()
+        self.y_bin_centers = ys[ys != bestfit.y].tolist()
 
         logging.trace('Found the following x_bin_centers:\n{0}'.format(self.x_bin_centers))
         logging.trace('Found the following y_bin_centers:\n{0}'.format(self.y_bin_centers))
@@ -1293,49 +1296,61 @@ class Histogram2D(BasicDrawable):
         logging.trace('Found the following x_bin_boundaries:\n{0}'.format(self.x_bin_boundaries))
         logging.trace('Found the following y_bin_boundaries:\n{0}'.format(self.y_bin_boundaries))
 
-    def fill_from_entries(self, entries=None):
-        if not(entries is None):
-            self.entries = entries
-        bestfit = self.bestfit()
-        self.set_binning_from_entries()
-
-        self.H2 = ROOT.TH2D(
+    def new_H2(self):
+        """Creates an empty TH2D with the current binning"""
+        H2 = ROOT.TH2D(
             utils.get_unique_rootname(), '',
             self.n_bins_x, array('d', self.x_bin_boundaries),
             self.n_bins_y, array('d', self.y_bin_boundaries),
             )
-        ROOT.SetOwnership(self.H2, False)
-        self.H2_array = [ [self.default_value for j in xrange(self.n_bins_y)] for i in xrange(self.n_bins_x) ]
+        ROOT.SetOwnership(H2, False)
+        return H2
 
-        for i_x in xrange(self.n_bins_x):
-            for i_y in xrange(self.n_bins_y):
-                self.H2.SetBinContent(i_x+1, i_y+1, self.default_value)
+    def update_H2(self, values=None):
+        """
+        Copies values (default: H2_array) into the TH2 in one call; H2_content keeps
+        track of what the TH2 holds, so that the smoothing/patching methods, which only
+        change the TH2, leave H2_array (the filled scan) alone
+        """
+        if values is None:
+            values = self.H2_array
+        self.H2_content = numpy.array(values, dtype=numpy.float64)
+        content = numpy.zeros((self.n_bins_y+2, self.n_bins_x+2))
+        content[1:-1,1:-1] = self.H2_content.T
+        # Root bin number is ix + (nx+2)*iy, including under- and overflow
+        self.H2.SetContent(array('d', content.ravel().tolist()))
+
+    def find_bins(self, values, bin_centers):
+        """Returns indices of values in the sorted bin_centers, and a mask of exact matches"""
+        bin_centers = numpy.asarray(bin_centers)
+        if len(bin_centers) == 0:
+            return numpy.zeros(len(values), dtype=int), numpy.zeros(len(values), dtype=bool)
+        indices = numpy.clip(numpy.searchsorted(bin_centers, values), 0, len(bin_centers)-1)
+        return indices, bin_centers[indices] == values
 
-        logging.debug('Filling {0} entries'.format(len(self.entries)))
-        for entry in self.entries:
-            if entry.x == bestfit.x and entry.y == bestfit.y: continue
-            try:
-                i_bin_x = self.x_bin_centers.index(entry.x)
-            except ValueError:
-                logging.error(
-                    '{0} could not be filled - x={1} does not match any bin'
-                    .format(entry, entry.x)
-                    )
-            try:
-                i_bin_y = self.y_bin_centers.index(entry.y)
-            except ValueError:
-                logging.error(
-                    '{0} could not be filled - y={1} does not match any bin'
-                    .format(entry, entry.y)
-                    )
+    def fill_from_entries(self, entries=None):
+        if not(entries is None):
+            self.entries = differentials.scans.ScanTable.from_entries(entries)
+        bestfit = self.bestfit()
+        self.set_binning_from_entries()
 
-            logging.trace(
-                'Filling i_x={0} (x={1}) / i_y={2} (y={3}) with 2*deltaNLL={4}'
-                .format(i_bin_x, entry.x, i_bin_y, entry.y, 2.*entry.deltaNLL)
-                )
+        self.H2 = self.new_H2()
+        self.H2_array = numpy.full((self.n_bins_x, self.n_bins_y), self.default_value)
 
-            self.H2.SetBinContent(i_bin_x+1, i_bin_y+1, 2.*entry.deltaNLL)
-            self.H2_array[i_bin_x][i_bin_y] = 2.*entry.deltaNLL
+        logging.debug('Filling {0} entries'.format(len(self.entries)))
+        xs = self.entries.column('x')
+        ys = self.entries.column('y')
+        is_bestfit = (xs == bestfit.x) & (ys == bestfit.y)
+        i_bins_x, matched_x = self.find_bins(xs, self.x_bin_centers)
+        i_bins_y, matched_y = self.find_bins(ys, self.y_bin_centers)
+        for i in numpy.nonzero(~is_bestfit & ~(matched_x & matched_y))[0]:
+            logging.error(
+                '{0} could not be filled - x={1} / y={2} does not match any bin'
+                .format(self.entries[i], xs[i], ys[i])
+                )
+        fill = ~is_bestfit & matched_x & matched_y
+        self.H2_array[i_bins_x[fill], i_bins_y[fill]] = 2.*self.entries.column('deltaNLL')[fill]
+        self.update_H2()
 
     def fill_with_matrix(self, matrix, x_bin_boundaries, y_bin_boundaries):
         self.x_bin_boundaries = x_bin_boundaries
@@ -1345,53 +1360,18 @@ class Histogram2D(BasicDrawable):
         self.x_bin_centers = [ 0.5*(r+l) for l, r in zip(self.x_bin_boundaries[:-1], self.x_bin_boundaries[1:]) ]
         self.y_bin_centers = [ 0.5*(r+l) for l, r in zip(self.y_bin_boundaries[:-1], self.y_bin_boundaries[1:]) ]
 
-        self.H2_array = matrix
+        self.H2_array = numpy.array(matrix, dtype=numpy.float64).reshape((self.n_bins_x, self.n_bins_y))
+        self.H2 = self.new_H2()
+        self.update_H2()
 
-        self.H2 = ROOT.TH2D(
-            utils.get_unique_rootname(), '',
-            self.n_bins_x, array('d', self.x_bin_boundaries),
-            self.n_bins_y, array('d', self.y_bin_boundaries),
-            )
-        ROOT.SetOwnership(self.H2, False)
-
-        min_z = 9999.
-        min_x = 9999.
-        min_y = 9999.
-        for i_x in xrange(self.n_bins_x):
-            for i_y in xrange(self.n_bins_y):
-                z = self.H2_array[i_x][i_y]
-                self.H2.SetBinContent(i_x+1, i_y+1, z)
-                if z < min_z: # Simultaneously look for minimum
-                    min_z = z
-                    min_x = self.x_bin_centers[i_x]
-                    min_y = self.y_bin_centers[i_y]
-        self.fill_bestfit(min_x, min_y)
+        # Simultaneously look for minimum
+        i_x, i_y = numpy.unravel_index(numpy.argmin(self.H2_array), self.H2_array.shape)
+        self.fill_bestfit(self.x_bin_centers[i_x], self.y_bin_centers[i_y])
 
     def smooth_2d(self):
-        smoothed = scipy.ndimage.gaussian_filter(
+        self.update_H2(scipy.ndimage.gaussian_filter(
             self.H2_array, sigma = 2,
-            )
-
-        # kernel = numpy.array([
-        #     [ 1., 1., 1. ],
-        #     [ 1., 9., 1. ],
-        #     [ 1., 1., 1. ],
-        #     ])
-        # kernel = kernel / numpy.sum(kernel)
-
-        # print kernel
-        # sys.exit()
-
-        # smoothed = scipy.signal.convolve2d(
-        #     self.H2_array, kernel, boundary='symm'
-        #     )
-
-        for i_x in xrange(self.n_bins_x):
-            for i_y in xrange(self.n_bins_y):
-                self.H2.SetBinContent(i_x+1, i_y+1, smoothed[i_x][i_y])
-
-
-
+            ))
 
     def add_padding(self, value, x_min=-1000., x_max=1000., y_min=-1000., y_max=1000.):
         if x_min > self.x_bin_boundaries[0]:
@@ -1419,38 +1399,17 @@ class Histogram2D(BasicDrawable):
                 )
             return
 
-        self.x_bin_boundaries = [x_min] + self.x_bin_boundaries + [x_max]
-        self.y_bin_boundaries = [y_min] + self.y_bin_boundaries + [y_max]
+        self.x_bin_boundaries = [x_min] + list(self.x_bin_boundaries) + [x_max]
+        self.y_bin_boundaries = [y_min] + list(self.y_bin_boundaries) + [y_max]
         self.n_bins_x = len(self.x_bin_boundaries)-1
         self.n_bins_y = len(self.y_bin_boundaries)-1
         self.x_bin_centers = [ 0.5*(r+l) for l, r in zip(self.x_bin_boundaries[:-1], self.x_bin_boundaries[1:]) ]
         self.y_bin_centers = [ 0.5*(r+l) for l, r in zip(self.y_bin_boundaries[:-1], self.y_bin_boundaries[1:]) ]
 
-        # Open up new hist with the padding bins
-        H = ROOT.TH2D(
-            utils.get_unique_rootname(), '',
-            self.n_bins_x, array('d', self.x_bin_boundaries),
-            self.n_bins_y, array('d', self.y_bin_boundaries),
-            )
-        ROOT.SetOwnership(H, False)
-
-        # Fill in the new hist using old hist and the padding value
-        for i_x in xrange(self.n_bins_x):
-            for i_y in xrange(self.n_bins_y):
-                if i_x == 0 or i_x == self.n_bins_x-1 or i_y == 0 or i_y == self.n_bins_y-1:
-                    fill_val = value
-                else:
-                    fill_val = self.H2.GetBinContent(i_x, i_y)
-                H.SetBinContent(i_x+1, i_y+1, fill_val)
-        self.H2 = H
-
-        # Also correct the H2_array
-        self.H2_array = (
-            [ value for i in xrange(self.n_bins_y) ]
-            + [ [value] + r + [value] for r in self.H2_array ]
-            + [ value for i in xrange(self.n_bins_y) ]
-            )
-
+        # Surround the old contents by a single bin filled with the padding value
+        self.H2_array = numpy.pad(self.H2_array, 1, mode='constant', constant_values=value)
+        self.H2 = self.new_H2()
+        self.update_H2(numpy.pad(self.H2_content, 1, mode='constant', constant_values=value))
 
     def mirror(self, del_y_middle=False):
         x_new_bounds = [ x for x in self.x_bin_boundaries if x > 0. ]
@@ -1467,39 +1426,28 @@ class Histogram2D(BasicDrawable):
         y_new_centers = [ 0.5*(r+l) for l, r in zip(y_new_bounds[:-1], y_new_bounds[1:]) ]
         y_new_nbins  = len(y_new_bounds)-1
 
-        H = ROOT.TH2D(
-            utils.get_unique_rootname(), '',
-            x_new_nbins, array('d', x_new_bounds),
-            y_new_nbins, array('d', y_new_bounds),
-            )
-        ROOT.SetOwnership(H, False)
+        def closest(values, centers):
+            # Index of the closest center per value (first one on ties, like core.get_closest_match)
+            return numpy.argmin(numpy.abs(numpy.subtract.outer(values, centers)), axis=1)
 
         # Set default value
-        H_array = [ [ 888. for i_y in xrange(y_new_nbins) ] for i_x in xrange(x_new_nbins) ]
-        for i_x in xrange(x_new_nbins):
-            for i_y in xrange(y_new_nbins):
-                H.SetBinContent(i_x+1, i_y+1, 888.)
-
-        for i_x in xrange(self.n_bins_x):
-            for i_y in xrange(self.n_bins_y):
-                x_center = self.x_bin_centers[i_x]
-                y_center = self.y_bin_centers[i_y]
-                val = self.H2.GetBinContent(i_x+1, i_y+1)
-
-                # Fill positive quadrant
-                i_x_new = differentials.core.get_closest_match(x_center, x_new_centers)[1]
-                i_y_new = differentials.core.get_closest_match(y_center, y_new_centers)[1]
-                H.SetBinContent(i_x_new+1, i_y_new+1, val)
-                H_array[i_x_new][i_y_new] = val
-
-                # Fill negative quadrant
-                i_x_new = differentials.core.get_closest_match(-x_center, x_new_centers)[1]
-                i_y_new = differentials.core.get_closest_match(-y_center, y_new_centers)[1]
-                H.SetBinContent(i_x_new+1, i_y_new+1, val)
-                H_array[i_x_new][i_y_new] = val
+        H_array = numpy.full((x_new_nbins, y_new_nbins), 888.)
+
+        x_centers = numpy.array(self.x_bin_centers)
+        y_centers = numpy.array(self.y_bin_centers)
+        ix_pos, ix_neg = closest(x_centers, x_new_centers), closest(-x_centers, x_new_centers)
+        iy_pos, iy_neg = closest(y_centers, y_new_centers), closest(-y_centers, y_new_centers)
+
+        # Fill positive and negative quadrant per old bin, in the old (x-major) order so
+        # that later bins overwrite earlier ones exactly like a bin-by-bin fill
+        IX_pos, IY_pos = numpy.meshgrid(ix_pos, iy_pos, indexing='ij')
+        IX_neg, IY_neg = numpy.meshgrid(ix_neg, iy_neg, indexing='ij')
+        i_x_new = numpy.column_stack((IX_pos.ravel(), IX_neg.ravel())).ravel()
+        i_y_new = numpy.column_stack((IY_pos.ravel(), IY_neg.ravel())).ravel()
+        vals = numpy.repeat(self.H2_content.ravel(), 2)
+        H_array[i_x_new, i_y_new] = vals
 
         # Overwrite
-        self.H2 = H
         self.H2_array = H_array
         self.x_bin_boundaries = x_new_bounds
         self.x_bin_centers    = x_new_centers
@@ -1507,78 +1455,31 @@ class Histogram2D(BasicDrawable):
         self.y_bin_boundaries = y_new_bounds
         self.y_bin_centers    = y_new_centers
         self.n_bins_y         = y_new_nbins
+        self.H2 = self.new_H2()
+        self.update_H2()
 
-
-        # all_x_bin_boundaries = self.x_bin_boundaries
-        # all_n_bins_x = self.n_bins_x
-
-        # bounds = [ x for x in self.x_bin_boundaries if x > 0. ]
-        # self.x_bin_boundaries = bounds[::-1] + bounds
-
-        # self.n_bins_x = len(self.x_bin_boundaries)-1
-        # self.x_bin_centers = [ 0.5*(r+l) for l, r in zip(self.x_bin_boundaries[:-1], self.x_bin_boundaries[1:]) ]
-
-        # # self.H2_array = self.H2_array[-self.n_bins_x:]
-
-        # H = ROOT.TH2D(
-        #     utils.get_unique_rootname(), '',
-        #     self.n_bins_x, array('d', self.x_bin_boundaries),
-        #     self.n_bins_y, array('d', self.y_bin_boundaries),
-        #     )
-        # ROOT.SetOwnership(H, False)
-
-        # # Fill in the new hist using old hist and the padding value
-        # for i_x in xrange(self.n_bins_x):
-        #     for i_y in xrange(self.n_bins_y):
-        #         c = self.x_bin_boundaries[i_x]
-        #         if c < 0.:
-        #             pass
-
-        #         # HIER VERDER
-        #         # spiegelen afmaken
-
-        #         H.SetBinContent(i_x+1, i_y+1, fill_val)
-        # self.H2 = H
-
-
-
-    def set_value_for_patch(self, value, x_min, x_max, y_min, y_max):
+    def get_patch_slices(self, x_min, x_max, y_min, y_max):
         x_min, ix_min = differentials.core.get_closest_match(x_min, self.x_bin_centers)
         x_max, ix_max = differentials.core.get_closest_match(x_max, self.x_bin_centers)
         y_min, iy_min = differentials.core.get_closest_match(y_min, self.y_bin_centers)
         y_max, iy_max = differentials.core.get_closest_match(y_max, self.y_bin_centers)
-        # Insert patch
-        for ix in xrange(ix_min, ix_max+1):
-            for iy in xrange(iy_min, iy_max+1):
-                self.H2.SetBinContent(ix+1, iy+1, value)
+        return slice(ix_min, ix_max+1), slice(iy_min, iy_max+1)
+
+    def set_value_for_patch(self, value, x_min, x_max, y_min, y_max):
+        patch = self.get_patch_slices(x_min, x_max, y_min, y_max)
+        content = self.H2_content.copy()
+        content[patch] = value
+        self.update_H2(content)
 
     def add_offset(self, value):
-        for ix in xrange(self.n_bins_x):
-            for iy in xrange(self.n_bins_y):
-                self.H2.SetBinContent(
-                    ix+1, iy+1,
-                     self.H2.GetBinContent(ix+1, iy+1) + value
-                    )
+        self.update_H2(self.H2_content + value)
 
     def add_offset_to_zero(self):
-        z_min = 10e9
-        ix_min = -1
-        iy_min = -1
-        for ix in xrange(self.n_bins_x):
-            for iy in xrange(self.n_bins_y):
-                z = self.H2.GetBinContent(ix+1, iy+1)
-                if z < z_min:
-                    z_min = z
-                    ix_min = ix
-                    iy_min = iy
-        self.add_offset(-z_min)
+        self.add_offset(-numpy.min(self.H2_content))
 
     def smooth_patch(self, x_min, x_max, y_min, y_max):
         # Get relevant patch
-        x_min, ix_min = differentials.core.get_closest_match(x_min, self.x_bin_centers)
-        x_max, ix_max = differentials.core.get_closest_match(x_max, self.x_bin_centers)
-        y_min, iy_min = differentials.core.get_closest_match(y_min, self.y_bin_centers)
-        y_max, iy_max = differentials.core.get_closest_match(y_max, self.y_bin_centers)
+        patch = self.get_patch_slices(x_min, x_max, y_min, y_max)
 
         # Get smoothed scan for whole matrix
         smoothed = scipy.ndimage.gaussian_filter(
@@ -1586,9 +1487,9 @@ class Histogram2D(BasicDrawable):
             )
 
         # Insert patch
-        for ix in xrange(ix_min, ix_max+1):
-            for iy in xrange(iy_min, iy_max+1):
-                self.H2.SetBinContent(ix+1, iy+1, smoothed[ix][iy])
+        content = self.H2_content.copy()
+        content[patch] = smoothed[patch]
+        self.update_H2(content)
 
 
     def polyfit_patch(self, x_min, x_max, y_min, y_max, order=7):
@@ -1599,15 +1500,15 @@ class Histogram2D(BasicDrawable):
         y_min, iy_min = differentials.core.get_closest_match(y_min, self.y_bin_centers)
         y_max, iy_max = differentials.core.get_closest_match(y_max, self.y_bin_centers)
 
-        # N = (ix_max+1-ix_min) * (iy_max+1-iy_min)
-
-        T2D = ROOT.TGraph2D()
+        X, Y = numpy.meshgrid(
+            self.x_bin_centers[ix_min:ix_max+1], self.y_bin_centers[iy_min:iy_max+1], indexing='ij'
+            )
+        Z = self.H2_array[ix_min:ix_max+1, iy_min:iy_max+1]
+        T2D = ROOT.TGraph2D(
+            X.size,
+            array('d', X.ravel().tolist()), array('d', Y.ravel().tolist()), array('d', Z.ravel().tolist())
+            )
         ROOT.SetOwnership(T2D, False)
-        i_point = 0
-        for ix in xrange(ix_min, ix_max+1):
-            for iy in xrange(iy_min, iy_max+1):
-                T2D.SetPoint(i_point, self.x_bin_centers[ix], self.y_bin_centers[iy], self.H2_array[ix][iy])
-                i_point += 1
 
         polyfit_factory = differentials.spline2d.Spline2DFactory()
         polyfit_factory.x_min = x_min
@@ -1618,11 +1519,11 @@ class Histogram2D(BasicDrawable):
         polyfit = polyfit_factory.make_polyfit(T2D)
         polyfit.multiply_by_two = False
 
-        for ix in xrange(ix_min, ix_max+1):
-            for iy in xrange(iy_min, iy_max+1):
-                x = self.x_bin_centers[ix]
-                y = self.y_bin_centers[iy]
-                self.H2.SetBinContent(ix+1, iy+1, polyfit.eval(x, y))
+        content = self.H2_content.copy()
+        content[ix_min:ix_max+1, iy_min:iy_max+1] = polyfit.eval_grid(
+            self.x_bin_centers[ix_min:ix_max+1], self.y_bin_centers[iy_min:iy_max+1]
+            )
+        self.update_H2(content)
 
 
     def fill_bestfit(self, x, y):
@@ -1640,12 +1541,34 @@ class Histogram2D(BasicDrawable):
         self.H2.SetMaximum(300.0)
         return [(self.H2, 'COLZ')]
 
+    def get_contours(self, levels):
+        """
+        Returns a dict level -> list of contours (xs, ys) of the current bin contents,
+        computed with marching squares in one pass; cached as long as the contents do not change
+        """
+        x_centers = numpy.array(self.x_bin_centers, dtype=numpy.float64)
+        y_centers = numpy.array(self.y_bin_centers, dtype=numpy.float64)
+        z = numpy.ascontiguousarray(self.H2_content, dtype=numpy.float64)
+        key = hashlib.sha1(x_centers.tobytes() + y_centers.tobytes() + z.tobytes()).hexdigest()
+        if key != self._contour_cache_key:
+            self._contour_cache_key = key
+            self._contour_cache = {}
+        todo = [ level for level in levels if not level in self._contour_cache ]
+        if len(todo) > 0:
+            self._contour_cache.update(utils.get_contours_from_array(x_centers, y_centers, z, todo))
+        return { level : self._contour_cache[level] for level in levels }
+
+    def get_contour_TGraphs(self, level):
+        return utils.contours_to_TGraphs(self.get_contours([level])[level], level)
+
     def repr_high_contours(self, leg=None):
         ret = []
 
         color_cycle = itertools.cycle([1, 2, 4])
-        for level in [ 20., 50., 70., 100, 200., 500., 1000. ]:
-            Tgs = utils.get_contours_from_H2(self.H2, level)
+        levels = [ 20., 50., 70., 100, 200., 500., 1000. ]
+        self.get_contours(levels)
+        for level in levels:
+            Tgs = self.get_contour_TGraphs(level)
             labels = []
             color = color_cycle.next()
             for Tg in Tgs:
@@ -1678,7 +1601,7 @@ class Histogram2D(BasicDrawable):
         return [(Tg, 'PSAME')]
 
     def repr_1sigma_contours(self, leg=None):
-        Tgs = utils.get_contours_from_H2(self.H2, 2.30)
+        Tgs = self.get_contour_TGraphs(2.30)
         if not(self.contour_filter_method is None):
             Tgs = getattr(self.contour_filter, self.contour_filter_method)(Tgs)[:1]
         if len(Tgs) == 0:
@@ -1694,7 +1617,7 @@ class Histogram2D(BasicDrawable):
         return [ (Tg, 'LSAME') for Tg in Tgs ]
 
     def repr_2sigma_contours(self, leg=None):
-        Tgs = utils.get_contours_from_H2(self.H2, 6.18)
+        Tgs = self.get_contour_TGraphs(6.18)
         if not(self.contour_filter_method is None):
             Tgs = getattr(self.contour_filter, self.contour_filter_method)(Tgs)[:1]
         if len(Tgs) == 0:
@@ -1731,7 +1654,7 @@ class Histogram2D(BasicDrawable):
 
 
     def get_most_probable_1sigma_contour(self, cutoff=2.30):
-        allcontours = utils.get_contours_from_H2(self.H2, cutoff)
+        allcontours = self.get_contour_TGraphs(cutoff)
         if len(allcontours) == 0:
             raise RuntimeError('No contours at all found for cutoff {0}'.format(cutoff))
         candidatecontours = []
@@ -0,0 +1,103 @@
+"""
+Pure numpy/scipy radial basis function interpolator, mirroring combine's RooSplineND:
+Gaussian basis functions exp(-d^2/eps^2) centered on every input point, with
+coordinates optionally rescaled to [0, 1] using the variable ranges. The weights
+are solved once (Cholesky, falling back to LU), after which any number of points
+can be evaluated per call.
+"""
+
+import logging
+import numpy
+import scipy.linalg
+
+
+class RBFSpline(object):
+    """docstring for RBFSpline"""
+
+    eval_chunk_size = 4096
+
+    def __init__(self, points, values, eps=2.2, rescale=True, ranges=None, solve=True):
+        super(RBFSpline, self).__init__()
+        self.points = numpy.atleast_2d(numpy.asarray(points, dtype=numpy.float64))
+        if self.points.shape[0] == 1 and len(values) != 1:
+            self.points = self.points.T
+        self.values = numpy.asarray(values, dtype=numpy.float64)
+        self.ndim = self.points.shape[1]
+        self.eps = eps
+        self.rescale = rescale
+
+        if ranges is None:
+            ranges = zip(self.points.min(axis=0), self.points.max(axis=0))
+        self.ranges = numpy.asarray(ranges, dtype=numpy.float64).reshape((self.ndim, 2))
+
+        if self.points.shape[0] != len(self.values):
+            raise ValueError(
+                'Got {0} points but {1} values'.format(self.points.shape[0], len(self.values))
+                )
+        if len(self.values) == 0:
+            raise ValueError('Cannot build an RBFSpline from 0 points')
+
+        self.nodes = self.transform(self.points)
+        self.weights = None
+        if solve: self.solve()
+
+    def transform(self, points):
+        points = numpy.asarray(points, dtype=numpy.float64)
+        if self.rescale:
+            width = self.ranges[:,1] - self.ranges[:,0]
+            width[width == 0.] = 1.
+            points = (points - self.ranges[:,0]) / width
+        return points
+
+    def basis(self, points_a, points_b):
+        d2 = (
+            numpy.sum(points_a**2, axis=1)[:,None]
+            + numpy.sum(points_b**2, axis=1)[None,:]
+            - 2. * numpy.dot(points_a, points_b.T)
+            )
+        numpy.maximum(d2, 0., out=d2)
+        return numpy.exp(-d2 / self.eps**2)
+
+    def solve(self):
+        A = self.basis(self.nodes, self.nodes)
+        try:
+            self.weights = scipy.linalg.cho_solve(scipy.linalg.cho_factor(A), self.values)
+            logging.debug('Solved RBF weights for {0} points with Cholesky'.format(len(self.values)))
+        except numpy.linalg.LinAlgError:
+            logging.debug('Cholesky failed for {0} points; solving RBF weights with LU'.format(len(self.values)))
+            self.weights = scipy.linalg.lu_solve(scipy.linalg.lu_factor(A), self.values)
+
+    def evaluate(self, points):
+        """Evaluates on an (npoints, ndim) array (or (npoints,) for 1D); returns (npoints,)"""
+        points = numpy.asarray(points, dtype=numpy.float64)
+        if points.ndim == 1: points = points.reshape((-1, self.ndim))
+        points = self.transform(points)
+        r = numpy.empty(points.shape[0])
+        for i in xrange(0, points.shape[0], self.eval_chunk_size):
+            r[i:i+self.eval_chunk_size] = numpy.dot(
+                self.basis(points[i:i+self.eval_chunk_size], self.nodes), self.weights
+                )
+        return r
+
+    def __call__(self, *coordinates):
+        """Evaluates a single point, e.g. spline(x, y)"""
+        return float(self.evaluate(numpy.array([coordinates]))[0])
+
+    def save(self, path):
+        with open(path, 'wb') as fp:
+            numpy.savez(
+                fp,
+                points = self.points, values = self.values, weights = self.weights,
+                ranges = self.ranges, eps = self.eps, rescale = self.rescale
+                )
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as npz:
+            spline = cls(
+                npz['points'], npz['values'],
+                eps = float(npz['eps']), rescale = bool(npz['rescale']), ranges = npz['ranges'],
+                solve = False
+                )
+            spline.weights = npz['weights']
+        return spline
@@ -1,6 +1,6 @@
 
 import differentials
-import os, re, logging
+import os, re, time, logging, getpass
 import os.path as osp
 from glob import glob
 
@@ -9,6 +9,75 @@ from math import sqrt
 from subprocess import CalledProcessError
 
 
+def parse_qacct(output):
+    """Parses (possibly concatenated) qacct output into a list of dicts, one per job"""
+    records = []
+    for block in re.split(r'^=+\s*$', output, flags=re.MULTILINE):
+        record = {}
+        for line in block.strip().split('\n'):
+            components = line.split(None, 1)
+            if len(components) != 2: continue
+            key, value = components
+            value = value.strip()
+            try:
+                value = int(value)
+            except ValueError:
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+            record[key] = value
+        if 'jobnumber' in record:
+            records.append(record)
+    return records
+
+
+class QacctCache(object):
+    """
+    Caches qacct records by jobid. Missing jobids are fetched with a single
+    'qacct -o <user> -d <days> -j' call that lists all jobs of the user in the
+    last days, instead of one qacct call per job.
+    """
+
+    def __init__(self):
+        super(QacctCache, self).__init__()
+        self.records = {}
+        self.queried_days = 0
+        self.not_found = set()
+
+    def prefetch(self, jobids, days):
+        missing = set(jobids) - set(self.records)
+        if len(missing) == 0: return
+        # Do not query again for jobids that were not found by an equally long query
+        if days <= self.queried_days and missing <= self.not_found: return
+        cmd = 'qacct -o {0} -d {1} -j'.format(getpass.getuser(), days)
+        try:
+            output = differentials.core.execute(cmd, py_capture_output=True)
+        except CalledProcessError:
+            logging.error('Could not call {0}'.format(cmd))
+            return
+        if output is None: return # testmode
+        for record in parse_qacct(output):
+            self.records[record['jobnumber']] = record
+        self.queried_days = max(days, self.queried_days)
+        self.not_found = missing - set(self.records)
+
+    def get(self, jobid):
+        if not jobid in self.records:
+            cmd = 'qacct -j {0}'.format(jobid)
+            try:
+                output = differentials.core.execute(cmd, py_capture_output=True)
+            except CalledProcessError:
+                logging.error('Could not qacct job {0}; too old, or not yet finished?'.format(jobid))
+                return None
+            if output is None: return None # testmode
+            for record in parse_qacct(output):
+                self.records[record['jobnumber']] = record
+        return self.records.get(jobid, None)
+
+qacct_cache = QacctCache()
+
+
 
 
 class Job(object):
@@ -101,12 +170,7 @@ class Job(object):
 
     def get_qacct(self):
         if not hasattr(self, 'jobid'): self.get_jobid()
-        cmd = 'qacct -j {0}'.format(self.jobid)
-        try:
-            self.qacct = differentials.core.execute(cmd, py_capture_output=True)
-        except CalledProcessError:
-            logging.error('Could not qacct job {0}; too old, or not yet finished?'.format(self.jobid))
-            self.qacct = ''
+        self.qacct = qacct_cache.get(self.jobid)
 
 
     def is_failed(self):
@@ -118,11 +182,10 @@ class Job(object):
     def is_failed_using_qacct(self):
         if hasattr(self, '_is_failed'): return self._is_failed
         if not hasattr(self, 'qacct'): self.get_qacct()
-        match = re.search(r'failed\s+(\d+)', self.qacct)
-        if not match:
+        if self.qacct is None or not 'failed' in self.qacct:
             logging.error('Problem obtaining is_failed')
             return
-        self.status = int(match.group(1))
+        self.status = int(self.qacct['failed'])
         if self.status != 0:
             self._is_failed = True
         else:
@@ -241,7 +304,8 @@ class ScanAccountant(object):
         if hasattr(self, 'failed_jobs'): return self.failed_jobs
 
         self.failed_jobs = []
-        # logging.warning('Doing qacct for all jobs to determine exit status')
+        if not self.get_is_failed_via_done_str:
+            self.prefetch_qacct()
         for i, job in enumerate(self.jobs):
             # differentials.core.print_progress_bar(i, len(self.jobs)-1)
             if job.is_failed():
@@ -249,25 +313,26 @@ class ScanAccountant(object):
         return self.failed_jobs
 
 
+    def prefetch_qacct(self):
+        """Gets qacct records for all jobs in one go, going back to the oldest .o file"""
+        jobids = [ job.get_jobid() for job in self.jobs ]
+        if len(jobids) == 0: return
+        oldest = min(osp.getmtime(job.o_file) for job in self.jobs)
+        days = int(math.ceil((time.time() - oldest) / 86400.)) + 1
+        qacct_cache.prefetch(jobids, days)
+
     def build_ofile_cpuline_dict(self):
         self.ofile_cputime_dict = {}
         self.ofile_done_dict = {}
 
-        globpat = osp.join(self.scandir, '*.o*')
-        cpuline_cmd = 'tail -n 15 {0}'.format(globpat)
-
-        try:
-            output = differentials.core.execute(cpuline_cmd, py_capture_output=True)
-        except CalledProcessError:
-            logging.error('Could not call tail; probably no .o files in the directory.')
+        o_files = glob(osp.join(self.scandir, '*.o*'))
+        if len(o_files) == 0:
+            logging.error('No .o files in {0}'.format(self.scandir))
             return False
 
         _got_queue = False
-        for block in output.split('==> '):
-            block = block.strip()
-            if len(block) == 0: continue
-            o_file = block.split('<==')[0].strip()
-
+        for o_file in o_files:
+            block = ''.join(tail(o_file, 15))
             key = osp.basename(o_file)
 
             cputime = CPUTime().from_combine_output(block)
@@ -293,15 +358,11 @@ class ScanAccountant(object):
         return True
 
     def build_shfile_combineline_dict(self):
-        globpat = osp.join(self.scandir, '*.sh')
-        cpuline_cmd = 'tail -n 2 {0}'.format(globpat)
-        output = differentials.core.execute(cpuline_cmd, py_capture_output=True)
         self.shfile_combineline_dict = {}
-        for block in output.split('==> '):
-            sh_file = block.split('<==')[0].strip()
-            for line in block.split('\n'):
+        for sh_file in glob(osp.join(self.scandir, '*.sh')):
+            for line in tail(sh_file, 2):
                 if line.startswith('eval combine'):
-                    self.shfile_combineline_dict[osp.basename(sh_file)] = line
+                    self.shfile_combineline_dict[osp.basename(sh_file)] = line.rstrip('\n')
 
     def produce_statistics(self):
         if self.only_good_jobs:
@@ -510,12 +571,22 @@ def fixed_length_basename(s, max_length=30):
     return fixed_length_string(s, max_length)
 
 
-def tail(f, n):
-    stdin,stdout = os.popen2("tail -n "+str(n)+" "+f)
-    stdin.close()
-    lines = stdout.readlines()
-    stdout.close()
-    return lines
+def tail(f, n, block_size=4096):
+    """Returns the last n lines of file f, reading backwards from the end in blocks"""
+    with open(f, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        end = fp.tell()
+        data = ''
+        position = end
+        # n+1 newlines are needed to be sure the first of the n lines is complete
+        while position > 0 and data.count('\n') <= n:
+            read_size = min(block_size, position)
+            position -= read_size
+            fp.seek(position)
+            data = fp.read(read_size) + data
+    lines = data.splitlines(True)
+    if len(lines) > 0 and lines[-1] == '': lines.pop()
+    return lines[-n:]
 
 def std(X, mean):
     N = len(X)
@@ -0,0 +1,122 @@
+"""
+Persistent on-disk cache for scan columns read from higgsCombine*.root files.
+
+Every entry is a single .npz file holding the (misfit-filtered, sorted) columns
+that ScanPrimitive.read_columns produced, plus the fingerprint (path, size,
+mtime, inode) of every root file that was read. An entry is only used if the
+fingerprint of the current list of root files matches exactly. The total size
+of the cache is kept under a cap by evicting the least recently used entries.
+"""
+
+import os, glob, json, hashlib, tempfile
+import logging
+
+import numpy
+
+
+class ScanCache(object):
+    """docstring for ScanCache"""
+
+    default_cache_dir = 'scancache'
+    default_max_size_bytes = 2 * 1024**3
+
+    def __init__(self, cache_dir=None, max_size_bytes=None):
+        super(ScanCache, self).__init__()
+        self.cache_dir = self.default_cache_dir if cache_dir is None else cache_dir
+        self.max_size_bytes = self.default_max_size_bytes if max_size_bytes is None else max_size_bytes
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def fingerprint(self, root_files):
+        fingerprint = []
+        for root_file in sorted(root_files):
+            stat = os.stat(root_file)
+            fingerprint.append([ os.path.abspath(root_file), stat.st_size, stat.st_mtime, stat.st_ino ])
+        return json.dumps(fingerprint)
+
+    def key(self, root_files, globpat, variables, **kwargs):
+        """
+        Identifies a read by the scan directories the root files live in, the glob
+        pattern and the requested variables (plus any other read options in kwargs)
+        """
+        scandirs = sorted(set( os.path.dirname(os.path.abspath(f)) for f in root_files ))
+        key = json.dumps([ scandirs, globpat, list(variables), sorted(kwargs.items()) ])
+        return hashlib.sha1(key).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key, fingerprint):
+        """Returns the dict of cached columns, or None if absent or stale"""
+        path = self.path(key)
+        if not os.path.isfile(path):
+            self.n_misses += 1
+            return None
+        try:
+            with numpy.load(path) as npz:
+                if str(npz['_fingerprint']) != fingerprint:
+                    logging.debug('Scan cache entry {0} is stale; root files changed'.format(path))
+                    self.n_misses += 1
+                    return None
+                columns = { name[4:] : npz[name] for name in npz.files if name.startswith('col_') }
+        except Exception as e:
+            logging.warning('Could not read scan cache entry {0} ({1}); ignoring it'.format(path, e))
+            self.n_misses += 1
+            return None
+        # Bump the mtime so eviction is least-recently-used
+        os.utime(path, None)
+        self.n_hits += 1
+        logging.debug('Read {0} points from scan cache entry {1}'.format(
+            len(columns.values()[0]) if len(columns) > 0 else 0, path))
+        return columns
+
+    def store(self, key, fingerprint, columns):
+        if not os.path.isdir(self.cache_dir): os.makedirs(self.cache_dir)
+        arrays = { 'col_' + name : numpy.asarray(values) for name, values in columns.iteritems() }
+        arrays['_fingerprint'] = numpy.array(fingerprint)
+        # Write to a temporary file first so a crash never leaves a half-written entry
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                numpy.savez(fp, **arrays)
+            os.rename(tmp_path, self.path(key))
+        except:
+            if os.path.isfile(tmp_path): os.remove(tmp_path)
+            raise
+        logging.debug('Stored scan cache entry {0}'.format(self.path(key)))
+        self.evict()
+
+    def entries(self):
+        return glob.glob(os.path.join(self.cache_dir, '*.npz'))
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in self.entries())
+
+    def evict(self):
+        """Removes least recently used entries until the cache is below max_size_bytes"""
+        entries = [ (os.path.getmtime(path), os.path.getsize(path), path) for path in self.entries() ]
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size_bytes: break
+            logging.debug('Evicting scan cache entry {0}'.format(path))
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for path in self.entries():
+            os.remove(path)
+
+
+_CACHE = None
+
+def enable(cache_dir=None, max_size_bytes=None):
+    global _CACHE
+    _CACHE = ScanCache(cache_dir, max_size_bytes)
+    logging.info('Scan cache enabled in {0}'.format(_CACHE.cache_dir))
+
+def disable():
+    global _CACHE
+    _CACHE = None
+
+def get_cache():
+    return _CACHE
@@ -0,0 +1,323 @@
+"""
+Completeness index for split-point scans: which grid points have a result, in
+which output file, across the original scan directory and its rescans
+(<scandir>_rescan_<date>, see rescan.py).
+
+The jobs are taken from the .sh files ('eval combine ...' lines with -n and
+--firstPoint/--lastPoint or --doPoints). Combine drops points of which the fit
+failed (no --keepFailures), so the entries of the limit tree in a job's
+higgsCombine<name>.*.root file are matched to grid points by their POI values,
+using the grid of --points and --setPhysicsModelParameterRanges (bin centers,
+as in combine's --algo=grid, for 1 or 2 POIs). If that is not possible, the
+entries are assumed to follow the order of the job's points; a file with fewer
+entries than points is then unreliable, and all its points count as missing.
+The best fit (quantileExpected == -1) is an extra entry.
+Every point gets a status:
+- 'ok'      : there is an entry with a proper deltaNLL
+- 'misfit'  : the entry has deltaNLL == 9990. (or > 1e9)
+- 'missing' : no output file, or no entry for the point (failed fit, crashed job)
+
+The index is stored as completeness.json in the scan directory. update() only
+reads root files that are new or changed (size, mtime) since the last update,
+so it can be called repeatedly while jobs are still finishing.
+"""
+
+import os, re, json, fnmatch
+import os.path as osp
+import logging
+from glob import glob
+
+import numpy
+
+import core
+from scan_accounting import tail
+from scans import get_columns_from_tree
+
+
+OK = 'ok'
+MISFIT = 'misfit'
+MISSING = 'missing'
+
+
+def get_rescan_dirs(scandir):
+    scandir = scandir.rstrip('/')
+    return sorted(glob(scandir + '_rescan_*'))
+
+
+class IndexedJob(object):
+    """docstring for IndexedJob"""
+
+    def __init__(self, sh_file, combine_command):
+        super(IndexedJob, self).__init__()
+        self.sh_file = sh_file
+        self.combine_command = combine_command
+        self.name = re.search(r'\s-n\s+(\S+)', combine_command).group(1)
+        self.points = self.get_points()
+        self.POIs, self.POI_ranges, self.n_grid_points = self.get_grid()
+
+    def get_points(self):
+        match = re.search(r'--doPoints ([\d,]+)', self.combine_command)
+        if match:
+            return [ int(i) for i in match.group(1).split(',') ]
+        match_first = re.search(r'--firstPoint (\d+)', self.combine_command)
+        match_last = re.search(r'--lastPoint (\d+)', self.combine_command)
+        if match_first and match_last:
+            return range(int(match_first.group(1)), int(match_last.group(1))+1)
+        logging.warning('Could not determine points for {0}'.format(self.sh_file))
+        return []
+
+    def get_grid(self):
+        """Returns (POIs, [ (min, max) per POI ], points of the grid); None for what cannot be found"""
+        POIs = re.findall(r'(?:^|\s)-P\s+(\S+)', self.combine_command)
+        match = re.search(r'--points[= ](\d+)', self.combine_command)
+        n_grid_points = int(match.group(1)) if match else None
+        ranges = {}
+        for match in re.finditer(r'--set(?:PhysicsModel)?ParameterRanges[= ](\S+)', self.combine_command):
+            for parstr in match.group(1).split(':'):
+                name, values = parstr.split('=', 1)
+                ranges[name] = tuple(float(v) for v in values.split(','))
+        POI_ranges = [ ranges[POI] for POI in POIs ] if all(POI in ranges for POI in POIs) else None
+        return POIs, POI_ranges, n_grid_points
+
+    def has_grid(self):
+        return len(self.POIs) in [ 1, 2 ] and not(self.POI_ranges is None) and not(self.n_grid_points is None)
+
+    def grid_points(self, coordinates, tolerance=1e-3):
+        """
+        Grid point of every row of coordinates (one column per POI), following
+        combine's --algo=grid; None if a row is not within tolerance (in units of
+        the grid spacing) of a grid point
+        """
+        if len(self.POIs) == 1:
+            n_per_dim = [ self.n_grid_points ]
+        else:
+            n_per_dim = [ int(numpy.ceil(numpy.sqrt(self.n_grid_points))) ] * 2
+        indices = []
+        for i_POI, ((left, right), n) in enumerate(zip(self.POI_ranges, n_per_dim)):
+            width = (right - left) / float(n)
+            continuous = (coordinates[:,i_POI] - left) / width - 0.5
+            index = numpy.round(continuous)
+            if numpy.any(numpy.abs(continuous - index) > tolerance) or numpy.any(index < 0) or numpy.any(index >= n):
+                return None
+            indices.append(index.astype(int))
+        if len(indices) == 1: return indices[0]
+        return indices[0] * n_per_dim[1] + indices[1]
+
+    def get_root_files(self):
+        return sorted(glob(osp.join(osp.dirname(self.sh_file), 'higgsCombine{0}.*.root'.format(self.name))))
+
+
+class CompletenessIndex(object):
+    """docstring for CompletenessIndex"""
+
+    index_file_name = 'completeness.json'
+    # Bump when the way points are matched to entries changes, so old indices are rebuilt
+    index_version = 2
+    tree_name = 'limit'
+
+    def __init__(self, scandir, include_rescans=True):
+        super(CompletenessIndex, self).__init__()
+        self.scandir = osp.abspath(scandir.rstrip('/'))
+        self.scandirs = [ self.scandir ]
+        if include_rescans: self.scandirs.extend([ osp.abspath(d) for d in get_rescan_dirs(self.scandir) ])
+        self.index_file = osp.join(self.scandir, self.index_file_name)
+        self.jobs = []
+        # root file -> { 'size', 'mtime', 'points' : [ [point, i_entry, status], ... ], 'i_bestfit' }
+        self.files = {}
+        self.load()
+
+    def load(self):
+        if not osp.isfile(self.index_file): return
+        try:
+            with open(self.index_file, 'r') as fp:
+                index = json.load(fp)
+            if index.get('version', 1) != self.index_version:
+                logging.info('{0} is outdated; rebuilding the index'.format(self.index_file))
+                return
+            self.files = index['files']
+        except (ValueError, KeyError) as e:
+            logging.warning('Could not read {0} ({1}); rebuilding the index'.format(self.index_file, e))
+            self.files = {}
+
+    def dump(self):
+        # Unique per process, so that two processes updating the index of the same
+        # scan do not write to the same temporary file
+        tmp_file = '{0}.{1}.tmp'.format(self.index_file, os.getpid())
+        with open(tmp_file, 'w') as fp:
+            json.dump({ 'version' : self.index_version, 'scandirs' : self.scandirs, 'files' : self.files }, fp)
+        os.rename(tmp_file, self.index_file)
+
+    def read_jobs(self):
+        self.jobs = []
+        for scandir in self.scandirs:
+            for sh_file in sorted(glob(osp.join(scandir, '*.sh'))):
+                for line in tail(sh_file, 2):
+                    if line.startswith('eval combine'):
+                        self.jobs.append(IndexedJob(osp.abspath(sh_file), line.strip()))
+                        break
+        return self.jobs
+
+    def read_root_file(self, root_file, job):
+        """Returns the index record for root_file, given the job that made it"""
+        stat = os.stat(root_file)
+        record = { 'size' : stat.st_size, 'mtime' : stat.st_mtime, 'points' : [], 'i_bestfit' : None }
+        variables = [ 'quantileExpected', 'deltaNLL' ]
+        if job.has_grid(): variables.extend(job.POIs)
+        try:
+            with core.openroot(root_file) as root_fp:
+                tree = root_fp.Get(self.tree_name)
+                if not tree:
+                    raise RuntimeError('no tree {0}'.format(self.tree_name))
+                columns = get_columns_from_tree(tree, variables)
+        except Exception as e:
+            logging.warning('Could not read {0} ({1}); treating its points as missing'.format(root_file, e))
+            columns = { variable : numpy.zeros(0) for variable in variables }
+
+        is_bestfit = columns['quantileExpected'] == -1.
+        i_bestfits = numpy.nonzero(is_bestfit)[0]
+        if len(i_bestfits) > 0: record['i_bestfit'] = int(i_bestfits[0])
+        i_entries = numpy.nonzero(~is_bestfit)[0]
+
+        # Entry per point of the job
+        entry_for_point = {}
+        entry_points = None
+        if job.has_grid():
+            entry_points = job.grid_points(numpy.column_stack([ columns[POI][i_entries] for POI in job.POIs ]))
+            if entry_points is None:
+                logging.warning('Entries of {0} are not on the grid of {1}'.format(root_file, job.sh_file))
+        if not(entry_points is None):
+            job_points = set(job.points)
+            for i_entry, point in zip(i_entries, entry_points):
+                if not point in job_points:
+                    logging.warning('{0} has an entry for point {1}, which is not a point of its job'.format(root_file, point))
+                    continue
+                entry_for_point.setdefault(int(point), int(i_entry))
+        elif len(i_entries) == len(job.points):
+            entry_for_point = { point : int(i_entry) for point, i_entry in zip(job.points, i_entries) }
+        else:
+            logging.warning(
+                '{0} has {1} entries for {2} points, and they cannot be matched to the grid; '
+                'treating all its points as missing'
+                .format(root_file, len(i_entries), len(job.points))
+                )
+
+        deltaNLLs = columns['deltaNLL']
+        for point in job.points:
+            if not point in entry_for_point:
+                record['points'].append([ point, None, MISSING ])
+                continue
+            i_entry = entry_for_point[point]
+            deltaNLL = deltaNLLs[i_entry]
+            status = MISFIT if (deltaNLL == 9990. or deltaNLL > 1e9) else OK
+            record['points'].append([ point, i_entry, status ])
+        return record
+
+    def update(self):
+        """Re-reads the jobs and all new or changed root files; returns the number of files read"""
+        n_read = 0
+        found_root_files = set()
+        for job in self.read_jobs():
+            for root_file in job.get_root_files():
+                found_root_files.add(root_file)
+                stat = os.stat(root_file)
+                record = self.files.get(root_file, None)
+                if not(record is None) and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+                    continue
+                self.files[root_file] = self.read_root_file(root_file, job)
+                n_read += 1
+        for root_file in self.files.keys():
+            if not root_file in found_root_files: del self.files[root_file]
+        logging.info('Read {0} new or changed root files for {1}'.format(n_read, self.scandir))
+        self.dump()
+        return n_read
+
+    def point_statuses(self, globpat='*'):
+        """
+        Returns { (scan, point) : (status, root_file, i_entry) } over all jobs of which
+        the root files match globpat, with scan the job name without split-point and
+        rescan suffixes. A point that is ok in any file is ok; for duplicates, the
+        first file (original scan before rescans) is used.
+        """
+        statuses = {}
+        for job in self.jobs:
+            if not fnmatch.fnmatch('higgsCombine{0}.root'.format(job.name), globpat + '.root'):
+                continue
+            scan_key = self.get_scan_key(job)
+            for point in job.points:
+                if not (scan_key, point) in statuses: statuses[(scan_key, point)] = (MISSING, None, None)
+            for root_file in job.get_root_files():
+                if not root_file in self.files: continue
+                for point, i_entry, status in self.files[root_file]['points']:
+                    current = statuses[(scan_key, point)][0]
+                    if current == OK or (current == MISFIT and status == MISSING): continue
+                    statuses[(scan_key, point)] = (status, root_file, i_entry)
+        return statuses
+
+    def missing_points_per_job(self, include_misfits=True):
+        """
+        Returns a list of (sh_file, points) of the jobs in the original scan directory
+        with points that have no result, neither from the job itself nor from a rescan
+        """
+        bad = [ MISSING, MISFIT ] if include_misfits else [ MISSING ]
+        statuses = self.point_statuses()
+        missing = []
+        for job in self.jobs:
+            if osp.dirname(job.sh_file) != self.scandir: continue
+            scan_key = self.get_scan_key(job)
+            points = [ p for p in job.points if statuses[(scan_key, p)][0] in bad ]
+            if len(points) > 0: missing.append((job.sh_file, points))
+        return missing
+
+    def get_scan_key(self, job):
+        """Name of the scan a job belongs to: strips the split-point and rescan suffixes"""
+        return re.sub(r'(_chunk\d+|\.POINTS\.\d+\.\d+)', '', job.name)
+
+    def summary(self, globpat='*'):
+        statuses = [ status for status, _, _ in self.point_statuses(globpat).itervalues() ]
+        return {
+            OK      : statuses.count(OK),
+            MISFIT  : statuses.count(MISFIT),
+            MISSING : statuses.count(MISSING),
+            }
+
+    def log_summary(self, globpat='*'):
+        summary = self.summary(globpat)
+        logging.info(
+            '{0} (+{1} rescans): {2} points ok, {3} misfits, {4} missing'
+            .format(self.scandir, len(self.scandirs)-1, summary[OK], summary[MISFIT], summary[MISSING])
+            )
+
+    def merged_columns(self, variables, globpat='*'):
+        """
+        Reads variables for exactly one entry per ok point (plus one best fit entry)
+        of the jobs matching globpat; returns a dict of columns
+        """
+        entries_per_file = {}
+        for status, root_file, i_entry in self.point_statuses(globpat).itervalues():
+            if status != OK: continue
+            entries_per_file.setdefault(root_file, []).append(i_entry)
+        if len(entries_per_file) == 0:
+            raise RuntimeError('No ok points in {0} for globpat {1}'.format(self.scandir, globpat))
+
+        # Take the best fit from the first file (original scan before rescans) that has one
+        for root_file in sorted(entries_per_file, key=self.file_order):
+            i_bestfit = self.files[root_file]['i_bestfit']
+            if not(i_bestfit is None):
+                entries_per_file[root_file].append(i_bestfit)
+                break
+        else:
+            logging.warning('No best fit entry found in {0} for globpat {1}'.format(self.scandir, globpat))
+
+        columns = { variable : [] for variable in variables }
+        for root_file in sorted(entries_per_file, key=self.file_order):
+            i_entries = numpy.array(sorted(entries_per_file[root_file]), dtype=int)
+            with core.openroot(root_file) as root_fp:
+                file_columns = get_columns_from_tree(root_fp.Get(self.tree_name), variables)
+            for variable in variables:
+                columns[variable].append(file_columns[variable][i_entries])
+        return { variable : numpy.concatenate(arrays) for variable, arrays in columns.iteritems() }
+
+    def file_order(self, root_file):
+        for i, scandir in enumerate(self.scandirs):
+            if osp.dirname(root_file) == scandir: return (i, root_file)
+        return (len(self.scandirs), root_file)
@@ -1,5 +1,6 @@
 import os.path
-import glob, re, copy, math, sys, tempfile
+import glob, re, copy, math, sys, tempfile, traceback
+import multiprocessing
 
 import logging
 import core
@@ -9,13 +10,70 @@ import plotting.plotting_utils as utils
 from uncertaintycalculator import UncertaintyCalculator
 from spline2d import Spline2DFactory
 from onedimscanfilter import OneDimScanFilter
+import scancache
 
 from collections import namedtuple
 from array import array
+import numpy
 
 import ROOT
 
 
+def get_columns_from_tree(tree, variables, n_per_draw=4):
+    """
+    Reads branches from a TTree/TChain into numpy float64 arrays, using
+    TTree::Draw with 'goff' and the GetV1..GetV4 buffers (max 4 variables per Draw)
+    """
+    n_entries = tree.GetEntries()
+    tree.SetEstimate(n_entries + 1)
+    columns = {}
+    for i_start in xrange(0, len(variables), n_per_draw):
+        draw_variables = variables[i_start:i_start+n_per_draw]
+        n_drawn = tree.Draw(':'.join(draw_variables), '', 'goff')
+        if n_drawn != n_entries:
+            raise RuntimeError(
+                'Drew {0} entries for {1}, but tree has {2} entries'
+                .format(n_drawn, draw_variables, n_entries)
+                )
+        for i_var, var_name in enumerate(draw_variables):
+            buf = getattr(tree, 'GetV{0}'.format(i_var+1))()
+            columns[var_name] = buffer_to_array(buf, n_drawn)
+    return columns
+
+def buffer_to_array(buf, n):
+    """Copies n doubles from a PyROOT buffer into a numpy array"""
+    if n == 0:
+        return numpy.zeros(0)
+    if hasattr(buf, 'SetSize'):
+        # Old-style PyROOT buffer
+        buf.SetSize(n)
+    else:
+        buf.reshape((n,))
+    return numpy.array(numpy.frombuffer(buf, dtype=numpy.float64, count=n))
+
+
+def read_scan_columns(task):
+    """
+    Worker for DifferentialSpectrum.read: reads the columns of a single POI.
+    Returns (POI, columns, scandirs, error); never raises, so one broken POI
+    does not take down the pool.
+    """
+    POI, scandirs, root_files, completeness_index = task
+    try:
+        scan = Scan(x_variable=POI, y_variable='deltaNLL', globpat=POI)
+        scan.scandirs.extend(scandirs)
+        scan.root_files.extend(root_files)
+        if completeness_index is None:
+            columns = scan.read_columns(scan.collect_root_files(), [ scan.x_variable, scan.y_variable ])
+        else:
+            # The index was updated by the caller; only read it here
+            scan.completeness_index = completeness_index
+            columns = scan.read_merged([ scan.x_variable, scan.y_variable ], update=False).columns
+        return POI, columns, scan.scandirs, None
+    except Exception:
+        return POI, None, scandirs, traceback.format_exc()
+
+
 def glob_rootfiles(d):
     if not d.endswith('/'): d += '/'
     return glob.glob(d + '*.root')
@@ -23,6 +81,188 @@ def glob_rootfiles(d):
 Unc = namedtuple('Unc', ['min_deltaNLL', 'i_min', 'x_min', 'left_bound', 'left_error', 'right_bound', 'right_error', 'symm_error', 'well_defined_left_bound', 'well_defined_right_bound', 'is_hopeless', 'cutoff_1sigma'])
 
 
+class ScanRow(object):
+    """
+    Lightweight view on a single row of a ScanTable, so that legacy code can
+    keep doing entry.x / entry['deltaNLL'] / entry.x = ...
+    """
+    __slots__ = ['_table', '_i']
+
+    def __init__(self, table, i):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_i', i)
+
+    def __getattr__(self, name):
+        try:
+            return self._table.get(name, self._i)
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._table.set(name, self._i, value)
+
+    def __getitem__(self, name):
+        return self._table.get(name, self._i)
+
+    def __setitem__(self, name, value):
+        self._table.set(name, self._i, value)
+
+    def __contains__(self, name):
+        return self._table.has_column(name)
+
+    def keys(self):
+        return self._table.keys()
+
+    def as_dict(self):
+        return core.AttrDict((key, self._table.get(key, self._i)) for key in self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, ScanRow):
+            if other._table is self._table: return other._i == self._i
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not(self == other)
+
+    def __repr__(self):
+        return 'ScanRow({0})'.format(dict(self.as_dict()))
+
+
+class ScanTable(object):
+    """
+    Struct-of-arrays container for scan points: one float64 numpy array per
+    named column, plus aliases (e.g. 'x' -> 'r_smH_PTH_0_15') that point to
+    the same array. Integer indexing returns a ScanRow, slicing returns a
+    zero-copy view, boolean masks and index arrays return a new table.
+    Writes should go through set/set_column, so that the cached best fit of the
+    table and of all views on the same arrays is invalidated.
+    """
+
+    def __init__(self, columns=None, aliases=None):
+        self.columns = {}
+        self.aliases = {}
+        self._n = 0
+        self._i_bestfit = None
+        # Write counter, shared with all slice views on the same arrays
+        self._version = [0]
+        self._i_bestfit_version = None
+        if not(columns is None):
+            for name, values in columns.iteritems():
+                self.columns[name] = numpy.asarray(values, dtype=numpy.float64)
+            lengths = list(set(len(values) for values in self.columns.itervalues()))
+            if len(lengths) > 1:
+                raise ValueError('Columns have unequal lengths: {0}'.format(lengths))
+            if len(lengths) == 1: self._n = lengths[0]
+        if not(aliases is None):
+            for alias, name in aliases.iteritems():
+                self.add_alias(alias, name)
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Builds a table from a list of dict-like entries (e.g. core.AttrDict)"""
+        if isinstance(entries, ScanTable): return entries
+        entries = list(entries)
+        if len(entries) == 0: return cls()
+        keys = entries[0].keys()
+        return cls({ key : [ entry[key] for entry in entries ] for key in keys })
+
+    def add_alias(self, alias, name):
+        if alias == name: return
+        if not name in self.columns:
+            raise KeyError('Cannot alias {0} to unknown column {1}'.format(alias, name))
+        self.aliases[alias] = name
+
+    def resolve(self, name):
+        return self.aliases.get(name, name)
+
+    def unalias(self, alias):
+        """Turns an alias into a column of its own, with a copy of the values"""
+        if not alias in self.aliases: return
+        self.columns[alias] = self.columns[self.aliases.pop(alias)].copy()
+
+    def has_column(self, name):
+        return self.resolve(name) in self.columns
+
+    def keys(self):
+        return self.columns.keys() + self.aliases.keys()
+
+    def column(self, name):
+        return self.columns[self.resolve(name)]
+
+    def set_column(self, name, values):
+        name = self.resolve(name)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if len(self.columns) > 0 and len(values) != self._n:
+            raise ValueError('Column {0} has length {1}, table has {2} rows'.format(name, len(values), self._n))
+        self.columns[name] = values
+        self._n = len(values)
+        self.invalidate()
+
+    def get(self, name, i):
+        return float(self.column(name)[i])
+
+    def set(self, name, i, value):
+        self.columns[self.resolve(name)][i] = value
+        self.invalidate()
+
+    def invalidate(self):
+        self._version[0] += 1
+        self._i_bestfit = None
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for i in xrange(self._n):
+            yield ScanRow(self, i)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, numpy.integer)):
+            if key < 0: key += self._n
+            if key < 0 or key >= self._n:
+                raise IndexError('Row {0} out of range for table with {1} rows'.format(key, self._n))
+            return ScanRow(self, key)
+        table = ScanTable(
+            { name : values[key] for name, values in self.columns.iteritems() },
+            self.aliases
+            )
+        if isinstance(key, slice):
+            # A view on the same arrays; writes to either must invalidate both
+            table._version = self._version
+        return table
+
+    def take(self, indices):
+        return self[numpy.asarray(indices, dtype=int)]
+
+    def mask(self, fn):
+        """Boolean mask from a per-row function (slow path for legacy lambdas)"""
+        return numpy.array([ bool(fn(row)) for row in self ], dtype=bool)
+
+    def bestfit_index(self):
+        """Index of deltaNLL == 0., or the value closest to 0. if there is none; cached"""
+        if self._i_bestfit is None or self._i_bestfit_version != self._version[0]:
+            self._i_bestfit_version = self._version[0]
+            deltaNLLs = self.column('deltaNLL')
+            i_zero = numpy.nonzero(deltaNLLs == 0.0)[0]
+            if len(i_zero) > 0:
+                self._i_bestfit = int(i_zero[0])
+            else:
+                self._i_bestfit = int(numpy.argmin(numpy.abs(deltaNLLs)))
+        return self._i_bestfit
+
+    def bestfit(self):
+        return self[self.bestfit_index()]
+
+    def to_entries(self):
+        """Converts to a list of core.AttrDict, for code that needs real dicts"""
+        keys = self.keys()
+        return [
+            core.AttrDict(zip(keys, values)) for values in
+            zip(*[ self.column(key).tolist() for key in keys ])
+            ]
+
+
 class DifferentialSpectrum(object):
     """Essentially a collection of Scan instances, 1 per POI that was scanned"""
     standard_titles = {
@@ -34,6 +274,8 @@ class DifferentialSpectrum(object):
         }
 
     default_style = plotting.pywrappers.StyleSheet()
+    n_read_workers = 1
+    use_completeness_index = False
 
     def __init__(self, name, scandirs=None, POIs=None):
         self.name = name
@@ -71,6 +313,8 @@ class DifferentialSpectrum(object):
         self.stylesheets = [ DifferentialSpectrum.default_style.copy() ]
 
         self.root_files_for_POI = {}
+        # POI -> traceback, for the POIs that could not be read
+        self.failed_POIs = {}
 
     def add_POI(self, POI, root_files):
         self.POIs.append(POI)
@@ -122,30 +366,104 @@ class DifferentialSpectrum(object):
         # else:
         #     self.POIs = self.get_POIs_from_datacard()
 
-    def read(self):
+    def read(self, n_workers=None):
+        """
+        Reads one Scan per POI. With n_workers > 1 the POIs are read in a process
+        pool; workers send back numpy columns only. A POI that fails to read is
+        logged and does not stop the others; it keeps its place in the spectrum
+        (so the binning is unchanged) as a scan without points and with NaN
+        uncertainties, and is listed in self.failed_POIs.
+        With use_completeness_index, points that were redone in a rescan are taken
+        only once (see scancompleteness.CompletenessIndex).
+        Returns the POIs that were read successfully.
+        """
         if self._is_read:
             raise RuntimeError('Scan {0} is already read'.format(self.name))
+        if len(self.POIs)==0:
+            self.get_POIs()
+        if n_workers is None: n_workers = self.n_read_workers
+
+        completeness_index = self.get_completeness_index() if self.use_completeness_index else None
+        tasks = [
+            (POI, self.scandirs, self.root_files_for_POI.get(POI, []),
+                None if POI in self.root_files_for_POI else completeness_index)
+            for POI in self.POIs
+            ]
+        if n_workers > 1 and len(tasks) > 1:
+            logging.info('Reading {0} POIs of {1} with {2} workers'.format(len(tasks), self.name, n_workers))
+            pool = multiprocessing.Pool(min(n_workers, len(tasks)))
+            try:
+                results = pool.map(read_scan_columns, tasks)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            if len(self.POIs)==0:
-                self.get_POIs()
-            for POI in self.POIs:
-                scan = Scan(
-                    x_variable=POI,
-                    y_variable='deltaNLL',
-                    globpat=POI
+            results = map(read_scan_columns, tasks)
+
+        self.failed_POIs = {}
+        for POI, columns, scandirs, error in results:
+            if error is None:
+                try:
+                    scan = self.make_scan(POI, scandirs, columns)
+                except Exception:
+                    error = traceback.format_exc()
+            if not(error is None):
+                logging.error(
+                    'Could not read scan for POI {0} (scandirs: {1}) of {2}:\n{3}'
+                    .format(POI, ', '.join(scandirs), self.name, error)
                     )
-                scan.scandirs.extend(self.scandirs)
-                scan.root_files.extend(self.root_files_for_POI.get(POI, []))
-                scan.read()
-                scan.create_uncertainties()
-                self.scans.append(scan)
-            self._is_read = True
+                self.failed_POIs[POI] = error
+                scan = self.make_failed_scan(POI, scandirs)
+            self.scans.append(scan)
+
+        if len(self.failed_POIs) > 0:
+            logging.error(
+                'Failed to read {0} of {1} POIs for {2}: {3}'
+                .format(len(self.failed_POIs), len(self.POIs), self.name, ', '.join(sorted(self.failed_POIs.keys())))
+                )
+        self._is_read = True
+        return [ POI for POI in self.POIs if not POI in self.failed_POIs ]
+
+    def get_completeness_index(self):
+        """Builds and updates the completeness index once for all POIs; None if there is not exactly one scandir"""
+        if len(self.scandirs) != 1:
+            logging.warning(
+                'Not using a completeness index for {0}; needs exactly one scandir, found {1}'
+                .format(self.name, len(self.scandirs))
+                )
+            return None
+        # Imported here; scancompleteness itself imports from this module
+        import scancompleteness
+        completeness_index = scancompleteness.CompletenessIndex(self.scandirs[0])
+        completeness_index.update()
+        return completeness_index
+
+    def make_scan(self, POI, scandirs, columns):
+        scan = Scan(x_variable=POI, y_variable='deltaNLL', globpat=POI)
+        scan.scandirs.extend(scandirs)
+        scan.set_entries_from_columns(columns)
+        scan.create_uncertainties()
+        return scan
+
+    def make_failed_scan(self, POI, scandirs):
+        """Placeholder for a POI that could not be read: no points, NaN uncertainties"""
+        scan = Scan(x_variable=POI, y_variable='deltaNLL', globpat=POI)
+        scan.scandirs.extend(scandirs)
+        scan.entries = ScanTable()
+        nan = float('nan')
+        scan.unc = Unc(
+            min_deltaNLL=nan, i_min=None, x_min=nan,
+            left_bound=nan, left_error=nan, right_bound=nan, right_error=nan, symm_error=nan,
+            well_defined_left_bound=False, well_defined_right_bound=False, is_hopeless=True,
+            cutoff_1sigma=nan
+            )
+        return scan
 
     def plot_scans(self, plotname=None):
         if plotname is None:
             plotname = 'scans_{0}'.format(self.name)
         plot = plotting.plots.MultiScanPlot(plotname)
-        plot.scans = self.scans
+        plot.scans = [ s for s in self.scans if not s.x_variable in self.failed_POIs ]
         plot.x_min = self.scans_x_min
         plot.x_max = self.scans_x_max
         plot.y_min = self.scans_y_min
@@ -317,15 +635,20 @@ class ScanPrimitive(object):
     tree_name = 'limit'
     filter_negatives = True
     deltaNLL_threshold = -0.01
+    # Spline backend for to_spline: 'roosplinend' (needs the chain) or 'numpy'
+    spline_backend = 'roosplinend'
 
     def __init__(self):
         self.scandirs = []
         self.root_files = []
         self.save_all_variables = False
-        self.entries = []
+        self.entries = ScanTable()
         self.globpat = '*'
 
         self.read_one_scandir = True
+        # Optional scancompleteness.CompletenessIndex; if set, read() takes one entry
+        # per point from the index (merging rescans) instead of globbing root files
+        self.completeness_index = None
 
 
     def collect_root_files(self):
@@ -385,7 +708,11 @@ class ScanPrimitive(object):
                 )
         return variables                            
 
-    def read_chain(self, root_files, variables, filter_x=False, return_chain=False):
+    def read_columns(self, root_files, variables, filter_x=False, return_chain=False):
+        """
+        Reads the requested branches in bulk into numpy arrays (one per variable),
+        applies the misfit filter and sorts on (x, y). Returns a dict of columns.
+        """
         if len(root_files) == 0:
             raise RuntimeError(
                 'No root files were passed to read_chain; scandirs = {0}'.format(self.scandirs)
@@ -395,38 +722,87 @@ class ScanPrimitive(object):
         for root_file in root_files:
             chain.Add(root_file)
 
-        # Entry = namedtuple('Entry', variables + ['x', 'y'] + (['z'] if hasattr(self, 'z_variable') else []))
-
-        entries = []
-        for event in chain:
-            if filter_x and getattr(event, self.x_variable) in [e.x for e in entries]: continue
-            # entry_dict = {}
-            entry_dict = core.AttrDict()
-            for var_name in variables:
-                entry_dict[var_name] = getattr(event, var_name)
-                if var_name == self.x_variable:
-                    entry_dict['x'] = entry_dict[var_name]
-                if var_name == self.y_variable:
-                    entry_dict['y'] = entry_dict[var_name]
-                if hasattr(self, 'z_variable') and var_name == self.z_variable:
-                    entry_dict['z'] = entry_dict[var_name]
-
-            if self.y_variable == 'deltaNLL' and entry_dict['y'] == 9990.0 or entry_dict['y']>1e9:
-                logging.trace(
-                    'Found deltaNLL=={3}, which indicates a misfit ({0}={1}, {2}={3}). '
-                    'Skipping point.'
-                    .format(self.x_variable, entry_dict['x'], self.y_variable, entry_dict['y'])
-                    )
-                continue
-            # entries.append(Entry(**entry_dict))
-            entries.append(entry_dict)
+        cache = scancache.get_cache()
+        if not(cache is None):
+            cache_key = cache.key(
+                root_files, self.globpat, variables,
+                tree_name=self.tree_name, x_variable=self.x_variable, y_variable=self.y_variable,
+                filter_x=filter_x
+                )
+            fingerprint = cache.fingerprint(root_files)
+            columns = cache.load(cache_key, fingerprint)
+            if not(columns is None):
+                return (columns, chain) if return_chain else columns
+
+        columns = get_columns_from_tree(chain, variables)
+        n_read = len(columns[variables[0]]) if len(variables) > 0 else 0
+        xs = columns[self.x_variable]
+        ys = columns[self.y_variable]
+
+        misfit = ys > 1e9
+        if self.y_variable == 'deltaNLL':
+            misfit |= (ys == 9990.0)
+        if numpy.any(misfit):
+            logging.trace(
+                'Found {0} points with deltaNLL==9990. or >1e9, which indicates a misfit. '
+                'Skipping points at {1}={2}'
+                .format(numpy.count_nonzero(misfit), self.x_variable, list(xs[misfit]))
+                )
+        keep = ~misfit
+
+        if filter_x:
+            # Keep only the first (in chain order) non-misfit occurrence of every x
+            i_passed = numpy.nonzero(keep)[0]
+            _, i_first = numpy.unique(xs[i_passed], return_index=True)
+            keep = numpy.zeros(n_read, dtype=bool)
+            keep[i_passed[i_first]] = True
 
-        if len(entries) == 0:
+        if not numpy.any(keep):
             raise RuntimeError(
                 'No entries were found; looked in root files such as {0}'.format(root_files[0])
                 )
 
-        entries.sort(key=lambda entry: (entry.x, entry.y))
+        i_sorted = numpy.nonzero(keep)[0]
+        i_sorted = i_sorted[numpy.lexsort((ys[i_sorted], xs[i_sorted]))]
+        columns = { key : column[i_sorted] for key, column in columns.iteritems() }
+
+        if not(cache is None):
+            cache.store(cache_key, fingerprint, columns)
+
+        if return_chain:
+            return columns, chain
+        else:
+            return columns
+
+    def read_merged(self, variables, update=True):
+        """
+        Reads one entry per grid point via self.completeness_index, so points that
+        were redone in a rescan are not counted twice; returns a ScanTable.
+        With update=False the index is used as it is (e.g. updated once for many scans)
+        """
+        if update: self.completeness_index.update()
+        self.completeness_index.log_summary(self.globpat)
+        columns = self.completeness_index.merged_columns(variables, self.globpat)
+        xs = columns[self.x_variable]
+        ys = columns[self.y_variable]
+        i_sorted = numpy.lexsort((ys, xs))
+        columns = { key : column[i_sorted] for key, column in columns.iteritems() }
+        aliases = { 'x' : self.x_variable, 'y' : self.y_variable }
+        if hasattr(self, 'z_variable'):
+            aliases['z'] = self.z_variable
+        return ScanTable(columns, aliases)
+
+    def read_chain(self, root_files, variables, filter_x=False, return_chain=False):
+        ret = self.read_columns(root_files, variables, filter_x=filter_x, return_chain=return_chain)
+        if return_chain:
+            columns, chain = ret
+        else:
+            columns = ret
+
+        aliases = { 'x' : self.x_variable, 'y' : self.y_variable }
+        if hasattr(self, 'z_variable'):
+            aliases['z'] = self.z_variable
+        entries = ScanTable(columns, aliases)
 
         if return_chain:
             return entries, chain
@@ -435,29 +811,24 @@ class ScanPrimitive(object):
 
 
     def filter_entries(self, inplace=True):
-        passed_entries = []
-        for entry in self.entries:
-            if entry.deltaNLL < self.deltaNLL_threshold:
-                # POIs = [ k for k in entry._fields if k.startswith('r_') ]
-                POIs = [ k for k in entry.keys() if k.startswith('r_') ]
-                if len(POIs) == 0:
-                    POI = 'x'
-                else:
-                    POI = POIs[0]
-                if self.filter_negatives:
-                    logging.warning(
-                        'deltaNLL<{0}; Dropping entry (deltaNLL={1:+10.4f}, {2}={3:+10.4f}) (scandirs: {4})'
-                        .format(
-                            self.deltaNLL_threshold,
-                            entry.deltaNLL,
-                            POI,
-                            getattr(entry, POI),
-                            self.scandirs)
-                        )
-                    continue
-                else:
-                    raise RuntimeError('Not allowed to filter negatives, but found:',entry)
-            passed_entries.append(entry)
+        deltaNLLs = self.entries.column('deltaNLL')
+        negative = deltaNLLs < self.deltaNLL_threshold
+        if numpy.any(negative):
+            if not self.filter_negatives:
+                raise RuntimeError('Not allowed to filter negatives, but found:', self.entries[int(numpy.nonzero(negative)[0][0])])
+            POIs = [ k for k in self.entries.keys() if k.startswith('r_') ]
+            POI = 'x' if len(POIs) == 0 else POIs[0]
+            for i in numpy.nonzero(negative)[0]:
+                logging.warning(
+                    'deltaNLL<{0}; Dropping entry (deltaNLL={1:+10.4f}, {2}={3:+10.4f}) (scandirs: {4})'
+                    .format(
+                        self.deltaNLL_threshold,
+                        deltaNLLs[i],
+                        POI,
+                        self.entries.column(POI)[i],
+                        self.scandirs)
+                    )
+        passed_entries = self.entries[~negative]
 
         if inplace:
             self.entries = passed_entries
@@ -465,38 +836,37 @@ class ScanPrimitive(object):
             return passed_entries
 
     def x(self):
-        return [ entry.x for entry in self.entries ]
+        return self.entries.column('x').tolist()
 
     def y(self):
-        return [ entry.y for entry in self.entries ]
+        return self.entries.column('y').tolist()
 
     def z(self):
-        return [ entry.z for entry in self.entries ]
+        return self.entries.column('z').tolist()
 
     def deltaNLL(self):
-        return [ entry.deltaNLL for entry in self.entries ]
+        return self.entries.column('deltaNLL').tolist()
 
     def two_times_deltaNLL(self):
-        return [ 2.*entry.deltaNLL for entry in self.entries ]
+        return (2.*self.entries.column('deltaNLL')).tolist()
 
     def bestfit(self):
-        deltaNLLs = self.deltaNLL()
-        if 0.0 in deltaNLLs:
-            i_bestfit = deltaNLLs.index(0.0)
-        else:
-            abs_deltaNLLs = map(abs, deltaNLLs)
-            i_bestfit = abs_deltaNLLs.index(min(abs_deltaNLLs))
+        i_bestfit = self.entries.bestfit_index()
+        bestfit = self.entries[i_bestfit]
+        if bestfit.deltaNLL != 0.0:
             logging.error(
                 'Could not find deltaNLL == 0.; taking value closest to 0.0: {0} (scandirs: {1})'
-                .format(deltaNLLs[i_bestfit], self.scandirs)
+                .format(bestfit.deltaNLL, self.scandirs)
                 )
-        return self.entries[i_bestfit]
+        return bestfit
+
+    def entry_columns(self):
+        return { key : self.entries.column(key) for key in self.entries.keys() }
 
     def filter(self, fn, inplace=True):
-        bestfit = self.bestfit()
-        new_entries = []
-        for entry in self.entries:
-            if entry is bestfit or fn(entry): new_entries.append(entry)
+        passed = self.entries.mask(fn)
+        passed[self.entries.bestfit_index()] = True
+        new_entries = self.entries[passed]
         if inplace:
             self.entries = new_entries
         else:
@@ -535,6 +905,10 @@ class Scan(ScanPrimitive):
 
 
     def read(self, keep_chain=False):
+        if not(self.completeness_index is None):
+            self.entries = self.read_merged([ self.x_variable, self.y_variable ])
+            self.filter_entries()
+            return
         root_files = self.collect_root_files()
         if self.save_all_variables:
             variables = self.get_list_of_variables_in_tree(root_files)
@@ -552,6 +926,11 @@ class Scan(ScanPrimitive):
             self.entries = self.read_chain(root_files, variables)
         self.filter_entries()
 
+    def set_entries_from_columns(self, columns):
+        """Sets the entries from already read columns (see read_columns) and filters them"""
+        self.entries = ScanTable(columns, { 'x' : self.x_variable, 'y' : self.y_variable })
+        self.filter_entries()
+
     def fix_bestfit_to_one(self):
         unc = self.unc._asdict()
         dmu = 1.0 - unc['x_min']
@@ -567,15 +946,19 @@ class Scan(ScanPrimitive):
         scanfilter.filter_clear_nonsense()
         scanfilter.raise_by_minimum()
 
-        # Rebuild from the filtered x
-        new_entries = []
-        for ix, x in enumerate(scanfilter.xs):
-            for entry in self.entries:
-                if entry.x == x:
-                    entry.y = scanfilter.ys[ix]
-                    entry.deltaNLL = scanfilter.ys[ix]
-                    new_entries.append(entry)
-        self.entries = new_entries
+        # Rebuild from the filtered x, using a map x -> entry indices
+        indices_for_x = {}
+        for i_entry, x in enumerate(self.entries.column('x').tolist()):
+            indices_for_x.setdefault(x, []).append(i_entry)
+        indices = []
+        ys = []
+        for x, y in zip(scanfilter.xs, scanfilter.ys):
+            indices_this_x = indices_for_x.get(x, [])
+            indices.extend(indices_this_x)
+            ys.extend([y] * len(indices_this_x))
+        self.entries = self.entries.take(indices)
+        self.entries.set_column('y', ys)
+        self.entries.set_column('deltaNLL', ys)
 
 
     def create_uncertainties(self, inplace=True, do_95percent_CL=False):
@@ -594,11 +977,9 @@ class Scan(ScanPrimitive):
             return unc
 
     def multiply_x_by_constant(self, constant):
-        # Very ugly way of doing things... should not have used a namedtuple in the first place.
-        for i in xrange(len(self.entries)):
-            # self.entries[i] = self.entries[i]._replace(x = self.entries[i].x * constant)
-            self.entries[i].x = constant * self.entries[i].x
-            # self.entries[i][self.x_variable] *= constant
+        # Only 'x' is scaled; x_variable keeps the original values
+        self.entries.unalias('x')
+        self.entries.set_column('x', constant * self.entries.column('x'))
 
     def to_graph(self):
         name = utils.get_unique_rootname()
@@ -618,13 +999,20 @@ class Scan(ScanPrimitive):
         factory.x_min = x_min
         factory.x_max = x_max
         factory.cutstring_addition = cutstring_addition
-        factory.tree = self.chain
+        factory.tree = getattr(self, 'chain', None)
+        factory.fill_columns(self.entry_columns())
         bestfit = self.bestfit()
         factory.fill_bestfit(bestfit.x)
         return factory
 
-    def to_spline(self, x_min, x_max, eps=2.2, deltaNLL_cutoff=30., cutstring_addition=''):
+    def to_spline(self, x_min, x_max, eps=2.2, deltaNLL_cutoff=30., cutstring_addition='', backend=None):
         factory = self.get_spline_factory(x_min, x_max, cutstring_addition)
+        factory.backend = self.spline_backend if backend is None else backend
+        if factory.backend != 'numpy' and factory.tree is None:
+            raise RuntimeError(
+                'Scan {0} has no chain (read without keep_chain=True?); cannot make a '
+                '\'{1}\' spline, use backend=\'numpy\''.format(self.x_variable, factory.backend)
+                )
         factory.eps = eps
         factory.deltaNLL_cutoff = deltaNLL_cutoff
         spline = factory.make_spline_1D()
@@ -677,25 +1065,28 @@ class Scan2D(ScanPrimitive):
 
         self._filled_bestfit = False
 
-    def __del__(self):
-        # Not pretty
-        if hasattr(self, '_close_root_fps'):
-            for fp in self._close_root_fps:
-                fp.Close()
+    def not_bestfit_mask(self):
+        bestfit = self.bestfit()
+        xs = self.entries.column('x')
+        ys = self.entries.column('y')
+        return ~((xs == bestfit.x) & (ys == bestfit.y))
 
     def x(self, exclude_bestfit=False):
         if exclude_bestfit:
-            bestfit = self.bestfit()
-            return [ entry.x for entry in self.entries if not(entry.x == bestfit.x and entry.y == bestfit.y) ]
-        return [ entry.x for entry in self.entries ]
+            return self.entries.column('x')[self.not_bestfit_mask()].tolist()
+        return self.entries.column('x').tolist()
 
     def y(self, exclude_bestfit=False):
         if exclude_bestfit:
-            bestfit = self.bestfit()
-            return [ entry.y for entry in self.entries if not(entry.x == bestfit.x and entry.y == bestfit.y) ]
-        return [ entry.y for entry in self.entries ]
+            return self.entries.column('y')[self.not_bestfit_mask()].tolist()
+        return self.entries.column('y').tolist()
 
     def read(self):
+        if not(self.completeness_index is None):
+            self.entries = self.read_merged([ self.x_variable, self.y_variable, self.z_variable ])
+            self.chain = None
+            self.filter_entries()
+            return
         root_files = self.collect_root_files()
 
         if self.save_all_variables:
@@ -726,70 +1117,40 @@ class Scan2D(ScanPrimitive):
         factory.y_min = y_min
         factory.y_max = y_max
         factory.cutstring_addition = cutstring_addition
-        factory.tree = self.chain
+        factory.tree = getattr(self, 'chain', None)
+        factory.fill_columns(self.entry_columns())
         bestfit = self.bestfit()
         factory.fill_bestfit(bestfit.x, bestfit.y)
         return factory
 
-    def new_tree_rootfile(self):
-        if not os.path.isdir('tmp'): os.makedirs('tmp')
-        root_file = 'tmp/newtree_{0}.root'.format(self.name)
-        root_file = core.make_unique_filename(root_file)
-        return root_file
-
     def new_tree_from_entries(self):
-        root_file = self.new_tree_rootfile()
-        root_fp = ROOT.TFile.Open(root_file, 'recreate')
-        ROOT.SetOwnership(root_fp, False)
-
-        tree = ROOT.TTree('limit', 'title')
-        ROOT.SetOwnership(tree, False)
-
-        x = array('f', [0.])
-        y = array('f', [0.])
-        deltaNLL = array('f', [0.])
-
-        tree.Branch('x', x, 'x/F')
-        tree.Branch('y', y, 'y/F')
-        tree.Branch('deltaNLL', deltaNLL, 'deltaNLL/F')
-
-        for entry in self.entries:
-            x[0] = entry.x
-            y[0] = entry.y
-            deltaNLL[0] = entry.deltaNLL
-            tree.Fill()
-
-        root_fp.Write()
-
-        if not hasattr(self, '_close_root_fps'):
-            self._close_root_fps = []
-        self._close_root_fps.append(root_fp)
-        return tree
-
-
-    def to_spline(self, x_min, x_max, y_min, y_max, eps=2.2, deltaNLL_cutoff=30., cutstring_addition='', remake_tree_from_entries=False):
+        """Context manager giving a memory-resident tree with branches x, y and deltaNLL"""
+        return core.memory_tree({
+            'x' : self.entries.column('x'),
+            'y' : self.entries.column('y'),
+            'deltaNLL' : self.entries.column('deltaNLL'),
+            })
+
+
+    def to_spline(self, x_min, x_max, y_min, y_max, eps=2.2, deltaNLL_cutoff=30., cutstring_addition='', remake_tree_from_entries=False, backend=None):
+        if getattr(self, 'chain', None) is None:
+            # E.g. after a merged read; there is no chain to build the spline from
+            remake_tree_from_entries = True
         factory = self.get_spline_factory(x_min, x_max, y_min, y_max, cutstring_addition)
+        factory.backend = self.spline_backend if backend is None else backend
+        factory.eps = eps
+        factory.deltaNLL_cutoff = deltaNLL_cutoff
         if remake_tree_from_entries:
-            factory.tree = self.new_tree_from_entries()
             factory.x_var = 'x'
             factory.y_var = 'y'
-
-        # print 'Making new tree from entries'
-        # tree = self.new_tree_from_entries()
-        # print tree
-        # print tree.GetEntries()
-        # root_array = tree.GetListOfBranches()
-        # for i_var in xrange(root_array.GetEntries()):
-        #     var_name = root_array[i_var].GetTitle()
-        #     print var_name
-        # print 'Printing entries of new tree'
-        # for e in tree:
-        #     print e.x, e.y, e.deltaNLL
-        # # sys.exit()
-
-        factory.eps = eps
-        factory.deltaNLL_cutoff = deltaNLL_cutoff
-        spline = factory.make_spline()
+        if remake_tree_from_entries and factory.backend != 'numpy':
+            # The numpy backend reads the entries directly; RooSplineND needs a (memory-resident) tree
+            with self.new_tree_from_entries() as tree:
+                factory.tree = tree
+                spline = factory.make_spline()
+                factory.tree = None
+        else:
+            spline = factory.make_spline()
         return spline
 
     # def to_polyfit(self, x_min, x_max, y_min, y_max, cutstring_addition=''):
@@ -800,8 +1161,10 @@ class Scan2D(ScanPrimitive):
     def to_polyfit(self, x_min, x_max, y_min, y_max, order=4):
         T2D = ROOT.TGraph2D()
         ROOT.SetOwnership(T2D, False)
-        for i_entry, entry in enumerate(self.entries):
-            T2D.SetPoint(i_entry, entry.x, entry.y, entry.deltaNLL)
+        for i_entry, (x, y, deltaNLL) in enumerate(zip(
+                self.entries.column('x'), self.entries.column('y'), self.entries.column('deltaNLL')
+                )):
+            T2D.SetPoint(i_entry, x, y, deltaNLL)
 
         factory = self.get_spline_factory(x_min, x_max, y_min, y_max, cutstring_addition='')
         factory.ord_polynomial = order
@@ -1,14 +1,21 @@
-import sys
+import sys, re, operator
 import core
 import ROOT
 import logging
+import numpy
+from array import array
 
 from plotting.plotting_utils import get_unique_rootname
 from plotting.pywrappers import Histogram2D, Graph
+from rbfspline import RBFSpline
 
 
 class Spline2DFactory(object):
     """docstring for Spline2DFactory"""
+
+    # 'roosplinend' reads from self.tree; 'numpy' uses RBFSpline on self.columns
+    default_backend = 'roosplinend'
+
     def __init__(self):
         super(Spline2DFactory, self).__init__()
 
@@ -22,6 +29,8 @@ class Spline2DFactory(object):
         self.y_max = 2.0
 
         self.tree = None
+        self.columns = None
+        self.backend = self.default_backend
 
         # Probably some splining parameter
         # In combine code it's 1.7
@@ -52,7 +61,71 @@ class Spline2DFactory(object):
         ROOT.SetOwnership(x, False)
         return x
 
+    def fill_columns(self, columns):
+        """Sets the input points for the numpy backend; dict of variable name -> array"""
+        self.columns = { name : numpy.asarray(values, dtype=numpy.float64) for name, values in columns.iteritems() }
+
+    def select_points(self, variables):
+        """
+        Applies the same selection as the RooSplineND cutstring to self.columns, and
+        returns the arrays of the requested variables and of z_var
+        """
+        if self.columns is None:
+            raise RuntimeError('No columns filled; call fill_columns before using the numpy backend')
+        selected = (self.columns['deltaNLL'] > 0.) & (self.columns['deltaNLL'] < self.deltaNLL_cutoff)
+        for name, op, value in parse_cutstring(self.cutstring_addition):
+            selected &= op(self.columns[name], value)
+        logging.debug(
+            'Selected {0} out of {1} points for the numpy spline'
+            .format(numpy.count_nonzero(selected), len(selected))
+            )
+        return [ self.columns[name][selected] for name in variables ], self.columns[self.z_var][selected]
+
+    def make_spline_numpy(self):
+        (xs, ys), zs = self.select_points([self.x_var, self.y_var])
+        spline = RBFSpline(
+            numpy.column_stack((xs, ys)), zs,
+            eps = self.eps,
+            rescale = True,
+            ranges = [ (self.x_min, self.x_max), (self.y_min, self.y_max) ]
+            )
+        splinewrapper = RBFSpline2DWrapper(spline,
+            x_min = self.x_min,
+            x_max = self.x_max,
+            y_min = self.y_min,
+            y_max = self.y_max,
+            )
+        if self.filled_bestfit:
+            splinewrapper.fill_bestfit(self.x_bestfit, self.y_bestfit)
+        return splinewrapper
+
+    def make_spline_1D_numpy(self):
+        (xs,), zs = self.select_points([self.x_var])
+        spline = RBFSpline(
+            xs.reshape((-1, 1)), zs,
+            eps = self.eps,
+            rescale = True,
+            ranges = [ (self.x_min, self.x_max) ]
+            )
+        splinewrapper = RBFSpline1DWrapper(spline,
+            x_min = self.x_min,
+            x_max = self.x_max,
+            )
+        if self.filled_bestfit:
+            splinewrapper.fill_bestfit(self.x_bestfit)
+        return splinewrapper
+
+    def get_tree(self):
+        if self.tree is None:
+            raise RuntimeError(
+                'No tree set for backend \'{0}\'; use the numpy backend, or remake '
+                'a tree from the entries of the scan'.format(self.backend)
+                )
+        return self.tree
+
     def make_spline(self):
+        if self.backend == 'numpy':
+            return self.make_spline_numpy()
         x = self.make_var_unique_name(self.x_var, self.x_min, self.x_max)
         y = self.make_var_unique_name(self.y_var, self.y_min, self.y_max)
 
@@ -62,7 +135,7 @@ class Spline2DFactory(object):
         spline = ROOT.RooSplineND(
             'spline_' + get_unique_rootname(), 'spline2D',
             s,
-            self.tree,
+            self.get_tree(),
             self.z_var,
             self.eps,
             True, # boolean rescale
@@ -81,6 +154,8 @@ class Spline2DFactory(object):
         return splinewrapper
 
     def make_spline_1D(self):
+        if self.backend == 'numpy':
+            return self.make_spline_1D_numpy()
         x = self.make_var_unique_name(self.x_var, self.x_min, self.x_max)
         s = ROOT.RooArgList(x)
         ROOT.SetOwnership(s, False)
@@ -88,7 +163,7 @@ class Spline2DFactory(object):
         spline = ROOT.RooSplineND(
             'spline_' + get_unique_rootname(), 'spline1D',
             s,
-            self.tree,
+            self.get_tree(),
             self.z_var,
             self.eps,
             True, # boolean rescale
@@ -107,27 +182,17 @@ class Spline2DFactory(object):
 
     #____________________________________________________________________
     def compile_2d_fit_string(self):
+        terms = polynomial_2d_terms(self.ord_polynomial)
         fstring = '('
-        param = 0
-        for o1 in range(self.ord_polynomial+1):
-            if (o1==0):
+        for param, (px, py) in enumerate(terms):
+            if px == 0 and py == 0:
                 fstring += "["+str(param)+"]"
-                param+=1
-                continue
+            elif py == 0:
+                fstring += "+["+str(param)+"]*pow(x,"+str(px)+")"
+            elif px == 0:
+                fstring += "+["+str(param)+"]*pow(y,"+str(py)+")"
             else:
-                fstring += "+["+str(param)+"]*pow(x,"+str(o1)+")"
-                param+=1
-                fstring += "+["+str(param)+"]*pow(y,"+str(o1)+")"
-                param+=1
-
-                o2=1
-                while o2<(o1+1):
-                    fstring += "+["+str(param)+"]*pow(x,"+str(o1)+")*pow(y,"+str(o2)+")"
-                    param+=1
-                    if (not o1==o2):
-                        fstring += "+["+str(param)+"]*pow(x,"+str(o2)+")*pow(y,"+str(o1)+")"
-                        param+=1
-                    o2+=1
+                fstring += "+["+str(param)+"]*pow(x,"+str(px)+")*pow(y,"+str(py)+")"
         fstring += ")"
         return fstring
 
@@ -142,7 +207,7 @@ class Spline2DFactory(object):
         cutstring = 'deltaNLL > 0. && 2.0*deltaNLL<{0}'.format(self.deltaNLL_cutoff) + self.cutstring_addition
         logging.info('Creating TGraph2D; cutstring is "{0}"'.format(cutstring))
         graph = TGraph2DFromTree(
-            self.tree,
+            self.get_tree(),
             self.x_var,
             self.y_var,
             '2.0*deltaNLL',
@@ -174,6 +239,7 @@ class Spline2DFactory(object):
             x_max = self.x_max,
             y_min = self.y_min,
             y_max = self.y_max,
+            ord_polynomial = self.ord_polynomial,
             )
         polyfit.multiply_by_two = True
 
@@ -201,6 +267,64 @@ class Spline2DFactory(object):
         return self.make_polyfit()
 
 
+def parse_cutstring(cutstring):
+    """
+    Parses a cutstring addition like ' && ct>-4.0 && ct<4.0' into a list of
+    (variable, operator, value); only simple comparisons are supported
+    """
+    ops = {
+        '<' : operator.lt, '<=' : operator.le,
+        '>' : operator.gt, '>=' : operator.ge,
+        '==' : operator.eq,
+        }
+    cuts = []
+    for clause in cutstring.split('&&'):
+        clause = clause.strip()
+        if clause == '': continue
+        match = re.match(r'^(\w+)\s*(<=|>=|==|<|>)\s*([-+]?[\d.]+(?:[eE][-+]?\d+)?)$', clause)
+        if not match:
+            raise ValueError(
+                'Cannot apply cut \'{0}\' without ROOT; only simple comparisons are supported'
+                .format(clause)
+                )
+        cuts.append(( match.group(1), ops[match.group(2)], float(match.group(3)) ))
+    return cuts
+
+
+def polynomial_2d_terms(order):
+    """
+    (power of x, power of y) per parameter of the 2D polynomial, in the parameter
+    order used by Spline2DFactory.compile_2d_fit_string
+    """
+    terms = [(0, 0)]
+    for o1 in range(1, order+1):
+        terms.append((o1, 0))
+        terms.append((0, o1))
+        for o2 in range(1, o1+1):
+            terms.append((o1, o2))
+            if not o1 == o2:
+                terms.append((o2, o1))
+    return terms
+
+
+_declared_batch_eval = None
+def declare_batch_eval():
+    """Declares a C++ loop that evaluates a RooAbsReal on many (x, y) points; returns False on failure"""
+    global _declared_batch_eval
+    if _declared_batch_eval is None:
+        try:
+            _declared_batch_eval = bool(ROOT.gInterpreter.Declare(
+                'void differentials_eval_2d(RooAbsReal& f, RooRealVar& x, RooRealVar& y, int n,'
+                '    const double* xs, const double* ys, double* out){'
+                '    for (int i = 0; i < n; i++){ x.setVal(xs[i]); y.setVal(ys[i]); out[i] = f.getVal(); }'
+                '    }'
+                ))
+        except Exception as e:
+            logging.warning('Could not declare batch evaluation loop ({0}); falling back to python loop'.format(e))
+            _declared_batch_eval = False
+    return _declared_batch_eval
+
+
 def TGraph2DFromTree(tree, xvar,  yvar, zvar, selection):
     tree.Draw(xvar + ':' + yvar + ':' + zvar, selection, 'goff')
     gr = ROOT.TGraph2D(
@@ -266,6 +390,15 @@ class Base1DWrapper(BaseWrapper):
                 r = 999.
         return r
 
+    def to_graph(self, nx=100):
+        x_axis = core.get_axis(nx, self.x_min, self.x_max)
+        y_axis = []
+        for x in x_axis:
+            y_axis.append(self.eval(x))
+
+        graph = Graph('auto', 'new_spline', x_axis, y_axis)
+        return graph
+
 
 class Spline1DWrapper(Base1DWrapper):
     """docstring for Spline1DWrapper"""
@@ -285,14 +418,18 @@ class Spline1DWrapper(Base1DWrapper):
     def eval(self, x):
         return super(Spline1DWrapper, self).eval(x)
 
-    def to_graph(self, nx=100):
-        x_axis = core.get_axis(nx, self.x_min, self.x_max)
-        y_axis = []
-        for x in x_axis:
-            y_axis.append(self.eval(x))
 
-        graph = Graph('auto', 'new_spline', x_axis, y_axis)
-        return graph
+class RBFSpline1DWrapper(Base1DWrapper):
+    """Wrapper around a 1D RBFSpline (numpy spline backend)"""
+    def __init__(self, spline, x_min, x_max):
+        super(RBFSpline1DWrapper, self).__init__(x_min, x_max)
+        self.spline = spline
+
+    def name(self):
+        return 'hist_' + get_unique_rootname()
+
+    def eval_interp(self, x):
+        return self.spline(x)
         
         
 
@@ -342,6 +479,67 @@ class Base2DWrapper(BaseWrapper):
                 r = 999.
         return r
 
+    def eval_interp_grid(self, xs, ys):
+        """Evaluates the interpolation on flat arrays of points; subclasses can override with a batch method"""
+        return numpy.array([ self.eval_interp(x, y) for x, y in zip(xs.tolist(), ys.tolist()) ])
+
+    def apply_selectors_grid(self, selectors, X, Y):
+        """
+        Returns a mask of points for which any of the selectors is True. Selectors
+        are first tried on the full arrays; selectors that do not broadcast
+        (e.g. using 'and') are evaluated point by point.
+        """
+        mask = numpy.zeros(X.shape, dtype=bool)
+        for selector in selectors:
+            try:
+                selected = numpy.asarray(selector(X, Y), dtype=bool)
+                if not selected.shape == X.shape: raise ValueError
+            except Exception:
+                selected = numpy.array(
+                    [ bool(selector(x, y)) for x, y in zip(X.ravel().tolist(), Y.ravel().tolist()) ],
+                    dtype=bool).reshape(X.shape)
+            mask |= selected
+        return mask
+
+    def eval_grid(self, xs, ys):
+        """
+        Vectorized version of eval on the grid xs x ys; returns an array of shape
+        (len(xs), len(ys)) following the same range, selector, offset, doubling
+        and negativity rules
+        """
+        X, Y = numpy.meshgrid(
+            numpy.asarray(xs, dtype=numpy.float64), numpy.asarray(ys, dtype=numpy.float64),
+            indexing='ij'
+            )
+        r = numpy.full(X.shape, 999.)
+
+        todo = numpy.ones(X.shape, dtype=bool)
+        if not(self.x_min is None): todo &= ~(X < self.x_min)
+        if not(self.x_max is None): todo &= ~(X > self.x_max)
+        if not(self.y_min is None): todo &= ~(Y < self.y_min)
+        if not(self.y_max is None): todo &= ~(Y > self.y_max)
+
+        if len(self.signal_selectors) > 0:
+            signal = todo & self.apply_selectors_grid(self.signal_selectors, X, Y)
+            r[signal] = 0.0
+            todo &= ~signal
+
+        if len(self.noise_selectors) > 0:
+            todo &= ~self.apply_selectors_grid(self.noise_selectors, X, Y)
+
+        interp = self.eval_interp_grid(X[todo], Y[todo])
+        if not(self.offset is None):
+            interp += self.offset
+        if self.multiply_by_two:
+            interp *= 2
+        negative = interp < 0.
+        if self.negativity_is_zero:
+            interp[negative] = 0.00001
+        elif self.disallow_negativity:
+            interp[negative] = 999.
+        r[todo] = interp
+        return r
+
     def to_hist(self, nx=100, ny=100, x_min=None, x_max=None, y_min=None, y_max=None):
         """Take standard spline ranges by default, but allow smaller or bigger rangers"""
         name = self.name()
@@ -357,12 +555,7 @@ class Base2DWrapper(BaseWrapper):
         x_centers = [ 0.5*(l+r) for l, r in zip(x_boundaries[:-1], x_boundaries[1:]) ]
         y_centers = [ 0.5*(l+r) for l, r in zip(y_boundaries[:-1], y_boundaries[1:]) ]
 
-        # Initialize with 0
-        mat = [ [0.0 for iy in xrange(ny)] for ix in xrange(nx) ]
-
-        for ix, x in enumerate(x_centers):
-            for iy, y in enumerate(y_centers):
-                mat[ix][iy] = self.eval(x,y)
+        mat = self.eval_grid(x_centers, y_centers).tolist()
 
         H.fill_with_matrix(mat, x_boundaries, y_boundaries)
 
@@ -378,9 +571,10 @@ class Base2DWrapper(BaseWrapper):
 
 class PolyFit2DWrapper(Base2DWrapper):
     """docstring for PolyFit2DWrapper"""
-    def __init__(self, f2D, x_min=None, x_max=None, y_min=None, y_max=None):
+    def __init__(self, f2D, x_min=None, x_max=None, y_min=None, y_max=None, ord_polynomial=None):
         super(PolyFit2DWrapper, self).__init__(x_min, x_max, y_min, y_max)
         self.f2D = f2D
+        self.ord_polynomial = ord_polynomial
 
     def name(self):
         return 'f2D_' + get_unique_rootname()
@@ -388,6 +582,16 @@ class PolyFit2DWrapper(Base2DWrapper):
     def eval_interp(self, x, y):
         return self.f2D.Eval(x, y)
 
+    def eval_interp_grid(self, xs, ys):
+        """Closed form evaluation from the fitted TF2 parameters"""
+        if self.ord_polynomial is None:
+            return super(PolyFit2DWrapper, self).eval_interp_grid(xs, ys)
+        terms = polynomial_2d_terms(self.ord_polynomial)
+        r = numpy.zeros(xs.shape)
+        for i_par, (px, py) in enumerate(terms):
+            r += self.f2D.GetParameter(i_par) * xs**px * ys**py
+        return r
+
 
 class Spline2DWrapper(Base2DWrapper):
     """docstring for Spline2DWrapper"""
@@ -406,6 +610,16 @@ class Spline2DWrapper(Base2DWrapper):
         r = self.spline.getVal()
         return r
 
+    def eval_interp_grid(self, xs, ys):
+        """Evaluates the spline in a compiled loop, avoiding a PyROOT round trip per point"""
+        if len(xs) == 0 or not declare_batch_eval():
+            return super(Spline2DWrapper, self).eval_interp_grid(xs, ys)
+        xs_buf = array('d', xs.tolist())
+        ys_buf = array('d', ys.tolist())
+        out = array('d', [0.]) * len(xs)
+        ROOT.differentials_eval_2d(self.spline, self.x, self.y, len(xs), xs_buf, ys_buf, out)
+        return numpy.array(out)
+
     def eval(self, x, y):
         return super(Spline2DWrapper, self).eval(x, y)
 
@@ -425,7 +639,17 @@ class Spline2DWrapper(Base2DWrapper):
         return graph
 
 
+class RBFSpline2DWrapper(Base2DWrapper):
+    """Wrapper around a 2D RBFSpline (numpy spline backend)"""
+    def __init__(self, spline, x_min=None, x_max=None, y_min=None, y_max=None):
+        super(RBFSpline2DWrapper, self).__init__(x_min, x_max, y_min, y_max)
+        self.spline = spline
 
+    def name(self):
+        return 'hist_' + get_unique_rootname()
 
+    def eval_interp(self, x, y):
+        return self.spline(x, y)
 
-
+    def eval_interp_grid(self, xs, ys):
+        return self.spline.evaluate(numpy.column_stack((xs, ys)))
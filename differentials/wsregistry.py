@@ -0,0 +1,227 @@
+"""
+Process-wide registry of RooWorkspaces, so that every workspace file is opened
+(and deserialised) only once per process; all callers of core.get_ws get the
+same RooWorkspace object, so changes to it (setVal, loadSnapshot) are shared.
+Code that changes values only temporarily should do so inside
+preserved_values(w), which restores them afterwards.
+
+Metadata that is cheap to store (POIs, variable values and ranges, snapshot
+names, pdfindex categories and the contents of sets) is kept in a sidecar
+summary file next to the workspace (<ws>.<wsname>.summary.json), valid as long as
+the workspace file does not change. Queries that only need names
+(core.list_POIs, core.read_set with return_names=True) use the summary and
+only open the workspace if the summary does not have the requested set yet.
+"""
+
+import os, time, json
+import os.path as osp
+import logging
+
+import ROOT
+
+
+def get_rss_mb():
+    """Resident memory of this process in MB (Linux only; 0. elsewhere)"""
+    try:
+        with open('/proc/self/status', 'r') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return 0.
+
+def file_signature(root_file):
+    stat = os.stat(root_file)
+    return [ stat.st_size, stat.st_mtime ]
+
+def iterate(collection):
+    """Iterates a RooAbsCollection/RooLinkedList the old-fashioned way (works for all ROOT versions)"""
+    itr = collection.createIterator() if hasattr(collection, 'createIterator') else collection.MakeIterator()
+    obj = itr.Next()
+    while obj:
+        yield obj
+        obj = itr.Next()
+
+
+class preserved_values():
+    """
+    Context manager that restores the values, constant flags, ranges and binnings of
+    all variables, and the indices of all categories, of a workspace on exit
+    """
+    def __init__(self, w):
+        self._w = w
+
+    def __enter__(self):
+        self._vars = [
+            (var, var.getVal(), var.isConstant(), var.getMin(), var.getMax(), var.getBins())
+            for var in iterate(self._w.allVars())
+            ]
+        self._cats = [ (cat, cat.getIndex()) for cat in iterate(self._w.allCats()) ]
+        return self._w
+
+    def __exit__(self, *args):
+        for var, value, is_constant, x_min, x_max, n_bins in self._vars:
+            # Range first, so the old value is not clipped to a changed range
+            var.setRange(x_min, x_max)
+            var.setBins(n_bins)
+            var.setVal(value)
+            var.setConstant(is_constant)
+        for cat, index in self._cats:
+            cat.setIndex(index)
+
+
+class WorkspaceSummary(object):
+    """docstring for WorkspaceSummary"""
+
+    def __init__(self, root_file, wsname='w'):
+        super(WorkspaceSummary, self).__init__()
+        self.root_file = root_file
+        self.wsname = wsname
+        self.summary_file = '{0}.{1}.summary.json'.format(root_file, wsname)
+        self.signature = file_signature(root_file)
+        self.data = None
+
+    def load(self):
+        """Reads the sidecar summary; returns False if absent or made for a different file"""
+        if not osp.isfile(self.summary_file): return False
+        try:
+            with open(self.summary_file, 'r') as fp:
+                data = json.load(fp)
+        except ValueError:
+            logging.warning('Could not read summary {0}; ignoring it'.format(self.summary_file))
+            return False
+        if data.get('signature', None) != self.signature:
+            logging.debug('Summary {0} is outdated'.format(self.summary_file))
+            return False
+        self.data = data
+        return True
+
+    def dump(self):
+        tmp_file = self.summary_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as fp:
+                json.dump(self.data, fp)
+            os.rename(tmp_file, self.summary_file)
+        except (IOError, OSError) as e:
+            logging.debug('Could not write summary {0} ({1})'.format(self.summary_file, e))
+
+    def extract(self, w):
+        """Builds the summary from a loaded workspace"""
+        self.data = {
+            'signature' : self.signature,
+            'vars'      : {},
+            'pdfindex'  : {},
+            'snapshots' : [],
+            'sets'      : {},
+            }
+        for var in iterate(w.allVars()):
+            self.data['vars'][var.GetName()] = [ var.getVal(), var.getMin(), var.getMax(), bool(var.isConstant()) ]
+        for cat in iterate(w.allCats()):
+            if cat.GetName().startswith('pdfindex'):
+                self.data['pdfindex'][cat.GetName()] = cat.getIndex()
+        if hasattr(w, 'getSnapshots'):
+            self.data['snapshots'] = [ snapshot.GetName() for snapshot in iterate(w.getSnapshots()) ]
+        for setname in [ 'POI', 'nuisances', 'globalObservables', 'observables' ]:
+            self.add_set(w, setname)
+
+    def add_set(self, w, setname):
+        argset = w.set(setname)
+        if argset == None:
+            self.data['sets'][setname] = None
+        else:
+            self.data['sets'][setname] = [ obj.GetName() for obj in iterate(argset) ]
+        return self.data['sets'][setname]
+
+    def has_set(self, setname):
+        return setname in self.data['sets']
+
+    def get_set(self, setname):
+        """Returns the names in the set, or None if the workspace has no such set"""
+        names = self.data['sets'][setname]
+        if names is None: return None
+        # Names read back from json are unicode; PyROOT wants str
+        return [ str(name) for name in names ]
+
+
+class WorkspaceRegistry(object):
+    """docstring for WorkspaceRegistry"""
+
+    def __init__(self):
+        super(WorkspaceRegistry, self).__init__()
+        # (abs path, wsname) -> dict with w, signature, open_time and rss_mb
+        self.workspaces = {}
+        self.summaries = {}
+
+    def key(self, root_file, wsname):
+        return (osp.abspath(root_file), wsname)
+
+    def get(self, root_file, wsname='w'):
+        key = self.key(root_file, wsname)
+        entry = self.workspaces.get(key, None)
+        if not(entry is None) and entry['signature'] == file_signature(root_file):
+            return entry['w']
+
+        rss_before = get_rss_mb()
+        t_start = time.time()
+        root_fp = ROOT.TFile.Open(root_file)
+        if root_fp == None or root_fp.IsZombie():
+            raise IOError('Could not open {0}'.format(root_file))
+        w = root_fp.Get(wsname)
+        root_fp.Close()
+        if w == None:
+            raise ValueError('Workspace \'{0}\' does not exist in {1}'.format(wsname, root_file))
+        entry = {
+            'w'         : w,
+            'signature' : file_signature(root_file),
+            'open_time' : time.time() - t_start,
+            'rss_mb'    : get_rss_mb() - rss_before,
+            }
+        self.workspaces[key] = entry
+        logging.info(
+            'Opened workspace {0} from {1} in {2:.1f}s (+{3:.0f} MB)'
+            .format(wsname, root_file, entry['open_time'], entry['rss_mb'])
+            )
+        return w
+
+    def get_summary(self, root_file, wsname='w'):
+        key = self.key(root_file, wsname)
+        summary = self.summaries.get(key, None)
+        if not(summary is None) and summary.signature == file_signature(root_file):
+            return summary
+        summary = WorkspaceSummary(root_file, wsname)
+        if not summary.load():
+            summary.extract(self.get(root_file, wsname))
+            summary.dump()
+        self.summaries[key] = summary
+        return summary
+
+    def read_set_names(self, root_file, setname, wsname='w'):
+        """Names in a set (None if the set does not exist), from the summary if possible"""
+        summary = self.get_summary(root_file, wsname)
+        if not summary.has_set(setname):
+            summary.add_set(self.get(root_file, wsname), setname)
+            summary.dump()
+        return summary.get_set(setname)
+
+    def release(self, root_file, wsname='w'):
+        self.workspaces.pop(self.key(root_file, wsname), None)
+
+    def clear(self):
+        self.workspaces = {}
+        self.summaries = {}
+
+    def report(self):
+        lines = [ 'Open workspaces:' ]
+        for (root_file, wsname), entry in sorted(self.workspaces.iteritems()):
+            lines.append(
+                '  {0}:{1}  opened in {2:.1f}s, +{3:.0f} MB'
+                .format(root_file, wsname, entry['open_time'], entry['rss_mb'])
+                )
+        return '\n'.join(lines)
+
+
+_REGISTRY = WorkspaceRegistry()
+
+def get_registry():
+    return _REGISTRY
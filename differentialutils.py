@@ -26,7 +26,10 @@ def run_fastscan_scan_reused_postfit(config, postfit):
     fastscan.run(copied_postfit)
     fastscan_file = fastscan.get_output()
 
-    pointwisescan = combine.CombinePointwiseScan(config)
+    if config.adaptiveScan:
+        pointwisescan = combine.CombineAdaptivePointwiseScan(config)
+    else:
+        pointwisescan = combine.CombinePointwiseScan(config)
     pointwisescan.run(copied_postfit, fastscan_file)
 
 
@@ -46,7 +49,10 @@ def run_postfit_fastscan_scan(config, point_minimizer_settings=None):
         # Change the minimizer settings only for the scan, but not for the best fit
         config.minimizer_settings = point_minimizer_settings
 
-    pointwisescan = combine.CombinePointwiseScan(config)
+    if config.adaptiveScan:
+        pointwisescan = combine.CombineAdaptivePointwiseScan(config)
+    else:
+        pointwisescan = combine.CombinePointwiseScan(config)
     pointwisescan.run(postfit_file, fastscan_file)
 
 
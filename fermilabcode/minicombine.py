@@ -1,6 +1,8 @@
-import os, sys, copy
+import os, sys, copy, bisect, time
 import importlib
 import logging
+import multiprocessing
+import numpy
 import differentials
 from differentials.core import AttrDict
 
@@ -12,6 +14,7 @@ if int(scipyversion) < 15:
 else:
     import scipy.optimize
     _optimize_loaded = True
+import scipy.ndimage
 
 #____________________________________________________________________
 
@@ -114,6 +117,53 @@ def get_kappat_kappag_parametrization():
     parametrization.bin_boundaries = sm.binBoundaries
     return parametrization
 
+# Set just before the pool forks, so workers inherit the chi2 object instead of
+# having to pickle it (parametrizations and BinMergers hold lambdas)
+_grid_chi2 = None
+
+def evaluate_grid_rows(task):
+    """Worker for evaluate_grid: evaluates a block of rows; cells outside the mask are nan"""
+    c1s, c2s, mask = task
+    block = numpy.full((len(c1s), len(c2s)), numpy.nan)
+    if mask is None: mask = numpy.ones(block.shape, dtype=bool)
+    i_c1, i_c2 = numpy.nonzero(mask)
+    if len(i_c1) > 0:
+        block[i_c1, i_c2] = _grid_chi2.evaluate_many(numpy.column_stack((c1s[i_c1], c2s[i_c2])))
+    return block
+
+def evaluate_grid(chi2, c1s, c2s, mask=None, n_workers=1, rows_per_block=None):
+    """
+    Evaluates chi2 on the grid c1s x c2s (optionally only where mask is True), and
+    returns a (len(c1s), len(c2s)) array. With n_workers > 1 blocks of rows are
+    evaluated in a process pool; the output ordering is the same as serially.
+    """
+    global _grid_chi2
+    if rows_per_block is None:
+        rows_per_block = max(1, len(c1s) // (4*n_workers))
+    tasks = [
+        (c1s[i:i+rows_per_block], c2s, None if mask is None else mask[i:i+rows_per_block])
+        for i in xrange(0, len(c1s), rows_per_block)
+        ]
+    _grid_chi2 = chi2
+    try:
+        if n_workers > 1 and len(tasks) > 1:
+            logging.debug('Evaluating {0} row blocks with {1} workers'.format(len(tasks), n_workers))
+            pool = multiprocessing.Pool(min(n_workers, len(tasks)))
+            try:
+                blocks = pool.map(evaluate_grid_rows, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            blocks = map(evaluate_grid_rows, tasks)
+    finally:
+        _grid_chi2 = None
+    return numpy.vstack(blocks)
+
+def chi2_quadratic_form(residuals, inv_cov):
+    """Returns r_n^T C^-1 r_n for every row r_n of residuals"""
+    return numpy.einsum('ni,ij,nj->n', residuals, inv_cov, residuals)
+
 #____________________________________________________________________
 
 
@@ -133,6 +183,11 @@ class CouplingFit(object):
         self.title = ''
         self.color = None
         self.bestfit = None
+        self.n_workers = 1
+        # If set, first scan every coarse_step-th bin center, and only scan the full
+        # grid where the coarse dchi2 is below coarse_dchi2_max
+        self.coarse_step = None
+        self.coarse_dchi2_max = 30.
         
     def setup_kappabkappac(self, data):
         self.chi2 = Chi2CouplingFitter()
@@ -163,27 +218,50 @@ class CouplingFit(object):
         self.c1_bin_centers = [ 0.5*(l+r) for l, r in zip(self.c1_bin_boundaries[:-1], self.c1_bin_boundaries[1:]) ]
         self.c2_bin_centers = [ 0.5*(l+r) for l, r in zip(self.c2_bin_boundaries[:-1], self.c2_bin_boundaries[1:]) ]
 
-        _do_log = logging.getLogger().isEnabledFor(logging.DEBUG)
-        if _do_log: logging.debug(
+        logging.debug(
             'Scanning grid; c1_min={0:<+6.2f}, c1_max={1:<+6.2f}, c2_min={2:<+6.2f}, c2_max={3:<+6.2f}'
             .format( self.c1_min, self.c1_max, self.c2_min, self.c2_max )
             )
 
-        scan = [[ 999. for j in xrange(self.c2_n_points) ] for i in xrange(self.c1_n_points)]
-        for i_c1, c1 in enumerate(self.c1_bin_centers):
-            for i_c2, c2 in enumerate(self.c2_bin_centers):
-                nll = self.chi2.evaluate([c1, c2])
-                nll0 = self.bestfit.chi2
-                dnll = nll - nll0
-                if _do_log:
-                    logging.debug(
-                        '{0}={1:<+6.2f}/{2}={3:<+6.2f}; dnll={4:<+6.2f}, nll={5:<+6.2f}, nll0={6:<+6.2f}'
-                        .format(self.chi2.c1_name, c1, self.chi2.c2_name, c2, dnll, nll, nll0)
-                        )
-                scan[i_c1][i_c2] =  dnll
-
+        c1s = numpy.array(self.c1_bin_centers)
+        c2s = numpy.array(self.c2_bin_centers)
+        nll0 = self.bestfit.chi2
 
-        self.scan = scan
+        if self.coarse_step is None or self.coarse_step <= 1:
+            self.scan = evaluate_grid(self.chi2, c1s, c2s, n_workers=self.n_workers) - nll0
+        else:
+            mask, coarse_fill = self.get_coarse_envelope(c1s, c2s)
+            logging.info(
+                'Coarse pass kept {0} of {1} cells within dchi2 < {2}'
+                .format(mask.sum(), mask.size, self.coarse_dchi2_max)
+                )
+            fine = evaluate_grid(self.chi2, c1s, c2s, mask=mask, n_workers=self.n_workers) - nll0
+            self.scan = numpy.where(mask, fine, coarse_fill)
+
+    def get_coarse_envelope(self, c1s, c2s):
+        """
+        Evaluates every coarse_step-th bin center, and returns a mask of the fine cells
+        that still need to be evaluated, plus the nearest coarse dchi2 for every fine cell.
+        A fine cell is only evaluated if any of the coarse points around it is below
+        coarse_dchi2_max; cells that are coarse points themselves are not evaluated twice.
+        """
+        i_c1_coarse = numpy.arange(0, len(c1s), self.coarse_step)
+        i_c2_coarse = numpy.arange(0, len(c2s), self.coarse_step)
+        coarse = evaluate_grid(
+            self.chi2, c1s[i_c1_coarse], c2s[i_c2_coarse], n_workers=self.n_workers
+            ) - self.bestfit.chi2
+        inside = scipy.ndimage.minimum_filter(coarse, size=3, mode='nearest') < self.coarse_dchi2_max
+
+        nearest_c1 = numpy.minimum(
+            numpy.rint(numpy.arange(len(c1s)) / float(self.coarse_step)).astype(int), len(i_c1_coarse)-1
+            )
+        nearest_c2 = numpy.minimum(
+            numpy.rint(numpy.arange(len(c2s)) / float(self.coarse_step)).astype(int), len(i_c2_coarse)-1
+            )
+        mask = inside[numpy.ix_(nearest_c1, nearest_c2)]
+        mask[numpy.ix_(i_c1_coarse, i_c2_coarse)] = False
+        coarse_fill = coarse[numpy.ix_(nearest_c1, nearest_c2)]
+        return mask, coarse_fill
 
     def to_hist(self):
         histogram2D = differentials.plotting.pywrappers.Histogram2D(
@@ -208,19 +286,21 @@ class CouplingFit(object):
 
     def sum(self, other):
         new = copy.deepcopy(self)
-        for i_c1 in xrange(len(new.c1_bin_centers)):
-            for i_c2 in xrange(len(new.c2_bin_centers)):
-                new.scan[i_c1][i_c2] = self.scan[i_c1][i_c2] + other.scan[i_c1][i_c2]
+        new.scan = numpy.asarray(self.scan) + numpy.asarray(other.scan)
         return new
 
 
 
 class Chi2(object):
     """docstring for Chi2"""
+
+    derivative_free_minimizers = [ 'Nelder-Mead', 'Powell', 'COBYLA' ]
+
     def __init__(self):
         super(Chi2, self).__init__()
         self.freeze_pois = []
         self.freeze_poi_values = []
+        self.minimizer = 'Nelder-Mead' # or e.g. 'L-BFGS-B', 'trust-ncg'
         
     def freeze_poi(self, i_poi, value):
         if not i_poi in self.freeze_pois:
@@ -256,13 +336,78 @@ class Chi2(object):
                 all_pois.append(floating_pois_iter.next())
         return all_pois
 
-    def minimize(self):
-        pois = [ p for i, p in enumerate(self.pois) if not i in self.freeze_pois ] # pick only floating pois
+    def floating_indices(self):
+        return [ i for i in xrange(len(self.pois)) if not i in self.freeze_pois ]
+
+    def get_all_pois_many(self, floating_points):
+        """Like get_all_pois, but for an (N, n_floating_pois) array of points"""
+        floating_points = numpy.atleast_2d(numpy.asarray(floating_points, dtype=numpy.float64))
+        if len(self.freeze_pois) == 0:
+            return floating_points
+        all_points = numpy.empty((floating_points.shape[0], len(self.pois)))
+        all_points[:,self.floating_indices()] = floating_points
+        all_points[:,self.freeze_pois] = self.freeze_poi_values
+        return all_points
+
+    def evaluate_many(self, points):
+        """
+        Evaluates an (N, n_floating_pois) array of points at once and returns an (N,)
+        array; subclasses override this with a vectorized implementation
+        """
+        return numpy.array([ self.evaluate(list(point)) for point in numpy.atleast_2d(points) ])
+
+    def gradient(self, pois, step=1e-5):
+        """
+        Gradient w.r.t. the floating pois; central differences in a single evaluate_many
+        call, subclasses override this with an analytic gradient
+        """
+        pois = numpy.asarray(pois, dtype=numpy.float64)
+        shifts = step * numpy.eye(len(pois))
+        chi2s = self.evaluate_many(numpy.vstack((pois + shifts, pois - shifts)))
+        return (chi2s[:len(pois)] - chi2s[len(pois):]) / (2.*step)
+
+    def hessian(self, pois, step=1e-4):
+        """Hessian w.r.t. the floating pois; central differences of the gradient"""
+        pois = numpy.asarray(pois, dtype=numpy.float64)
+        hess = numpy.array([
+            (self.gradient(pois + step*unit) - self.gradient(pois - step*unit)) / (2.*step)
+            for unit in numpy.eye(len(pois))
+            ])
+        return 0.5*(hess + hess.T)
+
+    def minimize(self, x0=None, minimizer=None):
+        """
+        Minimizes w.r.t. the floating pois, starting from x0 (floating pois only) if
+        given, and from self.pois otherwise. minimizer is any scipy.optimize.minimize
+        method; defaults to self.minimizer. Gradient-based methods get self.gradient,
+        trust-region methods also self.hessian.
+        """
+        if x0 is None:
+            x0 = [ p for i, p in enumerate(self.pois) if not i in self.freeze_pois ] # pick only floating pois
+        if minimizer is None: minimizer = self.minimizer
+        kwargs = {}
+        if not minimizer in self.derivative_free_minimizers:
+            kwargs['jac'] = self.gradient
+        if minimizer.startswith('trust') or minimizer in [ 'Newton-CG', 'dogleg' ]:
+            kwargs['hess'] = self.hessian
+
+        t_start = time.time()
         with differentials.core.raise_logging_level():
-            fit = scipy.optimize.minimize(self.evaluate, pois, method='Nelder-Mead', tol=1e-6)
+            fit = scipy.optimize.minimize(self.evaluate, x0, method=minimizer, tol=1e-6, **kwargs)
+        t_fit = time.time() - t_start
+
         chi2 = fit.fun
         fitted_pois = self.get_all_pois(list(fit.x)) # get fit, and plug back in the frozen pois as well
-        return AttrDict(chi2=chi2, pois=fitted_pois)
+        result = AttrDict(
+            chi2=chi2, pois=fitted_pois, floating_pois=list(fit.x),
+            nit=fit.get('nit', 0), nfev=fit.nfev, njev=fit.get('njev', 0), nhev=fit.get('nhev', 0),
+            status=fit.status, success=fit.success, time=t_fit, minimizer=minimizer
+            )
+        logging.debug(
+            '{0} fit: chi2={1:.4f} in {2:.3f}s; nit={3}, nfev={4}, njev={5}, nhev={6}, status={7}'
+            .format(minimizer, chi2, t_fit, result.nit, result.nfev, result.njev, result.nhev, fit.status)
+            )
+        return result
 
 
 class Chi2CouplingFitter(Chi2):
@@ -276,6 +421,18 @@ class Chi2CouplingFitter(Chi2):
     def build(self):
         self.get_rebinner()
         self.get_smxs_parametrization()
+        self.get_batch_matrices()
+
+    def get_batch_matrices(self):
+        """Matrix form of evaluate, used by evaluate_many"""
+        # Parabola coefficients per theory bin, in the order of parametrization.parabola_monomials
+        self.coefficient_matrix = numpy.array([
+            [ p.A, p.B, p.C, p.D, p.E, p.F ] for p in self.parametrization.parametrizations
+            ])
+        self.rebin_matrix = self.rebinner.get_rebin_matrix().matrix
+        smxs = numpy.array(self.smxs_parametrization)
+        self.inv_smxs = numpy.where(smxs != 0., 1./numpy.where(smxs != 0., smxs, 1.), 0.)
+        self.inv_cov = numpy.diag(1./numpy.array(self.data.delta)**2)
 
     def get_smxs_parametrization(self):
         self.smxs_parametrization = self.evaluate_parametrization_xs(self.pois_sm)
@@ -325,6 +482,48 @@ class Chi2CouplingFitter(Chi2):
             chi2 += ((mu_data-mu_param)**2) / (delta_data**2)
         return chi2
 
+    def evaluate_mus_many(self, points):
+        points = numpy.atleast_2d(numpy.asarray(points, dtype=numpy.float64))
+        xs_theory = differentials.parametrization.parabola_monomials(points).dot(self.coefficient_matrix.T)
+        xs_theory[numpy.abs(xs_theory) <= 1e-12] = 0.
+        return xs_theory.dot(self.rebin_matrix.T) * self.inv_smxs
+
+    def evaluate_many(self, points):
+        mus = self.evaluate_mus_many(points)
+        return chi2_quadratic_form(numpy.array(self.data.mu) - mus, self.inv_cov)
+
+    def monomials_to_mus(self, monomials):
+        """Maps (..., 6) parabola terms (or their derivatives) to (..., n_bins) mus"""
+        return monomials.dot(self.coefficient_matrix.T).dot(self.rebin_matrix.T) * self.inv_smxs
+
+    def jacobian_mus(self, pois):
+        """(n_bins, 2) derivatives of the mus w.r.t. the couplings"""
+        c1, c2 = pois
+        c3 = differentials.parametrization.Parabola.c3
+        d_monomials = numpy.array([
+            [ 2.*c1, 0., c2, c3, 0., 0. ],
+            [ 0., 2.*c2, c1, 0., c3, 0. ],
+            ])
+        return self.monomials_to_mus(d_monomials).T
+
+    def gradient(self, pois):
+        residuals = numpy.array(self.data.mu) - self.evaluate_mus_many(pois)[0]
+        return -2. * self.jacobian_mus(pois).T.dot(self.inv_cov.dot(residuals))
+
+    def hessian(self, pois):
+        residuals = numpy.array(self.data.mu) - self.evaluate_mus_many(pois)[0]
+        jacobian = self.jacobian_mus(pois)
+        # Second derivatives of the parabola terms are constant
+        d2_monomials = numpy.zeros((2, 2, 6))
+        d2_monomials[0,0,0] = 2.
+        d2_monomials[1,1,1] = 2.
+        d2_monomials[0,1,2] = d2_monomials[1,0,2] = 1.
+        d2_mus = self.monomials_to_mus(d2_monomials)
+        return (
+            2. * jacobian.T.dot(self.inv_cov).dot(jacobian)
+            - 2. * numpy.einsum('kli,i->kl', d2_mus, self.inv_cov.dot(residuals))
+            )
+
     # def minimize(self):
     #     fit = super(Chi2CouplingFitter, self).minimize()
     #     fit['mu'] = self.evaluate_parametrization(fit.pois)
@@ -349,6 +548,13 @@ class Scan(object):
         if hasattr(self, 'draw_style'): graph.draw_style = self.draw_style
         return graph
 
+# Set just before the pool forks, see _grid_chi2
+_profile_combination = None
+
+def profile_poi(i):
+    """Worker for PtCombination.get_scans"""
+    return _profile_combination.profile(i)
+
 class PtCombination(object):
     """docstring for PtCombination"""
     def __init__(self, spectra=None):
@@ -361,6 +567,8 @@ class PtCombination(object):
         self.title = 'ptcombination'
         self.hard_x_max = 500. # For plotting only
         self.outdir = 'fermilabcode'
+        self.scan_axis = (-1.5, 3.0, 70) # x_min, x_max, n_points
+        self.n_workers = 1
 
         if not(spectra is None):
             self.spectra = spectra
@@ -377,15 +585,45 @@ class PtCombination(object):
             self.bestfit = self.chi2.minimize()
             self.bestfit_done = True
 
-    def get_scan(self, i):
+    def profile(self, i):
+        """
+        Profiles poi i over self.scan_axis. Every point is minimized starting from the
+        minimum of its neighbour, walking outward from the bestfit in both directions.
+        Returns the poi axis, the chi2 axis and the fit diagnostics per point.
+        """
         self.get_bestfit() # Make sure the bestfit is there
-        poi_axis = get_axis(-1.5, 3.0, 70)
-        chi2_axis = []
-        for poi in poi_axis:
-            self.chi2.freeze_poi(i, poi)
-            fit = self.chi2.minimize()
-            chi2_axis.append(fit.chi2 - self.bestfit.chi2)
+        poi_axis = get_axis(*self.scan_axis)
+        chi2_axis = [ None for poi in poi_axis ]
+        fits = [ None for poi in poi_axis ]
+
+        x0_bestfit = [ p for i_poi, p in enumerate(self.bestfit.pois) if i_poi != i ]
+        i_split = bisect.bisect_left(poi_axis, self.bestfit.pois[i])
+        for walk in [ xrange(i_split, len(poi_axis)), xrange(i_split-1, -1, -1) ]:
+            x0 = x0_bestfit
+            for i_point in walk:
+                self.chi2.freeze_poi(i, poi_axis[i_point])
+                fit = self.chi2.minimize(x0)
+                x0 = fit.floating_pois
+                chi2_axis[i_point] = fit.chi2 - self.bestfit.chi2
+                fits[i_point] = AttrDict(
+                    poi=poi_axis[i_point], chi2=fit.chi2,
+                    nit=fit.get('nit', 0), nfev=fit.nfev, njev=fit.get('njev', 0), status=fit.status, success=fit.success,
+                    time=fit.time
+                    )
+                if not fit.success:
+                    logging.warning(
+                        'Fit for poi{0} = {1:+.3f} did not converge (status {2}, {3} iterations, {4} fcalls)'
+                        .format(i, poi_axis[i_point], fit.status, fit.get('nit', 0), fit.nfev)
+                        )
         self.chi2.unfreeze_all()
+        logging.debug(
+            'Profiled poi{0} in {1} fcalls'.format(i, sum(fit.nfev for fit in fits))
+            )
+        return poi_axis, chi2_axis, fits
+
+    def get_scan(self, i, profiled=None):
+        if profiled is None: profiled = self.profile(i)
+        poi_axis, chi2_axis, fits = profiled
 
         # Insert the bestfit values into the scan as well (at the right place)
         for i_poi_axis in xrange(len(poi_axis)-1):
@@ -408,14 +646,32 @@ class PtCombination(object):
 
         scan = Scan(poi_axis, chi2_axis)
         scan.unc = unc
+        scan.fits = fits
         scan.title = 'poi{0}'.format(i)
         return scan
 
-    def get_scans(self):
-        self.scans = []
-        for i in xrange(self.chi2.n_bins):
-            scan = self.get_scan(i)
-            self.scans.append(scan)
+    def get_scans(self, n_workers=None):
+        """
+        Profiles all pois; with n_workers > 1 the pois are profiled in a process pool.
+        Workers only send back the axes and fit diagnostics; the Scans are built here.
+        """
+        global _profile_combination
+        if n_workers is None: n_workers = self.n_workers
+        self.get_bestfit() # Before forking, so workers do not redo it
+        pois = range(self.chi2.n_bins)
+        if n_workers > 1 and len(pois) > 1:
+            logging.info('Profiling {0} pois with {1} workers'.format(len(pois), n_workers))
+            _profile_combination = self
+            pool = multiprocessing.Pool(min(n_workers, len(pois)))
+            try:
+                profiled = pool.map(profile_poi, pois)
+            finally:
+                pool.close()
+                pool.join()
+                _profile_combination = None
+        else:
+            profiled = map(self.profile, pois)
+        self.scans = [ self.get_scan(i, p) for i, p in zip(pois, profiled) ]
 
     def plot_scans(self, plotname=None):
         if len(self.scans) == 0:
@@ -519,6 +775,20 @@ class Chi2PtCombination(Chi2):
             chi2 += chi2_this_spectrum
         return chi2
 
+    def evaluate_many(self, points):
+        all_points = self.get_all_pois_many(points)
+        return sum(chi2_spectrum.evaluate_many(all_points) for chi2_spectrum in self.chi2_spectra)
+
+    def gradient(self, pois):
+        all_pois = self.get_all_pois_many(pois)[0]
+        gradient = sum(chi2_spectrum.gradient(all_pois) for chi2_spectrum in self.chi2_spectra)
+        return gradient[self.floating_indices()]
+
+    def hessian(self, pois):
+        hessian = sum(chi2_spectrum.hessian() for chi2_spectrum in self.chi2_spectra)
+        floating = self.floating_indices()
+        return hessian[numpy.ix_(floating, floating)]
+
 
 class Chi2Spectrum(object):
     """docstring for Chi2Spectrum"""
@@ -531,6 +801,8 @@ class Chi2Spectrum(object):
 
         self.mus = self.spectrum.mu
         self.deltas = [ 0.5*(abs(l)+abs(r)) for l, r in zip(self.spectrum.mu_down, self.spectrum.mu_up) ]
+        self.inv_cov = numpy.diag(1./numpy.array(self.deltas)**2)
+        self.merge_matrix = numpy.eye(self.n_bins)
 
         self.needs_rebinning = False
 
@@ -542,6 +814,7 @@ class Chi2Spectrum(object):
         self.finest = finest
         self.binmerger = BinMerger(self.finest, self.spectrum)
         self.binmerger.build()
+        self.merge_matrix = self.binmerger.get_matrix()
 
     def evaluate(self, pois):
         if self.needs_rebinning:
@@ -552,6 +825,22 @@ class Chi2Spectrum(object):
             chi2 += ((poi-mu)**2) / (delta**2)
         return chi2
 
+    def evaluate_many(self, points):
+        """Takes an (N, n_pois) array of all (not only floating) pois"""
+        if self.needs_rebinning:
+            points = points.dot(self.merge_matrix.T)
+        return chi2_quadratic_form(points - numpy.array(self.mus), self.inv_cov)
+
+    # chi2 is quadratic in the (fine) pois, so the derivatives are exact
+
+    def gradient(self, pois):
+        """Takes all (not only floating) pois"""
+        residuals = self.merge_matrix.dot(pois) - numpy.array(self.mus)
+        return 2. * self.merge_matrix.T.dot(self.inv_cov.dot(residuals))
+
+    def hessian(self):
+        return 2. * self.merge_matrix.T.dot(self.inv_cov).dot(self.merge_matrix)
+
 
 class BinMerger(object):
     """docstring for BinMerger"""
@@ -641,5 +930,9 @@ class BinMerger(object):
         merged_pois = [ expr(pois) for expr in self.bin_expressions ]
         return merged_pois
 
+    def get_matrix(self):
+        """(n_coarse, n_fine) matrix equivalent of evaluate; the merging is linear"""
+        return numpy.array([ self.evaluate(list(unit)) for unit in numpy.eye(self.n_fine) ]).T
+
 
 
@@ -79,15 +79,17 @@ def totalXS_nuispars(args):
         'higgsCombine_POSTFIT_combination_inclusive_Mar19_multiSignalModel.MultiDimFit.mH125.root'
         )
     ws = differentials.core.get_ws(postfit)
-    status = ws.loadSnapshot('MultiDimFit')
     nuispars = [ 'CMS_eff_e', 'CMS_eff_m', 'CMS_hgg_JEC', 'CMS_hgg_JER', 'CMS_hgg_LooseMvaSF', 'CMS_hgg_PreselSF', 'CMS_hgg_SigmaEOverEShift', 'CMS_hgg_TriggerWeight', 'CMS_hgg_electronVetoSF', 'CMS_hgg_phoIdMva', 'CMS_hzz2e2mu_Zjets', 'CMS_hzz4e_Zjets', 'CMS_hzz4mu_Zjets', 'CMS_zjets_bkgdcompo', 'QCDscale_VV', 'QCDscale_ggVV', 'kfactor_ggzz', 'lumi_13TeV', 'norm_nonResH', 'pdf_gg', 'pdf_qqbar', 'CMS_hgg_nuisance_LowR9EB_13TeVscale', 'CMS_zz4l_n_sig_3_8', 'CMS_zz4l_mean_m_sig', 'CMS_hgg_nuisance_Gain1EB_13TeVscale', 'CMS_hgg_nuisance_LightColl_13TeVscale', 'CMS_hgg_nuisance_Gain6EB_13TeVscale', 'CMS_hgg_nuisance_HighR9EB_13TeVsmear', 'CMS_hgg_nuisance_LowR9EB_13TeVsmear', 'CMS_zz4l_n_sig_2_8', 'CMS_zz4l_mean_e_sig', 'CMS_zz4l_sigma_m_sig', 'CMS_hgg_nuisance_deltafracright', 'CMS_hgg_nuisance_Absolute_13TeVscale', 'CMS_hgg_nuisance_MaterialForward_scale', 'CMS_hgg_nuisance_NonLinearity_13TeVscale', 'CMS_hgg_nuisance_MaterialCentral_scale', 'CMS_hgg_nuisance_LowR9EE_13TeVsmear', 'CMS_zz4l_sigma_e_sig', 'CMS_hgg_nuisance_Geant4_13TeVscale', 'CMS_hgg_nuisance_HighR9EE_13TeVscale', 'CMS_zz4l_n_sig_1_8', 'CMS_hgg_nuisance_HighR9EE_13TeVsmear', 'CMS_hgg_nuisance_LowR9EE_13TeVscale', 'CMS_hgg_nuisance_HighR9EB_13TeVscale' ]
 
     d = []
     maxname = max(map(len, nuispars))
-    for nuispar in nuispars:
-        val = ws.var(nuispar).getVal()
-        print '{0:{width}}: {1}'.format(nuispar, val, width=maxname)
-        d.append((nuispar, val))
+    # The workspace is shared; do not leave the postfit values loaded in it
+    with differentials.wsregistry.preserved_values(ws):
+        status = ws.loadSnapshot('MultiDimFit')
+        for nuispar in nuispars:
+            val = ws.var(nuispar).getVal()
+            print '{0:{width}}: {1}'.format(nuispar, val, width=maxname)
+            d.append((nuispar, val))
     d.sort(key=lambda tup: -abs(tup[1]))
 
     c = differentials.plotting.canvas.c
@@ -143,7 +143,6 @@ def projection_postfit_hbb_300ifb(args):
 
 def get_ranges_from_hbb_postfit_300ifb(args):
     w = differentials.core.get_ws(scenario1.hbb_postfit_300ifb)
-    w.loadSnapshot('MultiDimFit')
     keys = [
         'qcdeff',
         'r0p1',
@@ -155,8 +154,11 @@ def get_ranges_from_hbb_postfit_300ifb(args):
         'r3p1',
         ]
     out = {}
-    for key in keys:
-        out[key] = w.var(key).getVal()
+    # The workspace is shared; do not leave the postfit values loaded in it
+    with differentials.wsregistry.preserved_values(w):
+        w.loadSnapshot('MultiDimFit')
+        for key in keys:
+            out[key] = w.var(key).getVal()
     return out
 
 def set_hbb_parameter_ranges(args, config):
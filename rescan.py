@@ -46,26 +46,35 @@ class JobSplitter(object):
 
 
     def make_new_sh_files(self, job):
-        with open(job.sh_file, 'r') as fp:
+        self.make_new_sh_files_for_points(job.sh_file, job.points)
+
+    def make_new_sh_files_for_points(self, sh_file, points):
+        with open(sh_file, 'r') as fp:
             base_sh_text = fp.read()
 
-        points = job.points
+        # sh files from an earlier rescan refer to their own directory
+        old_scandir = osp.dirname(osp.abspath(sh_file))
+        if old_scandir == osp.abspath(self.old_scandir): old_scandir = None
         for i_chunk, chunk in enumerate(self.split_points(points)):
-            sh_text = self.get_new_shfile_text(base_sh_text, i_chunk, chunk)
+            sh_text = self.get_new_shfile_text(base_sh_text, i_chunk, chunk, old_scandir)
             outfile = osp.join(
                 self.scandir,
-                osp.basename(job.sh_file).replace('.sh', '_chunk{0}.sh'.format(i_chunk))
+                osp.basename(sh_file).replace('.sh', '_chunk{0}.sh'.format(i_chunk))
                 )
             self.dump_sh_text_to_file(outfile, sh_text)
             if self._example_sh_text is False: self._example_sh_text = sh_text
 
     def split_points(self, points):
+        if len(points) < 2: return [ points ]
         i_half = int(0.5*len(points))
         return [ points[:i_half], points[i_half:] ]
 
-    def get_new_shfile_text(self, base_sh_text, i_chunk, points):
+    def get_new_shfile_text(self, base_sh_text, i_chunk, points, old_scandir=None):
         sh_text = base_sh_text
-        sh_text = sh_text.replace(self.old_scandir, self.scandir)
+        if old_scandir is None:
+            sh_text = sh_text.replace(self.old_scandir, self.scandir)
+        else:
+            sh_text = sh_text.replace(old_scandir, osp.abspath(self.scandir))
         sh_text = re.sub(r'--doPoints ([\d,]+)', '', sh_text)
         sh_text = re.sub(r'--firstPoint (\d+)', '', sh_text)
         sh_text = re.sub(r'--lastPoint (\d+)', '', sh_text)
@@ -137,6 +146,7 @@ def main():
     parser.add_argument( 'scandirs', metavar='N', type=str, nargs='+', help='list of strings' )
     parser.add_argument( '--test', action='store_true', help='boolean')
     parser.add_argument( '--dry', action='store_true', help='boolean')
+    parser.add_argument( '--missing', action='store_true', help='Resubmit only points without a result in the scandir or its rescans')
     # parser.add_argument( '--allq', action='store_true', help='boolean')
     # parser.add_argument( '--shortq', action='store_true', help='boolean')
     # parser.add_argument( '--longq', action='store_true', help='boolean')
@@ -146,7 +156,18 @@ def main():
     
     scandir = args.scandirs[0]
     accountant = differentials.scan_accounting.ScanAccountant(scandir)
-    jobs = accountant.get_failed_jobs()
+    if args.missing:
+        accountant.process()
+        index = differentials.scancompleteness.CompletenessIndex(scandir)
+        index.update()
+        index.log_summary()
+        missing = index.missing_points_per_job()
+        logging.warning(
+            '{0} jobs have points without a result ({1} points in total)'
+            .format(len(missing), sum(len(points) for _, points in missing))
+            )
+    else:
+        jobs = accountant.get_failed_jobs()
 
     if args.test:
         differentials.core.testmode()
@@ -156,8 +177,12 @@ def main():
     splitter.make_new_scandir()
     splitter.copy_postfit_and_fastscan()
 
-    for job in jobs:
-        splitter.make_new_sh_files(job)
+    if args.missing:
+        for sh_file, points in missing:
+            splitter.make_new_sh_files_for_points(sh_file, points)
+    else:
+        for job in jobs:
+            splitter.make_new_sh_files(job)
 
     splitter.submit()
 
@@ -41,6 +41,9 @@ def main():
     parser.add_argument( '--savepng',   action='store_true' )
     parser.add_argument( '--savepng_convert',   action='store_true' )
     parser.add_argument( '--savegray',   action='store_true' )
+    parser.add_argument( '--scancache',   action='store_true' )
+    parser.add_argument( '--readworkers', type=int, default=1 )
+    parser.add_argument( '--completenessindex', action='store_true' )
 
     parser.add_argument( '--statonly', action='store_true' )
     parser.add_argument( '--statsyst', action='store_true' )
@@ -125,6 +128,12 @@ def main():
         differentials.core.save_png_through_convert()
     if args.savegray:
         differentials.core.save_gray()
+    if args.scancache:
+        differentials.scancache.enable()
+    if args.readworkers > 1:
+        differentials.scans.DifferentialSpectrum.n_read_workers = args.readworkers
+    if args.completenessindex:
+        differentials.scans.DifferentialSpectrum.use_completeness_index = True
 
 
     ########################################